@@ -0,0 +1,296 @@
+"""Time the hot paths of generate_templates.py and compare runs against a baseline.
+
+Usage: python benchmarks/hot_paths.py run [--quick] [--repeat 5] [--output results.json]
+       python benchmarks/hot_paths.py compare baseline.json results.json [--threshold 0.25]
+
+`run` times every case on synthetic fixtures and writes the best time of each
+case as JSON; keep one as the baseline of a machine. `compare` exits with
+status 1 if a case of the second file is slower than in the first by more
+than the threshold, a share of the baseline time that --case-threshold
+overrides per case.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# Keep the host facts and fingerprints of the runs out of the user's cache.
+SCRATCH_DIR = tempfile.mkdtemp(prefix="latex-docker-bench-")
+os.environ["XDG_CACHE_HOME"] = os.path.join(SCRATCH_DIR, "cache")
+
+import generate_templates  # noqa: E402
+from yaml_io import synthetic_compose  # noqa: E402
+
+# Sizes of the fixtures: env file lines, services and volumes per service.
+SIZES = {
+    "env_lines": [10, 1000, 100000],
+    "services": [1, 100, 1000],
+    "volumes": [10000],
+    "main_services": [1, 50],
+}
+QUICK_SIZES = {
+    "env_lines": [10, 1000],
+    "services": [1, 100],
+    "volumes": [1000],
+    "main_services": [1],
+}
+# Timings below this many seconds are within the noise of a run.
+DEFAULT_MIN_SECONDS = 0.0005
+
+
+def synthetic_env(lines: int) -> str:
+    # User variables followed by the managed block, as the generator writes it.
+    contents = [f"USER_VARIABLE_{i}=value_{i}" for i in range(lines)]
+    contents += [
+        generate_templates.ENV_FILE_BEGIN_MARKER,
+        "DOCKER_BUILDKIT=1",
+        'DISPLAY="$DISPLAY"',
+        "XAUTHORITY=/tmp/.docker.xauth",
+        generate_templates.ENV_FILE_END_MARKER,
+    ]
+    return "".join(line + "\n" for line in contents)
+
+
+def synthetic_build_args_env(services: int) -> str:
+    contents = []
+    for i in range(services):
+        contents += [
+            f"# >>> as services.latex-{i}.build.args",
+            "BASE_IMAGE=ubuntu:24.04",
+            "TEXLIVE_VERSION=2024",
+            "DOCKER_USER=latex",
+            "DOCKER_HOME=/home/latex",
+            f"# <<< as services.latex-{i}.build.args",
+        ]
+    return "".join(line + "\n" for line in contents)
+
+
+def write(filename: str, contents: str) -> str:
+    with open(filename, "w") as file:
+        file.write(contents)
+    return filename
+
+
+def best_of(statement, repeat: int) -> float:
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def run_main(argv):
+    sys.argv = ["generate_templates.py"] + argv
+    try:
+        generate_templates.main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+
+
+def main_fixture(directory: str, services: int):
+    # The repo's sample env and compose files, plus a manifest of `services`.
+    os.makedirs(directory)
+    shutil.copy(os.path.join(REPO_DIR, ".latex.env"), os.path.join(directory, ".env"))
+    shutil.copy(os.path.join(REPO_DIR, "docker-compose.yml"), directory)
+    argv = [
+        "--env-file",
+        os.path.join(directory, ".env"),
+        "--compose-file",
+        os.path.join(directory, "docker-compose.yml"),
+        "--entrypoint-path",
+        os.path.join(directory, "entrypoint.sh"),
+    ]
+    if services == 1:
+        return argv + ["--service-name", "latex", "--entrypoint"]
+    manifest = {
+        "services": [
+            {"service-name": f"latex-{i}", "cpu-limit": 2} for i in range(services)
+        ]
+    }
+    return argv + [
+        "--manifest",
+        write(os.path.join(directory, "services.json"), json.dumps(manifest)),
+    ]
+
+
+def cases(sizes, scratch: str):
+    # (name, statement) of every case; the fixtures are written up front.
+    for lines in sizes["env_lines"]:
+        env_file = write(os.path.join(scratch, f"env-{lines}"), synthetic_env(lines))
+        yield f"manage_content_in_file/line/{lines}", lambda env_file=env_file: (
+            generate_templates.manage_content_in_file(
+                env_file, "XAUTHORITY=/tmp/.docker.xauth", True
+            )
+        )
+        block = ["DOCKER_BUILDKIT=1", 'DISPLAY="$DISPLAY"']
+        yield f"manage_content_in_file/block/{lines}", lambda env_file=env_file: (
+            generate_templates.manage_content_in_file(env_file, block, True)
+        )
+        # Adding and removing a line rewrites the file twice.
+        yield f"manage_content_in_file/toggle/{lines}", lambda env_file=env_file: (
+            generate_templates.manage_content_in_file(env_file, "NEW=1", True),
+            generate_templates.manage_content_in_file(env_file, "NEW=1", False),
+        )
+
+    for services in sizes["services"]:
+        compose_data = synthetic_compose(services)
+        compose_file = os.path.join(scratch, f"compose-{services}.yml")
+        generate_templates.write_yaml(compose_file, compose_data)
+        env_file = write(
+            os.path.join(scratch, f"build-args-{services}"),
+            synthetic_build_args_env(services),
+        )
+        yield f"generate_build_args/{services}", lambda compose_file=compose_file, env_file=env_file, compose_data=compose_data: (
+            generate_templates.generate_build_args(
+                compose_file, env_file, compose_data=copy.deepcopy(compose_data)
+            )
+        )
+        yield f"yaml_load/{services}", lambda compose_file=compose_file: (
+            generate_templates.load_yaml(compose_file)
+        )
+        yield f"yaml_dump/{services}", lambda compose_data=compose_data: (
+            generate_templates.dump_yaml(compose_data)
+        )
+
+    for volumes in sizes["volumes"]:
+        compose_data = synthetic_compose(1)
+        compose_data["services"]["latex-0"]["volumes"] = [
+            f"/data/{i}:/home/latex/data/{i}:ro" for i in range(volumes)
+        ]
+        compose_file = os.path.join(scratch, f"volumes-{volumes}.yml")
+        generate_templates.write_yaml(compose_file, compose_data)
+        yield f"yaml_load/volumes/{volumes}", lambda compose_file=compose_file: (
+            generate_templates.load_yaml(compose_file)
+        )
+        yield f"yaml_dump/volumes/{volumes}", lambda compose_data=compose_data: (
+            generate_templates.dump_yaml(compose_data)
+        )
+
+    for services in sizes["main_services"]:
+        argv = main_fixture(os.path.join(scratch, f"main-{services}"), services)
+        run_main(argv)
+        # Without the fingerprint, every generator runs against files that
+        # are already up to date, as after an edit of an unrelated input.
+        yield f"main/cold/{services}", lambda argv=argv: (
+            shutil.rmtree(generate_templates.FINGERPRINT_DIR, ignore_errors=True),
+            run_main(argv),
+        )
+        yield f"main/unchanged/{services}", lambda argv=argv: run_main(argv)
+
+
+def run(args):
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = {}
+    try:
+        for name, statement in cases(sizes, SCRATCH_DIR):
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = best_of(statement, args.repeat)
+            print(f"{name:<45} {results[name] * 1e3:>10.3f} ms", flush=True)
+    finally:
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "libyaml": generate_templates.yaml_classes()[0].__name__.startswith("C"),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Saved {len(results)} results to {args.output}.")
+
+
+def compare(args):
+    thresholds = {}
+    for item in args.case_threshold:
+        name, _, value = item.rpartition("=")
+        thresholds[name] = float(value)
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)["results"]
+    with open(args.current, "r") as file:
+        current = json.load(file)["results"]
+
+    regressions = []
+    print(f"{'case':<45} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        change = after / before - 1 if before else 0.0
+        threshold = thresholds.get(name, args.threshold)
+        regressed = change > threshold and after - before > args.min_seconds
+        print(
+            f"{name:<45} {before * 1e3:>8.3f}ms {after * 1e3:>8.3f}ms {change:>+7.1%}"
+            + ("  REGRESSED" if regressed else "")
+        )
+        if regressed:
+            regressions.append(name)
+    for name in sorted(set(baseline) ^ set(current)):
+        print(
+            f"{name:<45} only in {'the baseline' if name in baseline else 'the current run'}"
+        )
+    if regressions:
+        sys.exit(
+            f"{len(regressions)} cases regressed past their threshold: {', '.join(regressions)}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Time every case")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--quick", action="store_true", help="Smaller fixtures")
+    run_parser.add_argument("--filter", type=str, help="Only the cases containing this")
+    run_parser.add_argument(
+        "--output", type=str, help="Write the results to this JSON file"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Fail if a case regressed against the baseline"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown as a share of the baseline time (default: %(default)s)",
+    )
+    compare_parser.add_argument(
+        "--case-threshold",
+        type=str,
+        action="append",
+        default=[],
+        metavar="CASE=SHARE",
+        help="Allowed slowdown of one case, e.g. main/cold/1=0.5",
+    )
+    compare_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=DEFAULT_MIN_SECONDS,
+        help="Ignore slowdowns smaller than this many seconds (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    # The generator logs every step at DEBUG.
+    logging.disable(logging.CRITICAL)
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
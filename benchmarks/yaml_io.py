@@ -0,0 +1,109 @@
+"""Compare the libyaml and pure-Python YAML paths of generate_templates.py.
+
+Usage: python benchmarks/yaml_io.py [--services 1 50 500] [--repeat 5]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import generate_templates  # noqa: E402
+
+
+def synthetic_compose(services: int) -> dict:
+    compose_data = {"networks": {"latex-network": {"driver": "bridge"}}, "services": {}}
+    for i in range(services):
+        name = f"latex-{i}"
+        compose_data["services"][name] = {
+            "build": {
+                "args": {
+                    key: f"${{{key}}}"
+                    for key in (
+                        "BASE_IMAGE",
+                        "COMPILE_JOBS",
+                        "DOCKER_BUILDKIT",
+                        "DOCKER_GID",
+                        "DOCKER_HOME",
+                        "DOCKER_UID",
+                        "DOCKER_USER",
+                        "TEXLIVE_VERSION",
+                    )
+                },
+                "context": ".",
+                "dockerfile": "Dockerfile",
+                "network": "${BUILDTIME_NETWORK_MODE}",
+            },
+            "container_name": name,
+            "deploy": {
+                "resources": {
+                    "limits": {"cpus": 8.0, "memory": "15.49G"},
+                    "reservations": {"cpus": 1.0, "memory": "1.94G"},
+                }
+            },
+            "env_file": "./.env",
+            "image": f"{name}:latest",
+            "restart": "always",
+            "user": "${DOCKER_UID}:${DOCKER_GID}",
+            "volumes": [
+                "~/Projects:${DOCKER_HOME}/Projects:rw",
+                "~/Documents:${DOCKER_HOME}/Documents:rw",
+                "/tmp/.X11-unix:/tmp/.X11-unix:rw",
+            ],
+        }
+    return compose_data
+
+
+def best_of(statement, repeat: int) -> float:
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--services", type=int, nargs="+", default=[1, 50, 500])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    modes = {"pure-python": (yaml.SafeLoader, yaml.SafeDumper)}
+    if getattr(yaml, "__with_libyaml__", False):
+        modes["libyaml"] = (yaml.CSafeLoader, yaml.CSafeDumper)
+    else:
+        print("PyYAML was built without libyaml; only the fallback is measured.")
+
+    print(f"{'services':>8}  {'mode':<12} {'load (ms)':>10} {'dump (ms)':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for services in args.services:
+            compose_file = os.path.join(tmp, f"compose-{services}.yml")
+            generate_templates.write_yaml(compose_file, synthetic_compose(services))
+
+            outputs = {}
+            timings = {}
+            for mode, (loader, dumper) in modes.items():
+                data = generate_templates.load_yaml(compose_file, loader)
+                outputs[mode] = generate_templates.dump_yaml(data, dumper)
+                load = best_of(
+                    lambda: generate_templates.load_yaml(compose_file, loader),
+                    args.repeat,
+                )
+                dump = best_of(
+                    lambda: generate_templates.dump_yaml(data, dumper), args.repeat
+                )
+                timings[mode] = (load, dump)
+                print(f"{services:>8}  {mode:<12} {load * 1e3:>10.2f} {dump * 1e3:>10.2f}")
+
+            if len(set(outputs.values())) != 1:
+                sys.exit(f"Dumped YAML differs between modes for {services} services.")
+            if "libyaml" in timings:
+                fallback, fast = timings["pure-python"], timings["libyaml"]
+                print(
+                    f"{'':>8}  {'speedup':<12} {fallback[0] / fast[0]:>9.1f}x {fallback[1] / fast[1]:>9.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,784 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import math
+import time
+import shlex
+import shutil
+import hashlib
+import argparse
+import threading
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "latex-build"
+)
+DEFAULT_COMMAND = "latexmk -pdf -interaction=nonstopmode -halt-on-error {source}"
+MEMORY_UNITS = {"": 1, "b": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+# A measured peak is scaled by this much when it is used as an estimate.
+ESTIMATE_MARGIN = 1.25
+LOG_TAIL_LINES = 20
+INDEX_VERSION = 1
+CHUNK_SIZE = 1 << 16
+# Outputs restored from the output cache, next to the document.
+OUTPUT_EXTENSIONS = (".pdf", ".synctex.gz")
+
+DOCUMENT_CLASS = re.compile(r"^[^%\n]*\\documentclass", re.MULTILINE)
+BEGIN_DOCUMENT = re.compile(r"^[^%\n]*\\begin\s*\{document\}", re.MULTILINE)
+# Magic comment of a file compiled through another root document.
+TEX_ROOT = re.compile(r"^\s*%\s*!\s*TEX\s+root\s*=", re.MULTILINE | re.IGNORECASE)
+COMMENT = re.compile(r"(?<!\\)%.*")
+# Commands whose argument names files a document reads, with the extensions
+# tried in turn. Packages and classes only count when they are local.
+DEPENDENCY = re.compile(
+    r"\\(input|include|subfile|includegraphics|addbibresource|bibliography"
+    r"|usepackage|RequirePackage|documentclass|LoadClass)\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}"
+)
+DEPENDENCY_EXTENSIONS = {
+    "input": ("", ".tex"),
+    "include": (".tex",),
+    "subfile": ("", ".tex"),
+    "includegraphics": ("", ".pdf", ".png", ".jpg", ".jpeg", ".eps"),
+    "addbibresource": ("",),
+    "bibliography": (".bib", ""),
+    "usepackage": (".sty",),
+    "RequirePackage": (".sty",),
+    "documentclass": (".cls",),
+    "LoadClass": (".cls",),
+}
+LOCAL_ONLY = {"usepackage", "RequirePackage", "documentclass", "LoadClass"}
+SCANNED_EXTENSIONS = (".tex", ".sty", ".cls")
+
+
+class Job(NamedTuple):
+    source: str
+    memory: int  # bytes reserved while it runs
+    seconds: float  # expected duration, 0 if unknown
+
+
+class Result(NamedTuple):
+    source: str
+    returncode: int
+    queued: float  # seconds from the start of the build until the job started
+    seconds: float
+    peak_rss: int  # bytes
+    log: str
+
+
+def parse_memory(value: str) -> int:
+    # Docker's memory notation, e.g. 512M, 1.5G or a number of bytes.
+    match = re.fullmatch(r"\s*([\d.]+)\s*([bkmgt]?)i?b?\s*", str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory size '{value}'.")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def format_memory(size: float) -> str:
+    return "{:.2f}G".format(size / (1 << 30))
+
+
+def read_first_line(filename: str) -> Optional[str]:
+    try:
+        with open(filename, "r") as file:
+            return file.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_limits(
+    root: str = "/sys/fs/cgroup",
+) -> Tuple[Optional[float], Optional[int]]:
+    # (cpus, memory) of the container, None where it is unlimited.
+    cpus = memory = None
+    cpu_max = read_first_line(os.path.join(root, "cpu.max"))
+    if cpu_max is not None:  # cgroup v2
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max":
+            cpus = int(quota) / int(period)
+        memory_max = read_first_line(os.path.join(root, "memory.max"))
+        if memory_max not in (None, "max"):
+            memory = int(memory_max)
+    else:  # cgroup v1
+        quota = read_first_line(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+        period = read_first_line(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+        if quota and period and int(quota) > 0:
+            cpus = int(quota) / int(period)
+        limit = read_first_line(os.path.join(root, "memory", "memory.limit_in_bytes"))
+        # Unlimited is reported as a huge number.
+        if limit and int(limit) < host_memory():
+            memory = int(limit)
+    return cpus, memory
+
+
+def compose_limits(
+    compose_file: str, service: str
+) -> Tuple[Optional[float], Optional[int]]:
+    # The limits generate_templates.py wrote for the service.
+    import yaml
+
+    with open(compose_file, "r") as file:
+        compose_data = yaml.safe_load(file) or {}
+    if service not in compose_data.get("services", {}):
+        raise ValueError(f"Service '{service}' is not in '{compose_file}'.")
+    service_data = compose_data["services"][service]
+    limits = service_data.get("deploy", {}).get("resources", {}).get("limits", {})
+    cpus = float(limits["cpus"]) if "cpus" in limits else None
+    if "cpuset" in service_data:
+        cpuset = len(parse_cpulist(str(service_data["cpuset"])))
+        cpus = cpuset if cpus is None else min(cpus, cpuset)
+    memory = parse_memory(limits["memory"]) if "memory" in limits else None
+    return cpus, memory
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    # The kernel's list format, e.g. "0-3,8,10-11".
+    cpus = []
+    for part in cpulist.split(","):
+        first, _, last = part.strip().partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def host_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def host_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def resolve_limits(args) -> Tuple[float, int, str]:
+    # (cpus, memory, where they come from): the options, then the compose file
+    # when given, then the cgroup, then the host.
+    if args.compose_file is not None:
+        cpus, memory = compose_limits(args.compose_file, args.service)
+        source = f"service '{args.service}' of {args.compose_file}"
+    else:
+        cpus, memory = cgroup_limits()
+        source = "the cgroup"
+    cpus = min(cpus or host_cpus(), host_cpus())
+    memory = memory or host_memory()
+    if args.cpus is not None or args.memory is not None:
+        source = "the command line"
+    if args.cpus is not None:
+        cpus = args.cpus
+    if args.memory is not None:
+        memory = parse_memory(args.memory)
+    return cpus, memory, source
+
+
+def is_root_document(filename: str) -> bool:
+    try:
+        with open(filename, "r", encoding="utf-8", errors="replace") as file:
+            text = file.read()
+    except OSError:
+        return False
+    return (
+        TEX_ROOT.search(text[:2048]) is None
+        and DOCUMENT_CLASS.search(text) is not None
+        and BEGIN_DOCUMENT.search(text) is not None
+    )
+
+
+def discover_documents(paths: List[str]) -> List[str]:
+    documents = []
+    for path in paths:
+        if os.path.isfile(path):
+            documents.append(path)
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            # Hidden directories and minted caches hold no documents of ours.
+            subdirectories[:] = sorted(
+                name for name in subdirectories if not name.startswith((".", "_minted"))
+            )
+            documents.extend(
+                os.path.join(directory, name)
+                for name in sorted(files)
+                if name.endswith(".tex")
+                and is_root_document(os.path.join(directory, name))
+            )
+    return [os.path.abspath(document) for document in documents]
+
+
+def hash_file(filename: str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def scan_references(filename: str) -> List[Tuple[str, str]]:
+    # (command, name) of every file reference in a TeX source.
+    with open(filename, "r", encoding="utf-8", errors="replace") as file:
+        text = COMMENT.sub("", file.read())
+    return [
+        (command, name.strip())
+        for command, names in DEPENDENCY.findall(text)
+        for name in names.split(",")
+        if name.strip()
+    ]
+
+
+class DependencyIndex:
+    # The content hash and file references of every file the documents read.
+    # A file is only hashed and scanned again once its size or mtime changes,
+    # so an unchanged tree costs a stat per file.
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.documents: Dict[str, str] = {}  # source: key of its last build
+        try:
+            with open(filename, "r") as file:
+                index = json.load(file)
+            if index.get("version") == INDEX_VERSION:
+                self.files = index["files"]
+                self.documents = index["documents"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def node(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        identity = [stat.st_size, stat.st_mtime_ns]
+        node = self.files.get(path)
+        if node is None or node["identity"] != identity:
+            node = {
+                "identity": identity,
+                "sha256": hash_file(path),
+                "references": (
+                    scan_references(path) if path.endswith(SCANNED_EXTENSIONS) else []
+                ),
+            }
+            self.files[path] = node
+        return node
+
+    def closure(self, source: str) -> Dict[str, Optional[str]]:
+        # {path: sha256} of the document and everything it reads transitively;
+        # None for referenced files that do not exist (yet).
+        root = os.path.dirname(source)
+        hashes: Dict[str, Optional[str]] = {}
+        pending = [source]
+        while pending:
+            path = pending.pop()
+            if path in hashes:
+                continue
+            node = self.node(path)
+            hashes[path] = None if node is None else node["sha256"]
+            for command, name in [] if node is None else node["references"]:
+                resolved = resolve_reference(command, name, root, os.path.dirname(path))
+                if resolved is not None:
+                    pending.append(resolved)
+        return hashes
+
+    def document_key(self, source: str, salt: str) -> str:
+        # Paths relative to the document, so that checkouts at other paths,
+        # e.g. in CI, share keys.
+        root = os.path.dirname(source)
+        hasher = hashlib.sha256(salt.encode())
+        for path, digest in sorted(self.closure(source).items()):
+            hasher.update(f"{os.path.relpath(path, root)}\0{digest}\0".encode())
+        return hasher.hexdigest()
+
+    def save(self):
+        # Forget the files that no document reads any more.
+        live = set()
+        for source in self.documents:
+            live.update(self.closure(source))
+        index = {
+            "version": INDEX_VERSION,
+            "files": {path: node for path, node in self.files.items() if path in live},
+            "documents": self.documents,
+        }
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        temporary = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(index, file)
+        os.replace(temporary, self.filename)
+
+
+def resolve_reference(
+    command: str, name: str, root: str, directory: str
+) -> Optional[str]:
+    # TeX resolves names from the root document's directory; the including
+    # file's directory is a fallback. A missing input still counts, so that
+    # creating it invalidates the document.
+    for base in (root, directory):
+        for extension in DEPENDENCY_EXTENSIONS[command]:
+            path = os.path.normpath(os.path.join(base, name + extension))
+            if os.path.isfile(path):
+                return path
+    if command in LOCAL_ONLY:
+        return None
+    return os.path.normpath(
+        os.path.join(root, name + DEPENDENCY_EXTENSIONS[command][-1])
+    )
+
+
+def output_directory(source: str) -> str:
+    # Where latexmk writes the outputs: the tmpfs directory the generated
+    # latexmkrc picks from the working directory with --scratch-size, unless
+    # --sync-back copies them next to the document.
+    directory = os.path.dirname(source)
+    scratch = os.environ.get("LATEX_SCRATCH_DIR")
+    if scratch and not os.environ.get("LATEX_SYNC_BACK"):
+        return os.path.join(scratch, os.path.realpath(directory).replace(os.sep, "_"))
+    return directory
+
+
+def output_files(source: str) -> Dict[str, str]:
+    # {extension: path} of the outputs latexmk writes for the document
+    stem = os.path.join(
+        output_directory(source), os.path.splitext(os.path.basename(source))[0]
+    )
+    return {extension: stem + extension for extension in OUTPUT_EXTENSIONS}
+
+
+class OutputCache:
+    # PDFs and SyncTeX files by the key of their inputs, under a directory
+    # that several containers may share. An entry appears atomically, and the
+    # first of concurrent stores wins.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key: str, source: str) -> bool:
+        entry = self.entry(key)
+        if not os.path.isfile(os.path.join(entry, "output.pdf")):
+            return False
+        outputs = output_files(source)
+        os.makedirs(os.path.dirname(outputs[".pdf"]), exist_ok=True)
+        for extension, path in outputs.items():
+            cached = os.path.join(entry, "output" + extension)
+            if os.path.isfile(cached):
+                # A fresh mtime, so that latexmk sees the output as up to date.
+                shutil.copyfile(cached, path)
+        return True
+
+    def store(self, key: str, source: str):
+        entry = self.entry(key)
+        outputs = output_files(source)
+        if os.path.isdir(entry):
+            return
+        if not os.path.isfile(outputs[".pdf"]):
+            logger.warning(
+                f"Not caching the outputs of {source}: {outputs['.pdf']} does not exist."
+            )
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temporary = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        try:
+            for extension, path in outputs.items():
+                if os.path.isfile(path):
+                    shutil.copyfile(path, os.path.join(temporary, "output" + extension))
+            os.rename(temporary, entry)
+        except OSError:  # stored by another container in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+
+
+def load_history(filename: str) -> Dict[str, Dict[str, float]]:
+    # {source: {"seconds": ..., "peak_rss": ...}} of the last successful builds
+    try:
+        with open(filename, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_history(filename: str, history: Dict[str, Dict[str, float]]):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(history, file, indent=2, sort_keys=True)
+    os.replace(temporary, filename)
+
+
+def plan_jobs(
+    documents: List[str], history: Dict[str, Dict[str, float]], job_memory: int
+) -> List[Job]:
+    # Longest first, so that the slowest documents do not start last.
+    jobs = []
+    for source in documents:
+        previous = history.get(source, {})
+        memory = (
+            int(previous["peak_rss"] * ESTIMATE_MARGIN)
+            if "peak_rss" in previous
+            else job_memory
+        )
+        jobs.append(Job(source, memory, previous.get("seconds", 0.0)))
+    return sorted(jobs, key=lambda job: -job.seconds)
+
+
+class Scheduler:
+    # Runs jobs on at most `slots` processes. A job is admitted while the
+    # memory reserved by the running ones leaves room for its estimate; a
+    # job larger than the whole budget runs alone.
+
+    def __init__(
+        self,
+        command: str,
+        slots: int,
+        memory_budget: int,
+        logs_dir: str,
+        stream: bool = False,
+    ):
+        self.command = command
+        self.slots = slots
+        self.memory_budget = memory_budget
+        self.logs_dir = logs_dir
+        self.stream = stream
+        self.condition = threading.Condition()
+        self.output_lock = threading.Lock()
+        self.running = 0
+        self.reserved = 0
+        self.peak_running = 0
+        self.results: List[Result] = []
+
+    def admissible(self, job: Job) -> bool:
+        return self.running < self.slots and (
+            self.running == 0 or self.reserved + job.memory <= self.memory_budget
+        )
+
+    def run(self, jobs: List[Job]) -> List[Result]:
+        self.start = time.monotonic()
+        pending = list(jobs)
+        with self.condition:
+            while pending or self.running:
+                job = next((job for job in pending if self.admissible(job)), None)
+                if job is None:
+                    self.condition.wait()
+                    continue
+                pending.remove(job)
+                self.running += 1
+                self.reserved += job.memory
+                self.peak_running = max(self.peak_running, self.running)
+                threading.Thread(target=self.worker, args=(job,), daemon=True).start()
+        return self.results
+
+    def worker(self, job: Job):
+        try:
+            result = self.run_job(job)
+        except OSError as e:
+            result = Result(job.source, 127, 0.0, 0.0, 0, str(e))
+        except Exception as e:
+            # The slot and the memory must be released, or run() waits forever.
+            logger.exception(f"Unexpected error while building {job.source}.")
+            result = Result(job.source, 1, 0.0, 0.0, 0, str(e))
+        with self.condition:
+            self.running -= 1
+            self.reserved -= job.memory
+            self.results.append(result)
+            self.condition.notify_all()
+        if result.returncode != 0:
+            logger.error(f"Failed to build {result.source}; see {result.log}.")
+
+    def log_file(self, source: str) -> str:
+        name = source.lstrip(os.sep).replace(os.sep, "_")
+        return os.path.join(self.logs_dir, os.path.splitext(name)[0] + ".log")
+
+    def run_job(self, job: Job) -> Result:
+        queued = time.monotonic() - self.start
+        directory, name = os.path.split(job.source)
+        command = [word.format(source=name) for word in shlex.split(self.command)]
+        log_file = self.log_file(job.source)
+        label = os.path.relpath(job.source)
+        with open(log_file, "wb") as log:
+            process = subprocess.Popen(
+                command,
+                cwd=directory,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            for line in process.stdout:
+                log.write(line)
+                if self.stream:
+                    with self.output_lock:
+                        sys.stdout.write(f"[{label}] {line.decode(errors='replace')}")
+                        sys.stdout.flush()
+            # wait4 also reports the peak RSS of the engines latexmk ran.
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        return Result(
+            job.source,
+            process.returncode,
+            queued,
+            time.monotonic() - self.start - queued,
+            usage.ru_maxrss * 1024,
+            log_file,
+        )
+
+
+def percentile(values: List[float], share: float) -> float:
+    # Nearest rank.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * share) - 1)] if ordered else 0.0
+
+
+def summarize(
+    results: List[Result],
+    elapsed: float,
+    scheduler: Scheduler,
+    up_to_date: int = 0,
+    restored: int = 0,
+) -> Dict[str, Any]:
+    latencies = [result.queued + result.seconds for result in results]
+    return {
+        "documents": len(results),
+        "up_to_date": up_to_date,
+        "restored": restored,
+        "failed": sorted(result.source for result in results if result.returncode),
+        "elapsed": round(elapsed, 3),
+        "throughput_per_minute": (
+            round(60 * len(results) / elapsed, 2) if elapsed else 0.0
+        ),
+        "slots": scheduler.slots,
+        "peak_running": scheduler.peak_running,
+        "memory_budget": scheduler.memory_budget,
+        "peak_rss": max((result.peak_rss for result in results), default=0),
+        "latency": {
+            "p50": round(percentile(latencies, 0.5), 3),
+            "p90": round(percentile(latencies, 0.9), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(max(latencies, default=0.0), 3),
+        },
+        "jobs": [
+            {
+                "source": result.source,
+                "returncode": result.returncode,
+                "queued": round(result.queued, 3),
+                "seconds": round(result.seconds, 3),
+                "peak_rss": result.peak_rss,
+            }
+            for result in sorted(results, key=lambda result: result.source)
+        ],
+    }
+
+
+def print_log_tail(result: Result):
+    try:
+        with open(result.log, "r", errors="replace") as file:
+            lines = file.readlines()[-LOG_TAIL_LINES:]
+    except OSError:
+        return
+    sys.stderr.write(f"--- {result.log}\n" + "".join(lines))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Build many LaTeX documents in parallel within the container's CPU and memory limits.",
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=["."],
+        help="Root documents, or directories to search for them (default: .)",
+    )
+    parser.add_argument(
+        "--command",
+        default=DEFAULT_COMMAND,
+        help="Build command, run in the document's directory; {source} is replaced "
+        "by the document's file name, and a literal brace is written {{ or }} "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=float,
+        help="CPU limit (default: from --compose-file, the cgroup or the host)",
+    )
+    parser.add_argument(
+        "--memory",
+        type=str,
+        help="Memory limit, e.g. 4G (default: from --compose-file, the cgroup or the host)",
+    )
+    parser.add_argument(
+        "--compose-file",
+        type=str,
+        help="Take the limits of --service from this compose file instead of the cgroup",
+    )
+    parser.add_argument(
+        "--service",
+        type=str,
+        default="latex",
+        help="Service of --compose-file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Maximum parallel builds (default: the CPU limit)",
+    )
+    parser.add_argument(
+        "--job-memory",
+        type=str,
+        default="1G",
+        help="Memory reserved for a document without a measured peak (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-headroom",
+        type=float,
+        default=0.1,
+        help="Share of the memory limit left unreserved (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--logs-dir",
+        type=str,
+        default=os.path.join(CACHE_DIR, "logs"),
+        help="Directory of the per-document logs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        default=os.path.join(CACHE_DIR, "history.json"),
+        help="Durations and peak memory of previous builds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        default=os.path.join(CACHE_DIR, "index.json"),
+        help="Dependency graph and content hashes of the documents (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--output-cache",
+        type=str,
+        default=os.environ.get("LATEX_BUILD_CACHE"),
+        help="Directory of PDFs and SyncTeX files by the hash of their inputs, "
+        "shareable between containers (default: $LATEX_BUILD_CACHE)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Build every document, even if its inputs are unchanged",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Also print the output of every build, prefixed with its document",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Write the summary and per-document timings to this JSON file",
+    )
+    args = parser.parse_args()
+    # Fail before any build starts rather than in every job.
+    try:
+        for word in shlex.split(args.command):
+            word.format(source="")
+    except (KeyError, IndexError, ValueError) as e:
+        parser.error(
+            f"invalid --command '{args.command}': {e!r}. Only {{source}} is "
+            "replaced; write a literal brace as {{ or }}."
+        )
+    return args
+
+
+def main():
+    args = parse_arguments()
+    documents = discover_documents(args.paths)
+    if not documents:
+        logger.warning("No root documents found.")
+        return
+
+    # Only documents whose transitive inputs changed are built; the outputs
+    # of inputs built before, here or in another container, are restored.
+    index = DependencyIndex(args.index)
+    output_cache = None if args.output_cache is None else OutputCache(args.output_cache)
+    salt = f"{args.command}\0{os.environ.get('TEXLIVE_VERSION', '')}"
+    start = time.monotonic()
+    with ThreadPoolExecutor() as pool:
+        keys = dict(
+            zip(
+                documents,
+                pool.map(lambda source: index.document_key(source, salt), documents),
+            )
+        )
+    up_to_date = restored = 0
+    outdated = []
+    for document in documents:
+        key = keys[document]
+        if args.force:
+            outdated.append(document)
+        elif index.documents.get(document) == key and os.path.isfile(
+            output_files(document)[".pdf"]
+        ):
+            up_to_date += 1
+        elif output_cache is not None and output_cache.restore(key, document):
+            index.documents[document] = key
+            restored += 1
+        else:
+            outdated.append(document)
+    logger.info(
+        f"Hashed the inputs of {len(documents)} documents in {time.monotonic() - start:.1f}s: "
+        f"{up_to_date} up to date, {restored} restored from the output cache."
+    )
+    documents = outdated
+
+    cpus, memory, source = resolve_limits(args)
+    slots = args.jobs if args.jobs is not None else max(1, int(cpus))
+    memory_budget = int(memory * (1 - args.memory_headroom))
+    logger.info(
+        f"Building {len(documents)} documents with up to {slots} jobs and {format_memory(memory_budget)} "
+        f"of memory ({cpus:g} CPUs and {format_memory(memory)} from {source})."
+    )
+
+    history = load_history(args.history)
+    jobs = plan_jobs(documents, history, parse_memory(args.job_memory))
+    os.makedirs(args.logs_dir, exist_ok=True)
+    scheduler = Scheduler(
+        args.command, slots, memory_budget, args.logs_dir, args.stream
+    )
+    results = scheduler.run(jobs)
+    elapsed = time.monotonic() - start
+
+    for result in results:
+        if result.returncode == 0:
+            history[result.source] = {
+                "seconds": round(result.seconds, 3),
+                "peak_rss": result.peak_rss,
+            }
+            index.documents[result.source] = keys[result.source]
+            if output_cache is not None:
+                output_cache.store(keys[result.source], result.source)
+        else:
+            index.documents.pop(result.source, None)
+            print_log_tail(result)
+    save_history(args.history, history)
+    index.save()
+
+    summary = summarize(results, elapsed, scheduler, up_to_date, restored)
+    latency = summary["latency"]
+    logger.info(
+        f"Built {len(results) - len(summary['failed'])}/{len(results)} documents "
+        f"({up_to_date} up to date, {restored} restored) in {elapsed:.1f}s "
+        f"({summary['throughput_per_minute']} per minute, at most {scheduler.peak_running} at once, "
+        f"peak RSS {format_memory(summary['peak_rss'])}); latency p50 {latency['p50']}s, "
+        f"p90 {latency['p90']}s, p99 {latency['p99']}s, max {latency['max']}s."
+    )
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            json.dump(summary, file, indent=2)
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+CHECKSUM_ALGORITHMS = ("sha512", "sha256", "md5")
+VERIFIED_CACHE_FILE = ".verified.json"
+
+
+def load_manifest(manifest_file: str) -> List[Dict[str, Any]]:
+    # A YAML or TOML list of {url, path, checksums (optional)} entries, either
+    # bare or under an "artifacts" key. Checksums are given inline as sha512,
+    # sha256 or md5, or as a checksum_url whose extension names the algorithm.
+    # Paths are relative to the downloads directory. $VARIABLES in url, path
+    # and checksum_url are expanded from the environment.
+    if manifest_file.endswith(".toml"):
+        try:
+            import tomllib
+        except ModuleNotFoundError:  # Python < 3.11
+            import tomli as tomllib
+        with open(manifest_file, "rb") as file:
+            manifest = tomllib.load(file)
+    else:
+        import yaml
+
+        with open(manifest_file, "r") as file:
+            manifest = yaml.safe_load(file)
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get("artifacts")
+    if not isinstance(manifest, list) or not all(
+        isinstance(entry, dict) and "url" in entry for entry in manifest
+    ):
+        raise ValueError(
+            f"Manifest '{manifest_file}' must be a list of artifacts with at least a 'url'."
+        )
+    for entry in manifest:
+        for key in ("url", "path", "checksum_url"):
+            if key in entry:
+                entry[key] = os.path.expandvars(entry[key])
+        entry.setdefault(
+            "path", os.path.basename(urllib.parse.urlparse(entry["url"]).path)
+        )
+    return manifest
+
+
+def hash_file(filename: str, algorithms) -> Dict[str, str]:
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+class Progress:
+    # One combined progress line for all downloads.
+
+    def __init__(self, total_files: int, stream=sys.stderr, interval: float = 0.2):
+        self.total_files = total_files
+        self.done_files = 0
+        self.failed_files = 0
+        self.total_bytes = 0
+        self.received_bytes = 0
+        self.stream = stream
+        self.interval = interval
+        self.started = time.monotonic()
+        self._last_draw = 0.0
+        self._lock = threading.Lock()
+        self._tty = stream.isatty()
+
+    def expect(self, size: int) -> None:
+        with self._lock:
+            self.total_bytes += size
+
+    def advance(self, size: int) -> None:
+        with self._lock:
+            self.received_bytes += size
+            self._draw()
+
+    def finish(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.done_files += 1
+            else:
+                self.failed_files += 1
+            self._draw(force=True)
+
+    def close(self) -> None:
+        with self._lock:
+            self._draw(force=True)
+            if self._tty:
+                self.stream.write("\n")
+                self.stream.flush()
+
+    def _draw(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and (not self._tty or now - self._last_draw < self.interval):
+            return
+        self._last_draw = now
+        rate = self.received_bytes / max(now - self.started, 1e-6)
+        total = f"/{self.total_bytes / 2**20:.1f}" if self.total_bytes else ""
+        line = (
+            f"[{self.done_files}/{self.total_files} files"
+            + (f", {self.failed_files} failed" if self.failed_files else "")
+            + f"] {self.received_bytes / 2**20:.1f}{total} MiB"
+            + f" at {rate / 2**20:.1f} MiB/s"
+        )
+        self.stream.write(("\r\033[K" if self._tty else "") + line)
+        if not self._tty:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+class Downloader:
+    """Download artifacts concurrently with a cap per host.
+
+    Every artifact is fetched into "<path>.part", resumed with an HTTP Range
+    request when a partial file is left over, hashed while the data streams in,
+    checked against its expected digests and renamed into place once complete.
+    Verified files are recorded in a `VerifiedCache`, so later runs do not
+    hash them again.
+    """
+
+    def __init__(
+        self,
+        downloads_dir: str,
+        jobs: int = 8,
+        per_host: int = 4,
+        retries: int = 3,
+        timeout: float = 30,
+        progress: Optional[Progress] = None,
+        verified_cache: Optional["VerifiedCache"] = None,
+    ):
+        self.downloads_dir = downloads_dir
+        self.jobs = jobs
+        self.per_host = per_host
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.verified_cache = verified_cache
+        self._host_slots: Dict[str, threading.Semaphore] = {}
+        self._sized: set = set()  # parts whose size was added to the progress
+        self._published: Dict[str, str] = {}  # checksum_url: digest, this run
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.Semaphore:
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            return self._host_slots.setdefault(host, threading.Semaphore(self.per_host))
+
+    @staticmethod
+    def inline_digests(artifact: Dict[str, Any]) -> Dict[str, str]:
+        return {
+            algorithm: str(artifact[algorithm]).lower()
+            for algorithm in CHECKSUM_ALGORITHMS
+            if artifact.get(algorithm) is not None
+        }
+
+    def expected_digests(self, artifact: Dict[str, Any]) -> Dict[str, str]:
+        # The published checksum is fetched at most once per run, and only
+        # when a file has to be verified.
+        digests = self.inline_digests(artifact)
+        checksum_url = artifact.get("checksum_url")
+        if checksum_url:
+            algorithm = checksum_url.rsplit(".", 1)[-1].lower()
+            if algorithm not in CHECKSUM_ALGORITHMS:
+                raise ValueError(
+                    f"Cannot tell the algorithm of '{checksum_url}' from its extension."
+                )
+            if algorithm not in digests:
+                with self._lock:
+                    published = self._published.get(checksum_url)
+                if published is None:
+                    with urllib.request.urlopen(
+                        checksum_url, timeout=self.timeout
+                    ) as response:
+                        # "<hex digest>  <file name>" as published by CTAN
+                        published = response.read().decode().split()[0].lower()
+                    with self._lock:
+                        self._published[checksum_url] = published
+                digests[algorithm] = published
+        return digests
+
+    def is_verified(self, path: str, artifact: Dict[str, Any]) -> bool:
+        checksum_url = artifact.get("checksum_url")
+        if self.verified_cache is not None and self.verified_cache.verified(
+            path, self.inline_digests(artifact), checksum_url
+        ):
+            logger.debug(f"'{path}' was verified before, not hashing it again.")
+            return True
+        digests = self.expected_digests(artifact)
+        actual = hash_file(path, digests)
+        if actual != digests:
+            return False
+        if self.verified_cache is not None:
+            self.verified_cache.record(path, digests, checksum_url)
+        return True
+
+    def pending(self, artifacts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        pending = []
+        for artifact in artifacts:
+            path = os.path.join(self.downloads_dir, artifact["path"])
+            if not os.path.isfile(path):
+                pending.append(artifact)
+                continue
+            checksummed = self.inline_digests(artifact) or artifact.get("checksum_url")
+            if checksummed and not self.is_verified(path, artifact):
+                logger.warning(
+                    f"'{path}' does not match its checksums. Downloading again."
+                )
+                pending.append(artifact)
+        return pending
+
+    def download_all(self, artifacts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Returns the artifacts that could not be downloaded.
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            results = list(executor.map(self.download, artifacts))
+        return [artifact for artifact, ok in zip(artifacts, results) if not ok]
+
+    def download(self, artifact: Dict[str, Any]) -> bool:
+        url = artifact["url"]
+        path = os.path.join(self.downloads_dir, artifact["path"])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        ok = False
+        with self._host_slot(url):
+            for attempt in range(1, self.retries + 1):
+                try:
+                    expected = self.expected_digests(artifact)
+                    actual = self._fetch(url, path + ".part", list(expected))
+                    if actual != expected:
+                        os.remove(path + ".part")
+                        raise ValueError(
+                            "checksum mismatch ("
+                            + ", ".join(
+                                f"{algorithm} expected {expected[algorithm]}, got {actual[algorithm]}"
+                                for algorithm in expected
+                            )
+                            + ")"
+                        )
+                    os.replace(path + ".part", path)
+                    if expected and self.verified_cache is not None:
+                        self.verified_cache.record(
+                            path, expected, artifact.get("checksum_url")
+                        )
+                    ok = True
+                    break
+                except (OSError, ValueError, urllib.error.URLError) as e:
+                    logger.warning(
+                        f"Attempt {attempt}/{self.retries} to download '{url}' failed. {str(e)}"
+                    )
+                    if (
+                        isinstance(e, urllib.error.HTTPError)
+                        and 400 <= e.code < 500
+                        and e.code not in (408, 429)
+                    ):
+                        # Client errors will not go away by retrying.
+                        break
+        if not ok:
+            logger.error(f"Unable to download '{url}'.")
+        if self.progress is not None:
+            self.progress.finish(ok)
+        return ok
+
+    def _fetch(self, url: str, part: str, algorithms: List[str]) -> Dict[str, str]:
+        # Download into `part` and return its digests, computed as the data
+        # arrives. Only a left-over partial file is read back from disk.
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset:
+                # Nothing left to fetch. The checksum, if any, catches a stale part.
+                return hash_file(part, algorithms)
+            raise
+        with response:
+            if offset and response.status != 206:
+                # The server ignored the Range header, start over.
+                offset = 0
+            hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+            if offset:
+                with open(part, "rb") as file:
+                    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                        for hasher in hashers.values():
+                            hasher.update(chunk)
+            length = response.headers.get("Content-Length")
+            if (
+                self.progress is not None
+                and length is not None
+                and part not in self._sized
+            ):
+                self._sized.add(part)
+                self.progress.expect(offset + int(length))
+                self.progress.advance(offset)
+            with open(part, "ab" if offset else "wb") as file:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    file.write(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    if self.progress is not None:
+                        self.progress.advance(len(chunk))
+            if length is not None and os.path.getsize(part) < offset + int(length):
+                raise OSError("connection closed before the download completed")
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+class VerifiedCache:
+    """Digests of files that already passed verification.
+
+    Entries are keyed by path and only trusted while the file's size, mtime
+    and inode are unchanged, so a verified multi-GB ISO is never re-read.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        try:
+            with open(cache_file, "r") as file:
+                self._entries = json.load(file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _identity(path: str) -> List[int]:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def verified(
+        self, path: str, digests: Dict[str, str], checksum_url: Optional[str] = None
+    ) -> bool:
+        # Without inline digests, the file is trusted if it was verified
+        # against the same published checksum.
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(path))
+        if entry is None or entry["identity"] != self._identity(path):
+            return False
+        if not digests:
+            return (
+                checksum_url is not None and entry.get("checksum_url") == checksum_url
+            )
+        return any(
+            entry["digests"].get(algorithm) == digest
+            for algorithm, digest in digests.items()
+        )
+
+    def record(
+        self, path: str, digests: Dict[str, str], checksum_url: Optional[str] = None
+    ) -> None:
+        with self._lock:
+            self._entries[os.path.abspath(path)] = {
+                "identity": self._identity(path),
+                "digests": digests,
+                "checksum_url": checksum_url,
+            }
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as file:
+                    json.dump(self._entries, file, indent=2)
+                os.replace(tmp_path, self.cache_file)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Download the artifacts listed in a manifest concurrently, resuming partial downloads.",
+    )
+
+    parser.add_argument(
+        "manifest",
+        type=str,
+        help="YAML or TOML manifest of artifacts (url, path, optional sha512/sha256/md5 or checksum_url)",
+    )
+
+    parser.add_argument(
+        "--downloads-dir",
+        type=str,
+        default="./downloads",
+        help="Directory the artifact paths are relative to (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of concurrent downloads (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=4,
+        help="Maximum concurrent downloads from one host (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Attempts per artifact; each retry resumes where the last one stopped (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="Socket timeout in seconds (default: %(default)s)",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    artifacts = load_manifest(args.manifest)
+
+    os.makedirs(args.downloads_dir, exist_ok=True)
+    downloader = Downloader(
+        args.downloads_dir,
+        jobs=args.jobs,
+        per_host=args.per_host,
+        retries=args.retries,
+        timeout=args.timeout,
+        verified_cache=VerifiedCache(
+            os.path.join(args.downloads_dir, VERIFIED_CACHE_FILE)
+        ),
+    )
+    pending = downloader.pending(artifacts)
+    if not pending:
+        logger.info("No download tasks.")
+        return
+    logger.info(f"{len(pending)} of {len(artifacts)} files to download.")
+
+    downloader.progress = Progress(len(pending))
+    failed = downloader.download_all(pending)
+    downloader.progress.close()
+    if failed:
+        logger.error(f"{len(failed)} downloads failed.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
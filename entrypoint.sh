@@ -1,39 +1,89 @@
 #!/usr/bin/env bash
-set -euo pipefail
+set -uo pipefail
 
-# Using bridge network mode:
-# Extract the display number from DISPLAY (e.g., ":10" from "hostname:10")
-# Set the new DISPLAY variable using host.docker.internal
-export DISPLAY="host.docker.internal:$(echo $DISPLAY | cut -d: -f2)"
+has() {
+	command -v "$1" 1>/dev/null 2>&1
+}
+export -f has
 
-# A workaround for root to use user-level zsh
-if [[ ! -f "/bin/zsh" && -f "${XDG_PREFIX_HOME}/bin/zsh" ]]; then
-	sudo ln -s "${XDG_PREFIX_HOME}/bin/zsh" /bin/zsh
-fi
+# Stamps live in the container file system, so recreating the container runs
+# every step again while a restart skips the ones that are up to date.
+STAMP_DIR="${XDG_STATE_HOME:-$HOME/.local/state}/latex-docker/init"
+mkdir -p "$STAMP_DIR"
+
+now_ms() {
+	echo $(($(date +%s%N) / 1000000))
+}
+
+# run_step NAME ALWAYS TTL INTERACTIVE KEY_COMMAND COMMAND
+run_step() {
+	local name="$1" always="$2" ttl="$3" interactive="$4" key_command="$5" command="$6"
+	local stamp="$STAMP_DIR/$name" start key shell=(bash -c)
+	start=$(now_ms)
+	key=$({
+		printf '%s\n' "$command"
+		[[ -n "$key_command" ]] && bash -c "$key_command" 2>/dev/null
+	} | sha256sum | cut -d' ' -f1)
+	if [[ "$always" == 0 && -f "$stamp" && "$(cat "$stamp")" == "$key" ]] &&
+		[[ -z "$ttl" || $(($(date +%s) - $(stat -c %Y "$stamp"))) -lt "$ttl" ]]; then
+		echo "init: $name is up to date" >&2
+		return 0
+	fi
+	[[ "$interactive" == 1 ]] && shell=(zsh -i -c)
+	if "${shell[@]}" "$command"; then
+		echo "$key" >"$stamp"
+		echo "init: $name done in $(($(now_ms) - start)) ms" >&2
+	else
+		rm -f "$stamp"
+		echo "init: $name failed after $(($(now_ms) - start)) ms" >&2
+		return 1
+	fi
+}
+
+# Waits for the steps started since the last wave; a failed required step
+# fails the start once every step has had its chance to run.
+failed=0
+run_wave() {
+	local pid status
+	for pid in "${!wave[@]}"; do
+		wait "$pid"
+		status=$?
+		if [[ $status -ne 0 && "${wave[$pid]}" == 1 ]]; then
+			failed=1
+		fi
+	done
+	wave=()
+}
 
-# SSH
-sudo service ssh start
+declare -A wave=()
+init_start=$(now_ms)
+export DISPLAY="host.docker.internal:$(echo ${DISPLAY:-} | cut -d: -f2)"
 
-# Git
-git config --global user.name "Shuqi XIAO"
-git config --global user.email "xiaosq2000@gmail.com"
-git lfs install
+run_step zsh-link 1 '' 0 '' 'if [[ ! -f "/bin/zsh" && -f "${XDG_PREFIX_HOME}/bin/zsh" ]]; then sudo ln -s "${XDG_PREFIX_HOME}/bin/zsh" /bin/zsh; fi' &
+wave[$!]=0
+run_step ssh 1 '' 0 '' 'sudo service ssh start' &
+wave[$!]=0
+run_step git-identity 0 '' 0 '' 'git config --global user.name "Shuqi XIAO" && git config --global user.email "xiaosq2000@gmail.com"' &
+wave[$!]=0
+run_step dotfiles 0 3600 0 '' 'cd ~ && git remote set-url origin "git@github.com:xiaosq2000/dotfiles.git" && git submodule update --init && git pull --recurse-submodules' &
+wave[$!]=0
+run_step font-caches 1 '' 0 '' 'manifest="$(sha256sum "${XDG_DATA_HOME}/fonts/fonts.json" 2>/dev/null | cut -d" " -f1)"; stamp="$(kpsewhich -var-value TEXMFVAR)/.font-manifest"; if [[ "$(cat "${stamp}" 2>/dev/null)" != "${manifest}" ]]; then luaotfload-tool --update && echo "${manifest}" > "${stamp}"; fi' &
+wave[$!]=0
+run_wave
 
-# The latest version of my dotfiles and submodules.
-cd ~
-git remote set-url origin "git@github.com:xiaosq2000/dotfiles.git"
-git submodule update --init
-git pull --recurse-submodules
+run_step git-lfs 0 '' 0 '' 'git lfs install' &
+wave[$!]=0
+run_step nvim-plugins 0 '' 0 'cat ~/.config/nvim/lazy-lock.json' 'nvim --headless "+Lazy! sync" +qa' &
+wave[$!]=0
+run_wave
 
-# Neovim 
-nvim --headless "+Lazy! sync" +qa
+echo "init: ready in $(($(now_ms) - init_start)) ms" >&2
+[[ $failed -eq 0 ]] || exit 1
 
-# Notify me if the container is ready.
-if [[ -z "$DBUS_SESSION_BUS_ADDRESS" ]]; then
+if [[ -z "${DBUS_SESSION_BUS_ADDRESS:-}" ]]; then
 	if has "notify-send"; then
 		notify-send "$(whoami) ready."
 	fi
-	completed "$(whoami) ready."
 fi
 
 exec "$@"
@@ -0,0 +1,406 @@
+import os
+import sys
+import json
+import shutil
+import struct
+import hashlib
+import tarfile
+import zipfile
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+FONT_EXTENSIONS = (".otf", ".ttf", ".ttc")
+ARCHIVE_EXTENSIONS = (".zip", ".tar.gz", ".tgz", ".tar.xz", ".tar.bz2")
+MANIFEST_FILE = ".extracted.json"
+# Shipped with the fonts, unlike the extraction manifest.
+FONT_MANIFEST_FILE = "fonts.json"
+
+
+def find_archives(typefaces_dir: str) -> List[str]:
+    archives = []
+    for root, _, files in os.walk(typefaces_dir):
+        for name in files:
+            if name.endswith(ARCHIVE_EXTENSIONS):
+                archives.append(os.path.join(root, name))
+    return sorted(archives)
+
+
+def archive_identity(archive: str) -> List[int]:
+    stat = os.stat(archive)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _safe_destination(directory: str, member: str) -> Optional[str]:
+    # Refuse absolute paths and ".." components that would escape `directory`.
+    destination = os.path.normpath(os.path.join(directory, member))
+    if os.path.commonpath(
+        [os.path.abspath(directory), os.path.abspath(destination)]
+    ) != (os.path.abspath(directory)):
+        logger.warning(f"Skipping '{member}', which points outside of '{directory}'.")
+        return None
+    return destination
+
+
+def is_font_file(name: str, extensions=FONT_EXTENSIONS) -> bool:
+    # macOS archives carry AppleDouble metadata, e.g. "__MACOSX/._Font.otf",
+    # whose names end like the fonts they describe.
+    parts = name.replace("\\", "/").split("/")
+    return (
+        name.lower().endswith(extensions)
+        and not parts[-1].startswith("._")
+        and "__MACOSX" not in parts
+    )
+
+
+def extract_archive(archive: str, extensions=FONT_EXTENSIONS) -> List[str]:
+    # Extract only the members ending with `extensions` next to the archive,
+    # keeping their paths, and return the extracted paths relative to it.
+    directory = os.path.dirname(archive)
+    extracted = []
+
+    def write(member_name, source):
+        destination = _safe_destination(directory, member_name)
+        if destination is None:
+            return
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            shutil.copyfileobj(source, file, 1 << 20)
+        os.replace(tmp_path, destination)
+        extracted.append(os.path.relpath(destination, directory))
+
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir() and is_font_file(info.filename, extensions):
+                    with zip_file.open(info) as source:
+                        write(info.filename, source)
+    else:
+        with tarfile.open(archive) as tar_file:
+            for member in tar_file:
+                if member.isfile() and is_font_file(member.name, extensions):
+                    write(member.name, tar_file.extractfile(member))
+    return sorted(extracted)
+
+
+class ExtractionManifest:
+    """Which font files each archive produced, and from which archive version.
+
+    An archive whose size and mtime are unchanged, and whose files are all
+    still there, is not extracted again. Archives may be deleted after
+    extraction; their entries are kept so that nothing is redone.
+    """
+
+    def __init__(self, typefaces_dir: str):
+        self.typefaces_dir = typefaces_dir
+        self.filename = os.path.join(typefaces_dir, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename, "r") as file:
+                self.entries: Dict[str, Any] = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _key(self, archive: str) -> str:
+        return os.path.relpath(archive, self.typefaces_dir)
+
+    def up_to_date(self, archive: str, extensions) -> bool:
+        entry = self.entries.get(self._key(archive))
+        if (
+            entry is None
+            or entry["identity"] != archive_identity(archive)
+            or entry["extensions"] != list(extensions)
+        ):
+            return False
+        directory = os.path.dirname(archive)
+        # A collapsed duplicate is only as good as the copy that was kept.
+        duplicates = entry.get("duplicates", {})
+        return all(
+            os.path.isfile(os.path.join(directory, path))
+            or (
+                path in duplicates
+                and os.path.isfile(os.path.join(self.typefaces_dir, duplicates[path]))
+            )
+            for path in entry["files"]
+        )
+
+    def record(self, archive: str, extensions, files: List[str]) -> None:
+        with self._lock:
+            previous = self.entries.get(self._key(archive), {}).get("files", [])
+            # Fonts a previous version of the archive produced but this one does not.
+            directory = os.path.dirname(archive)
+            for path in set(previous) - set(files):
+                try:
+                    os.remove(os.path.join(directory, path))
+                except FileNotFoundError:
+                    pass
+            self.entries[self._key(archive)] = {
+                "identity": archive_identity(archive),
+                "extensions": list(extensions),
+                "files": files,
+            }
+
+    def extracted_files(self) -> Dict[str, str]:
+        # Path of every extracted font, relative to `typefaces_dir`, to its archive.
+        extracted = {}
+        for key, entry in self.entries.items():
+            directory = os.path.dirname(key)
+            for path in entry["files"]:
+                extracted[os.path.normpath(os.path.join(directory, path))] = key
+        return extracted
+
+    def mark_duplicate(self, key: str, path: str, kept: str) -> None:
+        duplicates = self.entries[key].setdefault("duplicates", {})
+        duplicates[os.path.relpath(path, os.path.dirname(key))] = kept
+
+    def save(self) -> None:
+        _write_json(self.filename, self.entries)
+
+
+def _write_json(filename: str, data: Any) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, filename)
+
+
+def extract_typefaces(
+    typefaces_dir: str,
+    manifest: ExtractionManifest,
+    jobs: Optional[int] = None,
+    extensions=FONT_EXTENSIONS,
+) -> List[str]:
+    # Returns the archives that could not be extracted.
+    archives = [
+        archive
+        for archive in find_archives(typefaces_dir)
+        if not manifest.up_to_date(archive, extensions)
+    ]
+    if not archives:
+        logger.info("All typeface archives are already extracted.")
+        return []
+    logger.info(f"Extracting {len(archives)} typeface archives.")
+
+    def work(archive):
+        try:
+            files = extract_archive(archive, extensions)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            logger.error(f"Unable to extract '{archive}'. {str(e)}")
+            return False
+        manifest.record(archive, extensions, files)
+        logger.info(f"Extracted {len(files)} fonts from '{archive}'.")
+        return True
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        results = list(executor.map(work, archives))
+    return [archive for archive, ok in zip(archives, results) if not ok]
+
+
+def read_family_name(filename: str) -> Optional[str]:
+    # The typographic (16) or legacy (1) family name from the OpenType `name`
+    # table; for a collection, that of its first font.
+    try:
+        with open(filename, "rb") as file:
+            header = file.read(12)
+            if header[:4] == b"ttcf":
+                file.seek(12)
+                (offset,) = struct.unpack(">I", file.read(4))
+                file.seek(offset)
+                header = file.read(12)
+            (num_tables,) = struct.unpack(">H", header[4:6])
+            records = file.read(16 * num_tables)
+            for i in range(num_tables):
+                tag, _, offset, length = struct.unpack(
+                    ">4sIII", records[16 * i : 16 * (i + 1)]
+                )
+                if tag == b"name":
+                    file.seek(offset)
+                    table = file.read(length)
+                    break
+            else:
+                return None
+        _, count, strings = struct.unpack(">HHH", table[:6])
+        windows, mac = {}, {}
+        for i in range(count):
+            platform, _, _, name_id, length, offset = struct.unpack(
+                ">HHHHHH", table[6 + 12 * i : 18 + 12 * i]
+            )
+            if name_id not in (1, 16):
+                continue
+            raw = table[strings + offset : strings + offset + length]
+            if platform in (0, 3):
+                windows.setdefault(name_id, raw.decode("utf-16-be", "replace"))
+            elif platform == 1:
+                mac.setdefault(name_id, raw.decode("mac_roman", "replace"))
+        names = {**mac, **windows}
+        return names.get(16) or names.get(1)
+    except (OSError, struct.error):
+        return None
+
+
+def find_fonts(typefaces_dir: str, extensions=FONT_EXTENSIONS) -> List[str]:
+    fonts = []
+    for root, _, files in os.walk(typefaces_dir):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), typefaces_dir)
+            if is_font_file(path, extensions):
+                fonts.append(path)
+    return sorted(fonts)
+
+
+def describe_fonts(
+    typefaces_dir: str, jobs: Optional[int] = None, extensions=FONT_EXTENSIONS
+) -> List[Dict[str, Any]]:
+    # Hash every font, reusing the digests of the previous font manifest for
+    # files whose size and mtime have not changed.
+    try:
+        with open(os.path.join(typefaces_dir, FONT_MANIFEST_FILE), "r") as file:
+            previous = {font["path"]: font for font in json.load(file)["fonts"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        previous = {}
+
+    def describe(path):
+        filename = os.path.join(typefaces_dir, path)
+        stat = os.stat(filename)
+        font = previous.get(path)
+        if font and [font["size"], font["mtime_ns"]] == [
+            stat.st_size,
+            stat.st_mtime_ns,
+        ]:
+            return font
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                sha256.update(chunk)
+        return {
+            "path": path,
+            "sha256": sha256.hexdigest(),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "family": read_family_name(filename),
+        }
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        return list(executor.map(describe, find_fonts(typefaces_dir, extensions)))
+
+
+def deduplicate_typefaces(
+    typefaces_dir: str,
+    manifest: ExtractionManifest,
+    jobs: Optional[int] = None,
+    extensions=FONT_EXTENSIONS,
+) -> List[Dict[str, Any]]:
+    """Remove extracted fonts whose content another font already has.
+
+    Downloaded fonts are never removed, since they would be fetched again;
+    among identical files, one of them is kept in preference to extracted ones.
+    Families shipped by more than one typeface directory are reported. The
+    remaining fonts are described in the font manifest, which is returned.
+    """
+    fonts = describe_fonts(typefaces_dir, jobs, extensions)
+    extracted = manifest.extracted_files()
+
+    by_digest: Dict[str, List[Dict[str, Any]]] = {}
+    for font in fonts:
+        by_digest.setdefault(font["sha256"], []).append(font)
+    removed = set()
+    saved = 0
+    for copies in by_digest.values():
+        if len(copies) == 1:
+            continue
+        kept = min(copies, key=lambda font: (font["path"] in extracted, font["path"]))
+        for font in copies:
+            if font is kept or font["path"] not in extracted:
+                continue
+            os.remove(os.path.join(typefaces_dir, font["path"]))
+            manifest.mark_duplicate(extracted[font["path"]], font["path"], kept["path"])
+            removed.add(font["path"])
+            saved += font["size"]
+            logger.debug(f"'{font['path']}' is identical to '{kept['path']}'.")
+    if removed:
+        logger.info(
+            f"Removed {len(removed)} duplicate fonts ({saved / 2**20:.1f} MiB)."
+        )
+    fonts = [font for font in fonts if font["path"] not in removed]
+
+    directories: Dict[str, set] = {}
+    names: Dict[str, str] = {}
+    for font in fonts:
+        if font["family"]:
+            key = "".join(font["family"].split()).casefold()
+            names.setdefault(key, font["family"])
+            directories.setdefault(key, set()).add(font["path"].split(os.sep)[0])
+    for key, found_in in sorted(directories.items()):
+        if len(found_in) > 1:
+            logger.warning(
+                f"Family '{names[key]}' is shipped by {', '.join(sorted(found_in))}."
+            )
+
+    _write_json(
+        os.path.join(typefaces_dir, FONT_MANIFEST_FILE),
+        {"fonts": fonts},
+    )
+    return fonts
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Extract the font files of every typeface archive in parallel, skipping archives that have not changed.",
+    )
+
+    parser.add_argument(
+        "typefaces_dir",
+        type=str,
+        help="Directory searched recursively for .zip and .tar.* archives",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Number of archives extracted concurrently (default: the CPU count)",
+    )
+
+    parser.add_argument(
+        "--extensions",
+        type=str,
+        nargs="+",
+        default=list(FONT_EXTENSIONS),
+        help="File extensions to extract (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--keep-duplicates",
+        action="store_true",
+        help="Keep extracted fonts identical to another font instead of removing them",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    extensions = tuple(extension.lower() for extension in args.extensions)
+    manifest = ExtractionManifest(args.typefaces_dir)
+    failed = extract_typefaces(
+        args.typefaces_dir, manifest, jobs=args.jobs, extensions=extensions
+    )
+    if not args.keep_duplicates:
+        deduplicate_typefaces(
+            args.typefaces_dir, manifest, jobs=args.jobs, extensions=extensions
+        )
+    manifest.save()
+    if failed:
+        logger.error(f"{len(failed)} archives failed to extract.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,206 @@
 import re
 import os
-import yaml
+import sys
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
 import argparse
-from typing import Dict, Any
-import psutil
+import copy
+import functools
+import contextlib
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
 import logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# psutil, yaml and concurrent.futures are imported where they are used, so that
+# `--help` and other short paths do not pay for them.
+
+# Logging is configured in main from --log-level.
 logger = logging.getLogger(__name__)
 
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+SUBPROCESS_AUDIT_EVENTS = {"subprocess.Popen", "os.system", "os.posix_spawn", "os.exec"}
+
+
+class Span(NamedTuple):
+    name: str
+    start: float  # perf_counter seconds
+    end: float
+    thread: int
+    args: Dict[str, Any]
+    counters: Dict[str, float]
+
+
+class Tracer:
+    """Spans of the phases of a run, with what the process did during each.
+
+    Disabled unless --trace is given, when a span costs one attribute check.
+    File opens and subprocess calls are counted through an audit hook, and
+    reads, writes and their bytes come from /proc/self/io where it exists.
+    The counters are process-wide, so the spans of services generated
+    concurrently also include each other's I/O.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self.counters: Dict[str, float] = {
+            "opens": 0,
+            "subprocesses": 0,
+            "yaml_load_ms": 0.0,
+            "yaml_dump_ms": 0.0,
+        }
+        self.lock = threading.Lock()
+        self.io_fd: Optional[int] = None
+        self.origin = time.perf_counter()
+
+    def enable(self) -> None:
+        try:
+            # Kept open, so that reading the counters opens no file itself.
+            self.io_fd = os.open("/proc/self/io", os.O_RDONLY)
+        except OSError:
+            pass
+        self.origin = time.perf_counter()
+        self.enabled = True
+        sys.addaudithook(self._audit)
+
+    def _audit(self, event: str, args: Tuple) -> None:
+        if not self.enabled:
+            return
+        if event == "open":
+            self.counters["opens"] += 1
+        elif event in SUBPROCESS_AUDIT_EVENTS:
+            self.counters["subprocesses"] += 1
+
+    def snapshot(self) -> Tuple[Dict[str, float], int]:
+        # (counters, bytes read to take them)
+        values = dict(self.counters)
+        if self.io_fd is None:
+            return values, 0
+        content = os.pread(self.io_fd, 4096, 0)
+        io = dict(line.split(b": ") for line in content.splitlines())
+        values["reads"] = int(io[b"syscr"])
+        values["writes"] = int(io[b"syscw"])
+        values["bytes_read"] = int(io[b"rchar"])
+        values["bytes_written"] = int(io[b"wchar"])
+        return values, len(content)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        if not self.enabled:
+            yield
+            return
+        before, overhead = self.snapshot()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            after, _ = self.snapshot()
+            counters = {key: round(after[key] - before[key], 3) for key in before}
+            # The counters read at the start are only accounted for at the end.
+            if "reads" in counters:
+                counters["reads"] -= 1
+                counters["bytes_read"] -= overhead
+            with self.lock:
+                self.spans.append(
+                    Span(name, start, end, threading.get_ident(), args, counters)
+                )
+
+    @contextlib.contextmanager
+    def timer(self, counter: str):
+        # Add the time spent in the block to a counter, in milliseconds.
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1e3
+            with self.lock:
+                self.counters[counter] += elapsed
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        # Complete ("X") events of the Chrome trace event format, for
+        # chrome://tracing or https://ui.perfetto.dev.
+        pid = os.getpid()
+        threads = {}
+        for span in self.spans:
+            threads.setdefault(span.thread, len(threads))
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": "main" if tid == 0 else f"worker {tid}"},
+            }
+            for tid in threads.values()
+        ]
+        for span in sorted(self.spans, key=lambda span: span.start):
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": round((span.start - self.origin) * 1e6, 1),
+                    "dur": round((span.end - span.start) * 1e6, 1),
+                    "pid": pid,
+                    "tid": threads[span.thread],
+                    "args": {**span.args, **span.counters},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self) -> List[Dict[str, Any]]:
+        # One flat row per phase name, summed over its spans, slowest first.
+        rows: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            row = rows.setdefault(
+                span.name, {"name": span.name, "calls": 0, "wall_ms": 0.0}
+            )
+            row["calls"] += 1
+            row["wall_ms"] += (span.end - span.start) * 1e3
+            for key, value in span.counters.items():
+                row[key] = row.get(key, 0) + value
+        for row in rows.values():
+            for key in ("wall_ms", "yaml_load_ms", "yaml_dump_ms"):
+                row[key] = round(row[key], 3)
+        return sorted(rows.values(), key=lambda row: -row["wall_ms"])
+
+    def write(self, filename: str) -> str:
+        # The Chrome trace goes to `filename`, the summary next to it.
+        summary_file = os.path.splitext(filename)[0] + ".summary.json"
+        atomic_write(filename, json.dumps(self.chrome_trace()) + "\n")
+        atomic_write(summary_file, json.dumps(self.summary(), indent=2) + "\n")
+        return summary_file
+
+
+TRACER = Tracer()
+
+
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with TRACER.span(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_classes() -> Tuple[type, type]:
+    # Prefer the libyaml bindings when PyYAML was built with them. The pure-Python
+    # classes load and dump the same documents byte for byte, only slower.
+    try:
+        from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+    return YamlLoader, YamlDumper
+
 
 def nested_set(dic: Dict[str, Any], keys: list, value: Any) -> None:
     for key in keys[:-1]:
@@ -19,79 +208,737 @@ def nested_set(dic: Dict[str, Any], keys: list, value: Any) -> None:
     dic[keys[-1]] = value
 
 
-def manage_content_in_file(
-    filename: str, content_to_manage: str | list, should_exist: bool
-):
-    file_lines = []
-    content_found = False
-    file_modified = False
+def load_yaml(filename: str, loader: Optional[type] = None) -> Any:
+    import yaml
 
-    # Ensure content_to_manage is a list of strings
-    if isinstance(content_to_manage, str):
-        content_to_manage = [content_to_manage]
+    with open(filename, "r") as file, TRACER.timer("yaml_load_ms"):
+        return yaml.load(file, Loader=loader or yaml_classes()[0])
 
-    try:
-        # Read the file contents
-        with open(filename, "r") as file:
-            file_lines = file.readlines()
 
-        # Strip newlines from content lines while preserving internal whitespace
-        content_to_manage = [line.rstrip("\n") for line in content_to_manage]
+def dump_yaml(data: Any, dumper: Optional[type] = None) -> str:
+    import yaml
+
+    with TRACER.timer("yaml_dump_ms"):
+        return yaml.dump(
+            data, Dumper=dumper or yaml_classes()[1], default_flow_style=False
+        )
 
-        if len(content_to_manage) == 1:
-            # Single line management
-            for i, line in enumerate(file_lines):
-                if line.rstrip("\n") == content_to_manage[0]:
-                    content_found = True
-                    if not should_exist:
-                        del file_lines[i]
-                        file_modified = True
-                    break
 
-            if should_exist and not content_found:
-                file_lines.append(content_to_manage[0] + "\n")
-                file_modified = True
+def write_yaml(filename: str, data: Any) -> bool:
+    return write_if_changed(filename, dump_yaml(data))
+
+
+def nested_update(dic: Dict[str, Any], other: Dict[str, Any]) -> None:
+    for key, value in other.items():
+        if isinstance(value, dict) and isinstance(dic.get(key), dict):
+            nested_update(dic[key], value)
         else:
-            # Block management
-            for i in range(len(file_lines) - len(content_to_manage) + 1):
-                if [
-                    line.rstrip("\n")
-                    for line in file_lines[i : i + len(content_to_manage)]
-                ] == content_to_manage:
-                    content_found = True
-                    if not should_exist:
-                        del file_lines[i : i + len(content_to_manage)]
-                        file_modified = True
-                    break
+            dic[key] = value
+
+
+ENV_FILE_BEGIN_MARKER = "# >>> auto-generated contents"
+ENV_FILE_END_MARKER = "# <<< auto-generated contents"
+
+# Rules of the managed block in the build context's .dockerignore. TeX Live is
+# bind-mounted from its own `texlive` build context while it installs, so
+# neither the ISO nor its tree has to be uploaded with the main one.
+TEXLIVE_BUILD_CONTEXT = "./downloads/texlive"
+DOCKERIGNORE_RULES = [
+    "downloads/*.iso",
+    "downloads/texlive",
+    "downloads/.verified.json",
+    "downloads/**/*.part",
+    "downloads/typefaces/.extracted.json",
+    "downloads/typefaces/**/*.zip",
+    "downloads/typefaces/**/*.tar.gz",
+    # Tools installed into the image.
+    "!preamble_cache.py",
+    "!build_documents.py",
+]
+# Used when there is no .dockerignore yet: only the downloads are needed.
+DOCKERIGNORE_DEFAULT_RULES = ["*", "!downloads"]
+
+MANAGED_BLOCK_PATTERN = re.compile(r"^# (>>>|<<<) as services\.(.+)\.build\.args$")
+
+
+class EnvDocument:
+    """In-memory model of an environment variables file.
+
+    The file is parsed once, generators mutate the model, and `save` writes it
+    back with a single atomic replace.
+    """
+
+    def __init__(self, filename: str, lines: Optional[List[str]] = None):
+        self.filename = filename
+        self.lines = [] if lines is None else [line.rstrip("\n") for line in lines]
+        # Built lazily, kept up to date on appends and dropped on deletions.
+        self._line_index: Optional[Dict[str, List[int]]] = None
+        # Every `manage` call, so the edits can be replayed on another document.
+        self.journal: List[Tuple[List[str], bool]] = []
+
+    @classmethod
+    def load(cls, filename: str) -> "EnvDocument":
+        with open(filename, "r") as file:
+            return cls(filename, file.readlines())
+
+    def _index_line(self, i: int) -> None:
+        self._line_index.setdefault(self.lines[i], []).append(i)
+
+    def _ensure_index(self) -> None:
+        if self._line_index is not None:
+            return
+        self._line_index = {}
+        for i in range(len(self.lines)):
+            self._index_line(i)
+
+    def find_all_lines(self, line: str) -> List[int]:
+        self._ensure_index()
+        return list(self._line_index.get(line, []))
+
+    def find_all_blocks(self, block: List[str]) -> List[int]:
+        # Knuth-Morris-Pratt over whole lines: O(len(lines) + len(block)) and no
+        # slices of the document are copied. Overlapping occurrences are reported.
+        if not block:
+            return []
+        failure = [0] * len(block)
+        k = 0
+        for i in range(1, len(block)):
+            while k > 0 and block[i] != block[k]:
+                k = failure[k - 1]
+            if block[i] == block[k]:
+                k += 1
+            failure[i] = k
+
+        occurrences = []
+        k = 0
+        for i, line in enumerate(self.lines):
+            while k > 0 and line != block[k]:
+                k = failure[k - 1]
+            if line == block[k]:
+                k += 1
+            if k == len(block):
+                occurrences.append(i - k + 1)
+                k = failure[k - 1]
+        return occurrences
+
+    def find_all(self, content: List[str]) -> List[int]:
+        if len(content) == 1:
+            return self.find_all_lines(content[0])
+        return self.find_all_blocks(content)
+
+    def extend(self, lines: List[str]) -> None:
+        self._ensure_index()
+        for line in lines:
+            self.lines.append(line.rstrip("\n"))
+            self._index_line(len(self.lines) - 1)
+
+    def delete(self, starts: List[int], length: int = 1) -> None:
+        # Remove the non-overlapping ranges [start, start + length) in one pass.
+        keep = []
+        cursor = 0
+        for start in sorted(starts):
+            if start < cursor:
+                continue
+            keep.extend(self.lines[cursor:start])
+            cursor = start + length
+        keep.extend(self.lines[cursor:])
+        self.lines = keep
+        self._line_index = None
+
+    def manage(self, content_to_manage: str | list, should_exist: bool) -> bool:
+        # Ensure content_to_manage is a list of strings
+        if isinstance(content_to_manage, str):
+            content_to_manage = [content_to_manage]
+        # Strip newlines from content lines while preserving internal whitespace
+        content_to_manage = [line.rstrip("\n") for line in content_to_manage]
+        content_type = "line" if len(content_to_manage) == 1 else "block of lines"
+        self.journal.append((content_to_manage, should_exist))
+
+        occurrences = self.find_all(content_to_manage)
+        if len(occurrences) > 1:
+            logger.warning(
+                "The specified %s occurs %s times in '%s' (lines %s).",
+                content_type,
+                len(occurrences),
+                self.filename,
+                ", ".join(str(i + 1) for i in occurrences),
+            )
 
-            if should_exist and not content_found:
-                file_lines.extend([line + "\n" for line in content_to_manage])
-                file_modified = True
+        file_modified = False
+        if occurrences and not should_exist:
+            self.delete(occurrences, len(content_to_manage))
+            file_modified = True
+        elif not occurrences and should_exist:
+            self.extend(content_to_manage)
+            file_modified = True
 
-        # Write the modified content back to the file if changes were made
         if file_modified:
-            with open(filename, "w") as file:
-                file.writelines(file_lines)
-
             action = "added to" if should_exist else "removed from"
-            content_type = "line" if len(content_to_manage) == 1 else "block of lines"
-            logger.debug(f"The specified {content_type} was {action} the file.")
+            logger.debug("The specified %s was %s the file.", content_type, action)
         else:
             state = "already exists in" if should_exist else "is not in"
-            content_type = "line" if len(content_to_manage) == 1 else "block of lines"
             logger.debug(
-                f"No changes made. The specified {content_type} {state} the file."
+                "No changes made. The specified %s %s the file.", content_type, state
             )
+        return file_modified
+
+    def render(self) -> str:
+        return "".join(line + "\n" for line in self.lines)
+
+    def save(self) -> bool:
+        return write_if_changed(self.filename, self.render())
 
+
+def read_text(filename: str) -> Optional[str]:
+    try:
+        with open(filename, "r") as file:
+            return file.read()
     except FileNotFoundError:
-        logger.error(f"File '{filename}' not found.")
+        return None
+
+
+def write_if_changed(filename: str, content: str) -> bool:
+    # Leave the file (and its mtime) alone when the content is already there.
+    if read_text(filename) == content:
+        logger.debug("'%s' is up to date.", filename)
+        return False
+    atomic_write(filename, content)
+    logger.debug("Wrote '%s'.", filename)
+    return True
+
+
+def atomic_write(filename: str, content: str) -> None:
+    # Write to a temporary file in the same directory and rename it over the
+    # target, so an interrupted run never leaves a half-written file behind.
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(filename)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_current_umask())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _current_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def unmanaged_lines(filename: str) -> List[str]:
+    # Lines outside of the auto-generated block, which are kept as they are.
+    other_contents = []
+    is_managed_content = False
+    for line in EnvDocument.load(filename).lines:
+        if line == ENV_FILE_BEGIN_MARKER:
+            is_managed_content = True
+            continue
+        elif line == ENV_FILE_END_MARKER:
+            is_managed_content = False
+            continue
+        elif not is_managed_content:
+            other_contents.append(line)
+    return other_contents
+
+
+def dockerignore_file(compose_file: str) -> str:
+    # The services are built with the compose file's directory as context.
+    return os.path.join(os.path.dirname(compose_file), ".dockerignore")
+
+
+@traced
+def generate_dockerignore(filename: str, from_scratch: bool) -> str:
+    other_contents = (
+        DOCKERIGNORE_DEFAULT_RULES
+        if from_scratch or not os.path.exists(filename)
+        else unmanaged_lines(filename)
+    )
+    # Last, so that the exclusions win over the rules re-including `downloads`.
+    lines = (
+        other_contents
+        + [ENV_FILE_BEGIN_MARKER]
+        + DOCKERIGNORE_RULES
+        + [ENV_FILE_END_MARKER]
+    )
+    return "".join(line + "\n" for line in lines)
+
+
+def manage_content_in_file(
+    filename: str, content_to_manage: str | list, should_exist: bool
+):
+    try:
+        env_document = EnvDocument.load(filename)
+        if env_document.manage(content_to_manage, should_exist):
+            env_document.save()
+    except FileNotFoundError:
+        logger.error("File '%s' not found.", filename)
     except IOError as e:
-        logger.error(f"Unable to read or write file. {str(e)}")
+        logger.error("Unable to read or write file. %s", e)
     except Exception as e:
-        logger.exception(f"An unexpected error occurred: {str(e)}")
+        logger.exception("An unexpected error occurred: %s", e)
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "latex-docker"
+)
+HOST_FACTS_CACHE_FILE = os.path.join(CACHE_DIR, "host-facts.json")
+FINGERPRINT_DIR = os.path.join(CACHE_DIR, "fingerprints")
+
+
+class HostFacts:
+    """Facts about the host machine, each probed only when a code path needs it.
+
+    CPU count, total memory and the git identity are cached in `cache_file` for
+    `ttl` seconds (0 disables the cache). The cache is also dropped when the
+    host name or the global git configuration changes. Per-session values such
+    as XAUTHORITY are read lazily from the environment but never persisted.
+    """
+
+    def __init__(self, cache_file: str = HOST_FACTS_CACHE_FILE, ttl: float = 86400):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._facts: Optional[Dict[str, Any]] = None
+        self._created = 0.0
+        self._lock = threading.Lock()
+
+    def _cache_key(self) -> List[Any]:
+        gitconfig_mtimes = []
+        for path in (
+            os.path.expanduser("~/.gitconfig"),
+            os.path.join(
+                os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")),
+                "git",
+                "config",
+            ),
+        ):
+            try:
+                gitconfig_mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                gitconfig_mtimes.append(None)
+        return [os.uname().nodename, gitconfig_mtimes]
+
+    def _load(self) -> Dict[str, Any]:
+        if self._facts is not None:
+            return self._facts
+        self._facts = {}
+        self._created = time.time()
+        if self.ttl <= 0:
+            return self._facts
+        try:
+            with open(self.cache_file, "r") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return self._facts
+        if (
+            cache.get("key") == self._cache_key()
+            and time.time() - cache.get("created", 0) < self.ttl
+        ):
+            self._facts = cache.get("facts", {})
+            self._created = cache["created"]
+            logger.debug("Loaded host facts from '%s'", self.cache_file)
+        return self._facts
+
+    def _save(self) -> None:
+        if self.ttl <= 0:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            atomic_write(
+                self.cache_file,
+                json.dumps(
+                    {
+                        "key": self._cache_key(),
+                        "created": self._created,
+                        "facts": self._facts,
+                    }
+                ),
+            )
+        except OSError as e:
+            logger.debug("Unable to write host facts cache. %s", e)
+
+    def _get(self, name: str, probe) -> Any:
+        with self._lock:
+            facts = self._load()
+            if name not in facts:
+                facts[name] = probe()
+                self._save()
+            return facts[name]
+
+    @property
+    def cpu_count(self) -> int:
+        return self._get("cpu_count", lambda: os.cpu_count() or 1)
+
+    @property
+    def total_memory(self) -> int:
+        def probe():
+            import psutil
+
+            return psutil.virtual_memory().total
+
+        return self._get("total_memory", probe)
+
+    @property
+    def git_identity(self) -> Dict[str, str]:
+        def probe():
+            import subprocess
+
+            result = subprocess.run(
+                ["git", "config", "--global", "--get-regexp", r"^user\.(name|email)$"],
+                capture_output=True,
+                universal_newlines=True,
+            )
+            identity = {"name": "", "email": ""}
+            for line in result.stdout.splitlines():
+                key, _, value = line.partition(" ")
+                identity[key.split(".", 1)[1]] = value.strip()
+            return identity
+
+        identity = self._get("git_identity", probe)
+        if not identity["name"] or not identity["email"]:
+            logger.warning("Global git user.name or user.email is not set.")
+        return identity
+
+    @property
+    def uid(self) -> int:
+        return os.getuid()
+
+    @property
+    def gid(self) -> int:
+        return os.getgid()
+
+    @property
+    def xauthority(self) -> Optional[str]:
+        return os.environ.get("XAUTHORITY")
+
+    @property
+    def xdg_runtime_dir(self) -> Optional[str]:
+        return os.environ.get("XDG_RUNTIME_DIR")
+
+
+@traced
+def resolve_resource_defaults(args: Any, host_facts: HostFacts) -> None:
+    # Resource defaults depend on the host, so they are filled in only once a
+    # code path actually generates a service.
+    total_memory_gib = None
+    if args.cpu_limit is None:
+        args.cpu_limit = host_facts.cpu_count / 2
+    if args.cpu_reservation is None:
+        args.cpu_reservation = host_facts.cpu_count / 16
+    if args.memory_limit is None:
+        total_memory_gib = host_facts.total_memory / (1024**3)
+        args.memory_limit = "{:.2f}G".format(total_memory_gib / 2)
+    if args.memory_reservation is None:
+        total_memory_gib = host_facts.total_memory / (1024**3)
+        args.memory_reservation = "{:.2f}G".format(total_memory_gib / 16)
+    if args.compile_jobs is None:
+        args.compile_jobs = plan_compile_jobs(
+            args.cpu_limit, args.memory_limit, args.compile_job_memory
+        )
+        logger.info(
+            "Planned COMPILE_JOBS=%s for service '%s' (%s CPUs, %s at %s per job)",
+            args.compile_jobs,
+            args.service_name,
+            args.cpu_limit,
+            args.memory_limit,
+            args.compile_job_memory,
+        )
+
+
+MEMORY_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_memory(value: str) -> float:
+    # Docker's memory notation, e.g. 512M, 1.5G or a number of bytes.
+    match = re.fullmatch(r"\s*([\d.]+)\s*([bkmgt]?)i?b?\s*", str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory size '{value}'.")
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()]
+
+
+def plan_compile_jobs(cpu_limit: float, memory_limit: str, job_memory: str) -> int:
+    # As many parallel jobs as the CPU limit allows, unless their combined
+    # memory would exceed the limit and push the build into swap.
+    by_cpu = int(cpu_limit)
+    by_memory = int(parse_memory(memory_limit) // parse_memory(job_memory))
+    return max(1, min(by_cpu, by_memory))
+
+
+class CpuInfo(NamedTuple):
+    cpu: int
+    core: int
+    package: int
+    node: int
+
+
+class Topology(NamedTuple):
+    cpus: List[CpuInfo]
+    # Bytes of memory local to each NUMA node; empty when unknown.
+    node_memory: Dict[int, int]
+
+
+def parse_cpulist(text: str) -> List[int]:
+    # The kernel's list format, e.g. "0-3,8,10-11".
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+def sysfs_topology(root: str = "/sys") -> Topology:
+    cpu_dir = os.path.join(root, "devices", "system", "cpu")
+    node_dir = os.path.join(root, "devices", "system", "node")
+    online = read_text(os.path.join(cpu_dir, "online"))
+    cpus = (
+        parse_cpulist(online)
+        if online is not None
+        else sorted(
+            int(name[3:])
+            for name in os.listdir(cpu_dir)
+            if re.fullmatch(r"cpu\d+", name)
+        )
+    )
+    nodes = {}
+    node_memory = {}
+    if os.path.isdir(node_dir):
+        for name in os.listdir(node_dir):
+            if not re.fullmatch(r"node\d+", name):
+                continue
+            node = int(name[4:])
+            for cpu in parse_cpulist(
+                read_text(os.path.join(node_dir, name, "cpulist")) or ""
+            ):
+                nodes[cpu] = node
+            meminfo = read_text(os.path.join(node_dir, name, "meminfo")) or ""
+            match = re.search(r"MemTotal:\s+(\d+) kB", meminfo)
+            if match:
+                node_memory[node] = int(match.group(1)) * 1024
+
+    def topology_value(cpu, name, default):
+        value = read_text(os.path.join(cpu_dir, f"cpu{cpu}", "topology", name))
+        return default if value is None else int(value)
+
+    return Topology(
+        [
+            CpuInfo(
+                cpu,
+                topology_value(cpu, "core_id", cpu),
+                topology_value(cpu, "physical_package_id", 0),
+                nodes.get(cpu, 0),
+            )
+            for cpu in cpus
+        ],
+        node_memory,
+    )
+
+
+def json_topology(filename: str) -> Topology:
+    # A synthetic layout: {"cpus": [{"cpu": 0, "core": 0, "package": 0,
+    # "node": 0}, ...], "node_memory": {"0": bytes, ...}}
+    with open(filename, "r") as file:
+        layout = json.load(file)
+    return Topology(
+        [CpuInfo(**cpu) for cpu in layout["cpus"]],
+        {int(node): memory for node, memory in layout.get("node_memory", {}).items()},
+    )
+
+
+# Named sources for `--topology`; anything else is read as a JSON layout.
+TOPOLOGY_PROBES = {"sysfs": sysfs_topology}
+
+
+def load_topology(source: str) -> Topology:
+    if source in TOPOLOGY_PROBES:
+        return TOPOLOGY_PROBES[source]()
+    return json_topology(source)
+
+
+class CoreAllocator:
+    """Hands out disjoint sets of physical cores, with their SMT siblings.
+
+    Each request is served from a single NUMA node when one has enough free
+    cores, the fullest such node first to keep larger nodes available. The
+    CPUs in `used` are never handed out.
+    """
+
+    def __init__(self, topology: Topology, used: Optional[List[int]] = None):
+        self.topology = topology
+        used = set(used or [])
+        self._free: Dict[int, Dict[Tuple[int, int], List[int]]] = {}
+        for info in topology.cpus:
+            self._free.setdefault(info.node, {}).setdefault(
+                (info.package, info.core), []
+            ).append(info.cpu)
+        for cores in self._free.values():
+            for key in [key for key, cpus in cores.items() if used & set(cpus)]:
+                del cores[key]
+
+    def allocate(self, cores: int) -> List[int]:
+        fitting = [node for node, free in self._free.items() if len(free) >= cores]
+        if fitting:
+            order = [min(fitting, key=lambda node: (len(self._free[node]), node))]
+        else:
+            order = sorted(self._free, key=lambda node: -len(self._free[node]))
+        if sum(len(self._free[node]) for node in order) < cores:
+            raise ValueError(
+                f"Only {sum(len(free) for free in self._free.values())} free physical cores are left, {cores} requested."
+            )
+        cpus = []
+        remaining = cores
+        for node in order:
+            for key in sorted(self._free[node]):
+                if remaining == 0:
+                    break
+                cpus.extend(self._free[node].pop(key))
+                remaining -= 1
+        return sorted(cpus)
+
+    def nodes(self, cpus: List[int]) -> List[int]:
+        return sorted({info.node for info in self.topology.cpus if info.cpu in cpus})
+
+
+@traced
+def pin_services(
+    services: List[Any], compose_data: Dict, topology_source: str, host_facts
+) -> None:
+    # Give every service with --pin-cores its own cores, avoiding the cpusets
+    # of the other services already in the compose file.
+    for service_args in services:
+        service_args.cpuset = None
+    pinned = [service_args for service_args in services if service_args.pin_cores]
+    if not pinned:
+        return
+    topology = load_topology(topology_source)
+    generated = {service_args.service_name for service_args in services}
+    used = [
+        cpu
+        for name, service in compose_data.get("services", {}).items()
+        if name not in generated and service.get("cpuset")
+        for cpu in parse_cpulist(str(service["cpuset"]))
+    ]
+    allocator = CoreAllocator(topology, used)
+    for service_args in pinned:
+        cpus = allocator.allocate(service_args.pin_cores)
+        nodes = allocator.nodes(cpus)
+        if len(nodes) > 1:
+            logger.warning(
+                "Service '%s' spans NUMA nodes %s; no single node has %s free cores.",
+                service_args.service_name,
+                nodes,
+                service_args.pin_cores,
+            )
+        service_args.cpuset = format_cpulist(cpus)
+        if service_args.cpu_limit is None:
+            # A quota equal to the cpuset never throttles within it.
+            service_args.cpu_limit = float(len(cpus))
+        if service_args.memory_limit is None:
+            # The cpuset's share of the memory local to its nodes.
+            node_cpus = [info for info in topology.cpus if info.node in nodes]
+            node_memory = (
+                sum(topology.node_memory.get(node, 0) for node in nodes)
+                if all(node in topology.node_memory for node in nodes)
+                else host_facts.total_memory * len(node_cpus) / len(topology.cpus)
+            )
+            service_args.memory_limit = "{:.2f}G".format(
+                node_memory * len(cpus) / len(node_cpus) / (1024**3)
+            )
+        logger.debug(
+            "Pinning service '%s' to CPUs %s on NUMA nodes %s",
+            service_args.service_name,
+            service_args.cpuset,
+            nodes,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def generator_version() -> str:
+    # The script's own content, so any change to the generator invalidates
+    # previously stored fingerprints.
+    with open(os.path.abspath(__file__), "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+# Options that only control how a run is carried out, not what it produces.
+FINGERPRINT_IGNORED_OPTIONS = {
+    "check",
+    "jobs",
+    "host_facts_ttl",
+    "manifest",
+    "trace",
+    "log_level",
+}
+
+
+@traced
+def compute_fingerprint(
+    services: List[Any], files: List[str], host_facts: HostFacts
+) -> str:
+    fingerprint = hashlib.sha256()
+    fingerprint.update(generator_version().encode())
+    for service_args in services:
+        resolved = {
+            key: value
+            for key, value in vars(service_args).items()
+            if key not in FINGERPRINT_IGNORED_OPTIONS
+        }
+        fingerprint.update(json.dumps(resolved, sort_keys=True, default=str).encode())
+    # Host values the generators read outside of the arguments.
+    host_values = [
+        host_facts.uid,
+        host_facts.gid,
+        host_facts.xauthority,
+        host_facts.xdg_runtime_dir,
+        os.environ.get("KITTY_LISTEN_ON"),
+        os.environ.get("TERMINFO"),
+    ]
+    fingerprint.update(json.dumps(host_values).encode())
+    for filename in files:
+        content = read_text(filename)
+        fingerprint.update(b"\0" if content is None else content.encode() + b"\1")
+    return fingerprint.hexdigest()
+
+
+def fingerprint_file(compose_file: str, env_file: str) -> str:
+    key = "\0".join(os.path.abspath(f) for f in (compose_file, env_file))
+    return os.path.join(
+        FINGERPRINT_DIR, hashlib.sha256(key.encode()).hexdigest()[:32] + ".sha256"
+    )
+
+
+def store_fingerprint(filename: str, fingerprint: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        atomic_write(filename, fingerprint + "\n")
+    except OSError as e:
+        logger.debug("Unable to store fingerprint. %s", e)
 
 
-def parse_arguments():
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="""1. Generate template files (Docker Compose configuration, environment variables file, Docker entrypoint script...)
 2. Generate build arguments in COMPOSE_FILE according to the ENV_FILE.
@@ -116,8 +963,23 @@ def parse_arguments():
     parser.add_argument(
         "--service-name",
         type=str,
-        required=True,
-        help="Name of the service",
+        help="Name of the service (required unless --manifest is given)",
+    )
+
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help="""Path to a YAML or TOML manifest listing several services to generate
+        in one run. Each entry takes the per-service options of this command
+        (e.g. service-name, nvidia, cpu-limit), and options given on the command
+        line act as defaults for every entry.
+        """,
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Number of worker threads used with --manifest (default: one per service, at most the CPU count)",
     )
 
     parser.add_argument(
@@ -135,7 +997,29 @@ def parse_arguments():
     parser.add_argument(
         "--generate-build-args",
         action="store_true",
-        help="",
+        help="Only update build arguments in COMPOSE_FILE from ENV_FILE (for every service unless --service-name or --manifest is given)",
+    )
+
+    parser.add_argument(
+        "--analyze-layer-cache",
+        action="store_true",
+        help="""Only report which Dockerfile layers rebuild when build arguments change:
+        the ones differing between ENV_FILE and --proposed-env-file, or every
+        ARG one at a time. Also hints at ARGs declared earlier than needed.
+        """,
+    )
+
+    parser.add_argument(
+        "--proposed-env-file",
+        type=str,
+        help="Environment variables file to compare ENV_FILE with for --analyze-layer-cache",
+    )
+
+    parser.add_argument(
+        "--dockerfile",
+        type=str,
+        default="./Dockerfile",
+        help="Path to the Dockerfile (default: %(default)s)",
     )
 
     parser.add_argument(
@@ -192,6 +1076,18 @@ def parse_arguments():
         help="Use an external entrypoint shell script",
     )
 
+    parser.add_argument(
+        "--init-steps",
+        type=str,
+        help="YAML file of the entrypoint's init steps; the entrypoint is then regenerated from it on every run",
+    )
+
+    parser.add_argument(
+        "--interactive-entrypoint",
+        action="store_true",
+        help="Run the entrypoint under 'zsh -i' instead of plain bash",
+    )
+
     parser.add_argument(
         "--x11-socket-volume",
         type=str,
@@ -202,41 +1098,69 @@ def parse_arguments():
     parser.add_argument(
         "--cpu-limit",
         type=float,
-        default=os.cpu_count() / 2,
         help="""
         Set CPU usage limit for the service (e.g., 0.5 for half a CPU, 2 for two CPUs) 
-        (default: %(default)s, half of the total resources on the host machine.)
+        (default: half of the total resources on the host machine.)
         """,
     )
 
     parser.add_argument(
         "--memory-limit",
         type=str,
-        default="{:.2f}G".format(psutil.virtual_memory().total / (1024**3) / 2),
         help="""
         Set memory usage limit for the service (e.g., 512M, 1G). 
-        (default: %(default)s, half of the total resources on the host machine.)
+        (default: half of the total resources on the host machine.)
         """,
     )
 
     parser.add_argument(
         "--cpu-reservation",
         type=float,
-        default=os.cpu_count() / 16,
         help="""Set CPU reservation for the service (e.g., 0.1 for 10%% of a CPU, 1 for one full CPU)
-        (default: %(default)s, 1/16 * total resources on the host machine.)
+        (default: 1/16 * total resources on the host machine.)
         """,
     )
 
     parser.add_argument(
         "--memory-reservation",
         type=str,
-        default="{:.2f}G".format(psutil.virtual_memory().total / (1024**3) / 16),
         help="""Set memory reservation for the service (e.g., 256M, 1G)
-        (default: %(default)s, 1/16 * total resources on the host machine.)
+        (default: 1/16 * total resources on the host machine.)
         """,
     )
 
+    parser.add_argument(
+        "--compile-jobs",
+        type=int,
+        help="""Set COMPILE_JOBS, the parallelism of the image's source builds
+        (default: planned from the CPU and memory limits, see --compile-job-memory.)
+        """,
+    )
+
+    parser.add_argument(
+        "--compile-job-memory",
+        type=str,
+        default="1G",
+        help="Memory one compile job is expected to use when planning COMPILE_JOBS (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--pin-cores",
+        type=int,
+        help="""Pin the service to this many physical cores, with their SMT siblings,
+        on one NUMA node when possible. Services get disjoint cores, and the CPU and
+        memory limits default to the cores and their share of node-local memory.
+        """,
+    )
+
+    parser.add_argument(
+        "--topology",
+        type=str,
+        default="sysfs",
+        help="Where --pin-cores reads the host topology: %s, or a JSON layout file (default: %%(default)s)"
+        % ", ".join(TOPOLOGY_PROBES),
+    )
+
     parser.add_argument(
         "--x11-authority-volume",
         type=str,
@@ -271,20 +1195,234 @@ def parse_arguments():
         help="Path to the entrypoint shell script (default: %(default)s)",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--scratch-size",
+        type=str,
+        help="Build LaTeX documents in a tmpfs of this size (e.g., 2G) through latexmk's output and aux directories",
+    )
+
+    parser.add_argument(
+        "--texmfvar-size",
+        type=str,
+        help="Put TEXMFVAR in a tmpfs of this size (e.g., 512M)",
+    )
+
+    parser.add_argument(
+        "--shm-size",
+        type=str,
+        help="Size of /dev/shm (e.g., 1G); ignored with the host IPC namespace",
+    )
+
+    parser.add_argument(
+        "--sync-back",
+        action="store_true",
+        help="With --scratch-size, copy the final PDF and SyncTeX file back to the document's directory",
+    )
+
+    parser.add_argument(
+        "--latexmkrc-path",
+        type=str,
+        default="./latexmkrc",
+        help="Path to the latexmk rc file used with --scratch-size and --format-cache (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--output-cache-volume",
+        type=str,
+        help="Share latex-build's cache of built PDFs between containers through this named volume (e.g., latex-outputs)",
+    )
+
+    parser.add_argument(
+        "--format-cache",
+        type=str,
+        help="Compile through cached formats of the document preambles, keeping at most this much (e.g., 2G) on a named volume",
+    )
+
+    parser.add_argument(
+        "--log-level",
+        type=str.upper,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Log messages of this level and above (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--trace",
+        type=str,
+        help="Write a Chrome trace of the run's phases, with their file and YAML I/O, to this file, and a JSON summary next to it",
+    )
+
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Write nothing; exit with status 1 if regenerating would change the compose file, env file or entrypoint",
+    )
+
+    parser.add_argument(
+        "--host-facts-ttl",
+        type=float,
+        default=86400,
+        help="Seconds to reuse cached host facts (CPU count, memory, git identity) from %s, 0 to disable (default: %%(default)s)"
+        % HOST_FACTS_CACHE_FILE,
+    )
+
+    return parser
+
+
+def parse_arguments(
+    parser: Optional[argparse.ArgumentParser] = None,
+    argv: Optional[List[str]] = None,
+):
+    parser = build_parser() if parser is None else parser
+    args = parser.parse_args(argv)
+    if (
+        args.service_name is None
+        and args.manifest is None
+        and not args.generate_build_args
+        and not args.analyze_layer_cache
+    ):
+        parser.error("one of the arguments --service-name --manifest is required")
     return args
 
 
-def generate_user_configuration(env_file, compose_data, service_name):
-    manage_content_in_file(
-        env_file,
+# Options that apply to the whole run and cannot be set per manifest entry.
+MANIFEST_GLOBAL_OPTIONS = {
+    "compose_file",
+    "env_file",
+    "from_scratch",
+    "generate_build_args",
+    "manifest",
+    "jobs",
+    "host_facts_ttl",
+    "check",
+    "analyze_layer_cache",
+    "proposed_env_file",
+    "dockerfile",
+    "topology",
+    "trace",
+    "log_level",
+}
+
+
+def load_manifest(manifest_file: str) -> List[Dict[str, Any]]:
+    if manifest_file.endswith(".toml"):
+        try:
+            import tomllib
+        except ModuleNotFoundError:  # Python < 3.11
+            import tomli as tomllib
+        with open(manifest_file, "rb") as file:
+            manifest = tomllib.load(file)
+    else:
+        manifest = load_yaml(manifest_file)
+
+    # Either a bare list of entries or a mapping with a "services" list.
+    if isinstance(manifest, dict):
+        manifest = manifest.get("services")
+    if not isinstance(manifest, list) or not all(
+        isinstance(spec, dict) for spec in manifest
+    ):
+        raise ValueError(
+            f"Manifest '{manifest_file}' must be a list of service entries or contain a 'services' list."
+        )
+    if not manifest:
+        raise ValueError(f"Manifest '{manifest_file}' lists no services.")
+    return manifest
+
+
+def parse_manifest_entry(
+    parser: argparse.ArgumentParser, defaults: argparse.Namespace, spec: Dict
+) -> argparse.Namespace:
+    argv = []
+    # An explicit false turns off a flag given on the command line; only a
+    # missing or null value inherits it.
+    disabled = []
+    for key, value in spec.items():
+        dest = key.replace("-", "_")
+        if dest in MANIFEST_GLOBAL_OPTIONS:
+            raise ValueError(
+                f"Option '{key}' applies to the whole run and cannot be set per service."
+            )
+        option = "--" + dest.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is False:
+            if not hasattr(defaults, dest):
+                raise ValueError(f"Unknown option '{key}' in manifest entry {spec}.")
+            disabled.append(dest)
+        elif value is None:
+            continue
+        elif isinstance(value, list):
+            argv.append(option)
+            argv.extend(str(item) for item in value)
+        else:
+            argv.extend([option, str(value)])
+
+    args = parser.parse_args(argv, namespace=copy.copy(defaults))
+    for dest in disabled:
+        setattr(args, dest, False)
+    if "service-name" not in spec and "service_name" not in spec:
+        raise ValueError(f"Manifest entry {spec} has no 'service-name'.")
+    return args
+
+
+# Build arguments whose value differs between services. When several services
+# share the env file, they are prefixed by their service there: compose
+# interpolates the ${VAR} of every service from that one namespace.
+SERVICE_SCOPED_VARIABLES = ("DOCKER_USER", "DOCKER_HOME", "COMPILE_JOBS")
+
+
+def service_variable_prefix(service_name: str) -> str:
+    return re.sub(r"\W", "_", service_name).upper() + "_"
+
+
+def build_arg_name(service_name: str, key: str) -> str:
+    # The build argument an env file variable sets, e.g. DOCKER_USER for
+    # LATEX_2_DOCKER_USER in the block of service latex-2.
+    prefix = service_variable_prefix(service_name)
+    if key.startswith(prefix) and key[len(prefix) :] in SERVICE_SCOPED_VARIABLES:
+        return key[len(prefix) :]
+    return key
+
+
+def scope_service_variables(
+    env_fragment: EnvDocument, fragment: Dict, service_name: str
+):
+    # Rename the service's scoped variables in its env journal and in every
+    # reference of its compose fragment, before the fragments are merged.
+    prefix = service_variable_prefix(service_name)
+    names = "|".join(SERVICE_SCOPED_VARIABLES)
+    assignment = re.compile(rf"^({names})=")
+    reference = re.compile(rf"\$(?:\{{({names})\}}|({names})\b)")
+
+    def scope(value):
+        if isinstance(value, str):
+            return reference.sub(
+                lambda match: "${" + prefix + (match.group(1) or match.group(2)) + "}",
+                value,
+            )
+        if isinstance(value, list):
+            return [scope(item) for item in value]
+        if isinstance(value, dict):
+            return {key: scope(item) for key, item in value.items()}
+        return value
+
+    env_fragment.journal = [
+        ([assignment.sub(rf"{prefix}\1=", line) for line in content], should_exist)
+        for content, should_exist in env_fragment.journal
+    ]
+    fragment["services"][service_name] = scope(fragment["services"][service_name])
+
+
+@traced
+def generate_user_configuration(env_document, compose_data, service_name, host_facts):
+    env_document.manage(
         [
             "# User",
             f"# >>> as services.{service_name}.build.args",
             f"DOCKER_USER={service_name}",
             f"DOCKER_HOME=/home/{service_name}",
-            f"DOCKER_UID={os.getuid()}",
-            f"DOCKER_GID={os.getgid()}",
+            f"DOCKER_UID={host_facts.uid}",
+            f"DOCKER_GID={host_facts.gid}",
             f"# <<< as services.{service_name}.build.args",
         ],
         True,
@@ -294,9 +1432,9 @@ def generate_user_configuration(env_file, compose_data, service_name):
     )
 
 
-def generate_networking_configuration(env_file, compose_data, service_name):
-    manage_content_in_file(
-        env_file,
+@traced
+def generate_networking_configuration(env_document, compose_data, service_name):
+    env_document.manage(
         [
             "# Networking",
             f"# >>> as services.{service_name}.build.args",
@@ -333,56 +1471,291 @@ def generate_networking_configuration(env_file, compose_data, service_name):
     )
 
 
-def generate_entrypoint_template(entrypoint: str):
-    with open(entrypoint, "w") as file:
-        import subprocess
-
-        user_name = subprocess.check_output(
-            "git config --global user.name", shell=True, universal_newlines=True
-        ).strip()
-        user_email = subprocess.check_output(
-            "git config --global user.email",
-            shell=True,
-            universal_newlines=True,
-        ).strip()
-        file.write(f"""#!/usr/bin/env bash
-set -euo pipefail
+class InitStep(NamedTuple):
+    """One step of the generated entrypoint.
+
+    A step whose stamp matches is skipped: the stamp records a hash of `run`
+    and of the output of the `key` command, and expires after `ttl` seconds
+    when set. Steps marked `always` run on every start. Steps run concurrently
+    once the steps named in `after` are done. `interactive` steps run under
+    `zsh -i` to get the user's rc; `volumes` maps names to paths to keep on
+    named volumes, e.g. caches the step fills.
+    """
+
+    name: str
+    run: str
+    key: Optional[str] = None
+    ttl: Optional[int] = None
+    after: Tuple[str, ...] = ()
+    always: bool = False
+    interactive: bool = False
+    required: bool = False
+    volumes: Dict[str, str] = {}
+
+
+# Refresh the luaotfload database in TEXMFVAR only when the font manifest shipped in
+# the image differs from the one it was built for, e.g. after an image rebuild.
+FONT_CACHE_CHECK = (
+    'manifest="$(sha256sum "${XDG_DATA_HOME}/fonts/fonts.json" 2>/dev/null | cut -d" " -f1)"; '
+    'stamp="$(kpsewhich -var-value TEXMFVAR)/.font-manifest"; '
+    'if [[ "$(cat "${stamp}" 2>/dev/null)" != "${manifest}" ]]; then '
+    'luaotfload-tool --update && echo "${manifest}" > "${stamp}"; fi'
+)
 
-has() {{
-command -v "$1" 1>/dev/null 2>&1
-}}
 
-git config --global user.name "{user_name}"
-git config --global user.email "{user_email}"
+def default_init_steps(host_facts: HostFacts) -> List[Dict[str, Any]]:
+    import shlex
+
+    user_name = shlex.quote(host_facts.git_identity["name"])
+    user_email = shlex.quote(host_facts.git_identity["email"])
+    return [
+        {
+            "name": "git-identity",
+            "run": f"git config --global user.name {user_name} && git config --global user.email {user_email}",
+        },
+        {
+            # The container file system is reset when the container is recreated.
+            "name": "zsh-link",
+            "run": 'if [[ ! -f "/bin/zsh" && -f "${XDG_PREFIX_HOME}/bin/zsh" ]]; then sudo ln -s "${XDG_PREFIX_HOME}/bin/zsh" /bin/zsh; fi',
+            "always": True,
+        },
+        {
+            "name": "font-caches",
+            "run": FONT_CACHE_CHECK,
+            "always": True,
+        },
+        {
+            "name": "nvim-plugins",
+            "run": 'if has nvim; then nvim --headless "+Lazy! sync" +qa; fi',
+            "key": "cat ~/.config/nvim/lazy-lock.json",
+            "volumes": {"nvim-data": "${DOCKER_HOME}/.local/share/nvim"},
+        },
+    ]
+
+
+def load_init_steps(filename: str) -> Dict[str, Any]:
+    # {"environment": [lines run in the entrypoint itself], "steps": [...]}
+    spec = load_yaml(filename)
+    if isinstance(spec, list):
+        spec = {"steps": spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get("steps"), list):
+        raise ValueError(f"Init steps file '{filename}' must contain a 'steps' list.")
+    if not all(isinstance(line, str) for line in spec.get("environment", [])):
+        raise ValueError(f"The environment of '{filename}' must be a list of lines.")
+    return spec
+
+
+def parse_init_steps(entries: List[Dict[str, Any]]) -> List[InitStep]:
+    steps = []
+    for entry in entries:
+        unknown = set(entry) - set(InitStep._fields)
+        if unknown:
+            raise ValueError(f"Unknown init step options: {', '.join(sorted(unknown))}")
+        entry = dict(entry)
+        entry["after"] = tuple(entry.get("after", ()))
+        entry["volumes"] = dict(entry.get("volumes", {}))
+        steps.append(InitStep(**entry))
+    return steps
+
+
+def init_step_waves(steps: List[InitStep]) -> List[List[InitStep]]:
+    # Group the steps into waves that only depend on earlier waves.
+    by_name = {step.name: step for step in steps}
+    levels: Dict[str, int] = {}
+
+    def level(step, visiting=()):
+        if step.name in levels:
+            return levels[step.name]
+        if step.name in visiting:
+            raise ValueError(
+                f"Init steps depend on each other: {' -> '.join(visiting)}"
+            )
+        for name in step.after:
+            if name not in by_name:
+                raise ValueError(f"Init step '{step.name}' runs after unknown '{name}'")
+        levels[step.name] = 1 + max(
+            (level(by_name[name], visiting + (step.name,)) for name in step.after),
+            default=-1,
+        )
+        return levels[step.name]
+
+    waves: List[List[InitStep]] = []
+    for step in steps:
+        index = level(step)
+        waves.extend([] for _ in range(index + 1 - len(waves)))
+        waves[index].append(step)
+    return waves
+
+
+ENTRYPOINT_RUNNER = r"""#!/usr/bin/env bash
+set -uo pipefail
+
+has() {
+	command -v "$1" 1>/dev/null 2>&1
+}
+export -f has
+
+# Stamps live in the container file system, so recreating the container runs
+# every step again while a restart skips the ones that are up to date.
+STAMP_DIR="${XDG_STATE_HOME:-$HOME/.local/state}/latex-docker/init"
+mkdir -p "$STAMP_DIR"
+
+now_ms() {
+	echo $(($(date +%s%N) / 1000000))
+}
+
+# run_step NAME ALWAYS TTL INTERACTIVE KEY_COMMAND COMMAND
+run_step() {
+	local name="$1" always="$2" ttl="$3" interactive="$4" key_command="$5" command="$6"
+	local stamp="$STAMP_DIR/$name" start key shell=(bash -c)
+	start=$(now_ms)
+	key=$({
+		printf '%s\n' "$command"
+		[[ -n "$key_command" ]] && bash -c "$key_command" 2>/dev/null
+	} | sha256sum | cut -d' ' -f1)
+	if [[ "$always" == 0 && -f "$stamp" && "$(cat "$stamp")" == "$key" ]] &&
+		[[ -z "$ttl" || $(($(date +%s) - $(stat -c %Y "$stamp"))) -lt "$ttl" ]]; then
+		echo "init: $name is up to date" >&2
+		return 0
+	fi
+	[[ "$interactive" == 1 ]] && shell=(zsh -i -c)
+	if "${shell[@]}" "$command"; then
+		echo "$key" >"$stamp"
+		echo "init: $name done in $(($(now_ms) - start)) ms" >&2
+	else
+		rm -f "$stamp"
+		echo "init: $name failed after $(($(now_ms) - start)) ms" >&2
+		return 1
+	fi
+}
+
+# Waits for the steps started since the last wave; a failed required step
+# fails the start once every step has had its chance to run.
+failed=0
+run_wave() {
+	local pid status
+	for pid in "${!wave[@]}"; do
+		wait "$pid"
+		status=$?
+		if [[ $status -ne 0 && "${wave[$pid]}" == 1 ]]; then
+			failed=1
+		fi
+	done
+	wave=()
+}
+
+declare -A wave=()
+init_start=$(now_ms)
+"""
 
-if [[ ! -f "/bin/zsh" && -f "${{XDG_PREFIX_HOME}}/bin/zsh" ]]; then
-sudo ln -s "${{XDG_PREFIX_HOME}}/bin/zsh" /bin/zsh
-fi
 
-if [[ -z "$DBUS_SESSION_BUS_ADDRESS" ]]; then
-if has "notify-send"; then
-   notify-send "$(whoami) ready."
-fi
-fi
+def render_entrypoint(steps: List[InitStep], environment: List[str]) -> str:
+    import shlex
+
+    lines = [ENTRYPOINT_RUNNER.rstrip("\n")] + environment
+    for wave in init_step_waves(steps):
+        lines.append("")
+        for step in wave:
+            arguments = [
+                step.name,
+                "1" if step.always else "0",
+                "" if step.ttl is None else str(step.ttl),
+                "1" if step.interactive else "0",
+                step.key or "",
+                step.run,
+            ]
+            lines.append(f"run_step {' '.join(shlex.quote(a) for a in arguments)} &")
+            lines.append(f"wave[$!]={int(step.required)}")
+        lines.append("run_wave")
+    lines += [
+        "",
+        'echo "init: ready in $(($(now_ms) - init_start)) ms" >&2',
+        "[[ $failed -eq 0 ]] || exit 1",
+        "",
+        'if [[ -z "${DBUS_SESSION_BUS_ADDRESS:-}" ]]; then',
+        '	if has "notify-send"; then',
+        '		notify-send "$(whoami) ready."',
+        "	fi",
+        "fi",
+        "",
+        'exec "$@"',
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def entrypoint_init_steps(
+    init_steps_file: Optional[str], host_facts: HostFacts
+) -> Tuple[List[InitStep], List[str]]:
+    if init_steps_file is None:
+        return parse_init_steps(default_init_steps(host_facts)), []
+    spec = load_init_steps(init_steps_file)
+    return parse_init_steps(spec["steps"]), list(spec.get("environment", []))
+
+
+def rendered_step_names(entrypoint: str) -> List[str]:
+    # Names of the init steps an existing entrypoint runs.
+    import shlex
+
+    return [
+        shlex.split(match)[0]
+        for match in re.findall(
+            r"^run_step ('[^']*'|\S+) ", read_text(entrypoint) or "", re.MULTILINE
+        )
+    ]
 
-# sudo service ssh start
 
-exec "$@"
-""")
+def generate_entrypoint_template(
+    entrypoint: str,
+    host_facts: HostFacts,
+    steps: Optional[List[InitStep]] = None,
+    environment: Optional[List[str]] = None,
+):
+    if steps is None:
+        steps, environment = entrypoint_init_steps(None, host_facts)
+    return write_if_changed(entrypoint, render_entrypoint(steps, environment or []))
 
 
-def generate_entrypoint_and_command(entrypoint_path, compose_data, service_name):
+@traced
+def generate_entrypoint_and_command(
+    entrypoint_path,
+    compose_data,
+    service_name,
+    host_facts,
+    init_steps_file=None,
+    interactive=False,
+    dry_run=False,
+):
     volumes = compose_data["services"][service_name]["volumes"]
     volumes.append(f"{entrypoint_path}:/entrypoint.sh:ro")
-    logger.debug(f"Added a new volume '{entrypoint_path}:/entrypoint.sh:ro'")
-    logger.debug("Added entrypoint with 'zsh -i'")
-    nested_set(
-        compose_data,
-        ["services", service_name, "entrypoint"],
-        ["zsh", "-i", "/entrypoint.sh"],
+    logger.debug("Added a new volume '%s:/entrypoint.sh:ro'", entrypoint_path)
+    steps, environment = entrypoint_init_steps(init_steps_file, host_facts)
+    # An entrypoint generated from an init steps file is owned by the generator;
+    # otherwise, an existing one is left alone.
+    regenerate = init_steps_file is not None or not os.path.exists(entrypoint_path)
+    # Only the steps the entrypoint runs get their volumes.
+    rendered = (
+        {step.name for step in steps}
+        if regenerate
+        else rendered_step_names(entrypoint_path)
+    )
+    for step in steps:
+        if step.name not in rendered:
+            continue
+        for name, target in step.volumes.items():
+            volume = f"{service_name}-{name}"
+            volumes.append(f"{volume}:{target}")
+            nested_set(compose_data, ["volumes", volume], {})
+            logger.debug(
+                "Added named volume '%s' for init step '%s'", volume, step.name
+            )
+    # The init steps do not need the interactive rc, only the final command does.
+    entrypoint = (
+        ["zsh", "-i", "/entrypoint.sh"] if interactive else ["bash", "/entrypoint.sh"]
     )
-    if not os.path.exists(entrypoint_path):
-        generate_entrypoint_template(entrypoint_path)
+    logger.debug("Added entrypoint with '%s'", " ".join(entrypoint[:-1]))
+    nested_set(compose_data, ["services", service_name, "entrypoint"], entrypoint)
+    if not dry_run and regenerate:
+        generate_entrypoint_template(entrypoint_path, host_facts, steps, environment)
     nested_set(
         compose_data,
         ["services", service_name, "command"],
@@ -390,65 +1763,382 @@ def generate_entrypoint_and_command(entrypoint_path, compose_data, service_name)
     )
 
 
-def generate_build_args(compose_file: str, env_file: str, service_name: str):
-    # Load the docker-compose.yml file
-    with open(compose_file, "r") as file:
-        compose_data = yaml.safe_load(file)
+class BuildArg(NamedTuple):
+    value: str
+    line: int  # 1-based line number in the env file
 
-    # Read the contents of the bash script
-    with open(env_file, "r") as file:
-        bash_content = file.read()
-
-    # Extract all build argument names from the bash script based on the specified rule
-    build_args_pattern = re.compile(
-        r"# >>> as services\.{service}\.build\.args\s*(.*?)\s*# <<< as services\.{service}\.build\.args".format(
-            service=re.escape(service_name)
-        ),
-        re.DOTALL,
-    )
-    build_args_matches = build_args_pattern.findall(bash_content)
 
-    build_args = {}
-    for match in build_args_matches:
-        build_args_content = match.strip()
-        for line in build_args_content.split("\n"):
+def extract_build_args(env_file: str) -> Dict[str, Dict[str, BuildArg]]:
+    # Stream the env file once and collect the arguments of every
+    # "# >>> as services.X.build.args" ... "# <<< as services.X.build.args"
+    # section. Sections of different services may nest; an argument belongs to
+    # every section that is open on its line. Unterminated sections are ignored.
+    build_args: Dict[str, Dict[str, BuildArg]] = {}
+    open_sections: Dict[str, Dict[str, BuildArg]] = {}
+    with open(env_file, "r") as file:
+        for line_number, line in enumerate(file, start=1):
             line = line.strip()
-            if line and not line.startswith("#"):
-                key, value = line.split("=", 1)
-                build_args[key] = f"${{{key}}}"
+            match = MANAGED_BLOCK_PATTERN.match(line)
+            if match is not None:
+                direction, service_name = match.groups()
+                if direction == ">>>":
+                    open_sections.setdefault(service_name, {})
+                elif service_name in open_sections:
+                    build_args.setdefault(service_name, {}).update(
+                        open_sections.pop(service_name)
+                    )
+                continue
+            if not open_sections or not line or line.startswith("#"):
+                continue
+            key, separator, value = line.partition("=")
+            if not separator:
+                logger.warning(
+                    "Ignoring '%s' at %s:%s, which is not a KEY=VALUE assignment.",
+                    line,
+                    env_file,
+                    line_number,
+                )
+                continue
+            for section in open_sections.values():
+                section[key] = BuildArg(value, line_number)
 
-    if not build_args:
+    for service_name in open_sections:
         logger.warning(
-            """No build arguments found in the shell script '{}' for service '{}'.
+            "The build arguments section of service '%s' in '%s' is not terminated.",
+            service_name,
+            env_file,
+        )
+    return build_args
+
+
+@traced
+def generate_build_args(
+    compose_file: str,
+    env_file: str,
+    service_names: Optional[List[str]] = None,
+    compose_data: Optional[Dict] = None,
+) -> List[str]:
+    # Update services.X.build.args in the compose file for every given service
+    # (every service with a section in the env file by default) and return the
+    # names of the services that were updated.
+    build_args = extract_build_args(env_file)
+    if service_names is None:
+        service_names = list(build_args)
+
+    # Load the docker-compose.yml file unless the caller already did
+    if compose_data is None:
+        compose_data = load_yaml(compose_file)
+
+    updated = []
+    for service_name in service_names:
+        if service_name not in build_args:
+            logger.warning(
+                """No build arguments found in the shell script '%s' for service '%s'.
 Please make sure the bash script contains the following lines:
-# >>> as services.{}.build.args
+# >>> as services.%s.build.args
 # ENV_VAR_1=value1
 # ENV_VAR_2=value2
 # ...
-# <<< as services.{}.build.args
-Skipping the update of docker-compose.yml.
-""".format(env_file, service_name, service_name, service_name)
+# <<< as services.%s.build.args
+Skipping the update of the service in docker-compose.yml.
+""",
+                env_file,
+                service_name,
+                service_name,
+                service_name,
+            )
+            continue
+        service = (compose_data or {}).get("services", {}).get(service_name)
+        if service is None:
+            logger.warning(
+                "Service '%s' is not defined in '%s'. Skipping it.",
+                service_name,
+                compose_file,
+            )
+            continue
+
+        # Update the build section in the docker-compose.yml file
+        nested_set(
+            service,
+            ["build", "args"],
+            {
+                build_arg_name(service_name, key): f"${{{key}}}"
+                for key in build_args[service_name]
+            },
         )
-        exit(0)
+        logger.debug(
+            "Set %s build arguments for service '%s'",
+            len(build_args[service_name]),
+            service_name,
+        )
+        updated.append(service_name)
+
+    # Save the updated docker-compose.yml file once for all services
+    if updated:
+        write_yaml(compose_file, compose_data)
+    return updated
+
+
+class DockerInstruction(NamedTuple):
+    stage: int  # -1 for global ARGs declared before the first FROM
+    line: int
+    keyword: str
+    arguments: str
+
+
+def parse_dockerfile(dockerfile: str) -> List[DockerInstruction]:
+    instructions = []
+    stage = -1
+    buffer: List[str] = []
+    start_line = 0
+    with open(dockerfile, "r") as file:
+        for line_number, line in enumerate(file, start=1):
+            stripped = line.strip()
+            # Comments and blank lines are dropped, also inside continuations.
+            if not stripped or stripped.startswith("#"):
+                continue
+            if not buffer:
+                start_line = line_number
+            if stripped.endswith("\\"):
+                buffer.append(stripped[:-1].strip())
+                continue
+            buffer.append(stripped)
+            keyword, _, arguments = " ".join(buffer).partition(" ")
+            buffer = []
+            keyword = keyword.upper()
+            if keyword == "FROM":
+                stage += 1
+            instructions.append(
+                DockerInstruction(stage, start_line, keyword, arguments.strip())
+            )
+    return instructions
+
+
+# Rough rebuild cost in minutes, first matching hint wins. Only meant to tell a
+# few seconds from a coffee break from a 40-minute TeX Live install.
+LAYER_COST_HINTS = [
+    (re.compile(r"install-tl"), 40.0),
+    (re.compile(r"\btlmgr\b"), 10.0),
+    (re.compile(r"\bmake\b"), 3.0),
+    (re.compile(r"apt-get install"), 1.0),
+    (re.compile(r"\bgit clone\b|\bwget\b|\bcurl\b"), 0.5),
+    (re.compile(r"texlive"), 2.0),  # e.g. copying the ISO contents
+]
+
+# Instructions that only change image metadata.
+METADATA_INSTRUCTIONS = {
+    "ARG",
+    "ENV",
+    "LABEL",
+    "USER",
+    "WORKDIR",
+    "SHELL",
+    "EXPOSE",
+    "ENTRYPOINT",
+    "CMD",
+    "STOPSIGNAL",
+    "HEALTHCHECK",
+    "ONBUILD",
+    "VOLUME",
+    "MAINTAINER",
+}
+
+
+def layer_cost(instruction: DockerInstruction) -> float:
+    if instruction.keyword in METADATA_INSTRUCTIONS:
+        return 0.0
+    for pattern, minutes in LAYER_COST_HINTS:
+        if pattern.search(instruction.arguments):
+            return minutes
+    return 0.1 if instruction.keyword == "RUN" else 0.05
+
+
+def references_arg(instruction: DockerInstruction, name: str) -> bool:
+    return (
+        re.search(
+            r"\$(\{%s[}:]|%s\b)" % (re.escape(name), re.escape(name)),
+            instruction.arguments,
+        )
+        is not None
+    )
 
-    # Update the build section in the docker-compose.yml file
-    build = compose_data["services"][service_name]["build"]
-    build["args"] = build_args
 
-    # Save the updated docker-compose.yml file
-    with open(compose_file, "w") as file:
-        yaml.dump(compose_data, file, default_flow_style=False)
+def rebuilt_instructions(
+    instructions: List[DockerInstruction], invalidated: Dict[int, int]
+) -> List[DockerInstruction]:
+    # `invalidated` maps a stage to the index of its first invalidated
+    # instruction. Stages built FROM an invalidated stage are rebuilt entirely,
+    # stages that COPY --from it are rebuilt from that COPY on.
+    invalidated = dict(invalidated)
+    stage_names = {}
+    for i, instruction in enumerate(instructions):
+        if instruction.keyword == "FROM":
+            words = instruction.arguments.split()
+            if len(words) >= 3 and words[-2].lower() == "as":
+                stage_names[words[-1]] = instruction.stage
+    for i, instruction in enumerate(instructions):
+        if instruction.stage in invalidated and invalidated[instruction.stage] <= i:
+            continue
+        sources = []
+        if instruction.keyword == "FROM":
+            sources = instruction.arguments.split()[:1]
+        elif instruction.keyword == "COPY":
+            sources = re.findall(r"--from=(\S+)", instruction.arguments)
+        for source in sources:
+            stage = stage_names.get(source, int(source) if source.isdigit() else None)
+            if stage is not None and stage in invalidated:
+                invalidated.setdefault(instruction.stage, i)
+                invalidated[instruction.stage] = min(invalidated[instruction.stage], i)
+    return [
+        instruction
+        for i, instruction in enumerate(instructions)
+        if instruction.stage in invalidated and invalidated[instruction.stage] <= i
+    ]
+
+
+class ArgImpact(NamedTuple):
+    name: str
+    declared: List[DockerInstruction]
+    # First instruction whose cache key changes with the ARG value: the first
+    # RUN after the declaration (ARGs are in its environment) or the first
+    # instruction that references it, whichever comes first.
+    first_invalidated: Dict[int, int]
+    # First instruction that actually references the ARG, per stage.
+    first_used: Dict[int, int]
+
+
+def analyze_build_args(instructions: List[DockerInstruction]) -> Dict[str, ArgImpact]:
+    impacts: Dict[str, ArgImpact] = {}
+    for i, instruction in enumerate(instructions):
+        if instruction.keyword != "ARG":
+            continue
+        name = instruction.arguments.split("=", 1)[0].strip()
+        impact = impacts.setdefault(name, ArgImpact(name, [], {}, {}))
+        impact.declared.append(instruction)
+        for j in range(i + 1, len(instructions)):
+            later = instructions[j]
+            if instruction.stage == -1:
+                # Global ARGs can only be used by FROM lines.
+                if later.keyword == "FROM" and references_arg(later, name):
+                    impact.first_invalidated.setdefault(later.stage, j)
+                    impact.first_used.setdefault(later.stage, j)
+                continue
+            if later.stage != instruction.stage:
+                break
+            if later.keyword == "ARG":
+                continue
+            used = references_arg(later, name)
+            if used:
+                impact.first_used.setdefault(later.stage, j)
+            if used or later.keyword == "RUN":
+                impact.first_invalidated.setdefault(later.stage, j)
+            if used:
+                break
+    return impacts
+
+
+def changed_build_args(env_file: str, proposed_env_file: str) -> List[str]:
+    def assignments(filename):
+        values = {}
+        for service_args in extract_build_args(filename).values():
+            for key, build_arg in service_args.items():
+                values[key] = build_arg.value
+        return values
+
+    current = assignments(env_file)
+    proposed = assignments(proposed_env_file)
+    return sorted(
+        key
+        for key in current.keys() | proposed.keys()
+        if current.get(key) != proposed.get(key)
+    )
+
 
+def report_layer_cache_impact(
+    dockerfile: str, changed_args: Optional[List[str]] = None
+) -> float:
+    # Print which layers rebuild when `changed_args` change (every declared
+    # ARG one at a time if not given) and return the estimated minutes.
+    instructions = parse_dockerfile(dockerfile)
+    impacts = analyze_build_args(instructions)
 
+    def describe(instruction):
+        text = f"{instruction.keyword} {instruction.arguments}"
+        return f"{dockerfile}:{instruction.line} " + (
+            text if len(text) <= 60 else text[:57] + "..."
+        )
+
+    if changed_args is None:
+        print(f"{'ARG':<24} {'rebuild (min)':>13}  first invalidated layer")
+        for name, impact in impacts.items():
+            rebuilt = rebuilt_instructions(instructions, impact.first_invalidated)
+            first = (
+                describe(instructions[min(impact.first_invalidated.values())])
+                if impact.first_invalidated
+                else "(none)"
+            )
+            cost = sum(layer_cost(instruction) for instruction in rebuilt)
+            print(f"{name:<24} {cost:>13.1f}  {first}")
+        total = 0.0
+    else:
+        invalidated: Dict[int, int] = {}
+        for name in changed_args:
+            impact = impacts.get(name)
+            if impact is None:
+                print(
+                    f"{name} is not declared in {dockerfile} and does not affect the build cache."
+                )
+                continue
+            for stage, index in impact.first_invalidated.items():
+                invalidated[stage] = min(invalidated.get(stage, index), index)
+        rebuilt = rebuilt_instructions(instructions, invalidated)
+        total = sum(layer_cost(instruction) for instruction in rebuilt)
+        if not rebuilt:
+            print("No layers will be rebuilt.")
+        else:
+            print(
+                f"Changing {', '.join(changed_args)} rebuilds {len(rebuilt)} instructions:"
+            )
+            for instruction in rebuilt:
+                print(f"  {layer_cost(instruction):>6.1f} min  {describe(instruction)}")
+            print(f"Estimated rebuild time: {total:.1f} min")
+
+    # ARGs declared long before they are needed invalidate the RUN layers in
+    # between for nothing.
+    for name, impact in impacts.items():
+        for stage, used in impact.first_used.items():
+            invalidated_index = impact.first_invalidated[stage]
+            if invalidated_index < used:
+                wasted = [
+                    instruction
+                    for instruction in instructions[invalidated_index:used]
+                    if instruction.keyword == "RUN"
+                ]
+                print(
+                    f"hint: ARG {name} is first used at {dockerfile}:{instructions[used].line}, "
+                    f"but invalidates {len(wasted)} earlier RUN layers "
+                    f"(~{sum(layer_cost(i) for i in wasted):.1f} min) from {dockerfile}:{instructions[invalidated_index].line}. "
+                    f"Declare it right before its first use."
+                )
+        if not impact.first_used and any(d.stage >= 0 for d in impact.declared):
+            print(
+                f"hint: ARG {name} is never referenced, but still invalidates the RUN layers after its declaration."
+            )
+    return total
+
+
+@traced
 def generate_basic_configuration(
-    args: Any, env_file: str, service_name: str, compose_data: Dict
+    args: Any, env_document: EnvDocument, service_name: str, compose_data: Dict
 ):
-    nested_set(compose_data, ["services", service_name, "env_file"], env_file)
-    manage_content_in_file(
-        env_file,
+    nested_set(
+        compose_data, ["services", service_name, "env_file"], env_document.filename
+    )
+    env_document.manage(
         [
             f"# >>> as services.{service_name}.build.args",
             "DOCKER_BUILDKIT=1",
+            f"COMPILE_JOBS={args.compile_jobs}",
             f"# <<< as services.{service_name}.build.args",
         ],
         True,
@@ -457,6 +2147,11 @@ def generate_basic_configuration(
     nested_set(
         compose_data, ["services", service_name, "build", "dockerfile"], "Dockerfile"
     )
+    nested_set(
+        compose_data,
+        ["services", service_name, "build", "additional_contexts", "texlive"],
+        TEXLIVE_BUILD_CONTEXT,
+    )
     nested_set(compose_data, ["services", service_name, "restart"], "always")
     nested_set(compose_data, ["services", service_name, "stdin_open"], True)
     nested_set(compose_data, ["services", service_name, "tty"], True)
@@ -474,7 +2169,7 @@ def generate_basic_configuration(
         args.cpu_limit,
     )
     logger.debug(
-        f"Setting CPU limit to {args.cpu_limit} for service '{args.service_name}'"
+        "Setting CPU limit to %s for service '%s'", args.cpu_limit, args.service_name
     )
 
     nested_set(
@@ -483,7 +2178,9 @@ def generate_basic_configuration(
         args.memory_limit,
     )
     logger.debug(
-        f"Setting memory limit to {args.memory_limit} for service '{args.service_name}'"
+        "Setting memory limit to %s for service '%s'",
+        args.memory_limit,
+        args.service_name,
     )
 
     if args.cpu_reservation is not None:
@@ -493,7 +2190,9 @@ def generate_basic_configuration(
             args.cpu_reservation,
         )
         logger.debug(
-            f"Setting CPU reservation to {args.cpu_reservation} for service '{args.service_name}'"
+            "Setting CPU reservation to %s for service '%s'",
+            args.cpu_reservation,
+            args.service_name,
         )
 
     if args.memory_reservation is not None:
@@ -503,8 +2202,16 @@ def generate_basic_configuration(
             args.memory_reservation,
         )
         logger.debug(
-            f"Setting memory reservation to {args.memory_reservation} for service '{args.service_name}'"
+            "Setting memory reservation to %s for service '%s'",
+            args.memory_reservation,
+            args.service_name,
         )
+    if args.cpuset is not None:
+        nested_set(compose_data, ["services", service_name, "cpuset"], args.cpuset)
+        logger.debug("Setting cpuset to %s for service '%s'", args.cpuset, service_name)
+    else:
+        compose_data["services"][service_name].pop("cpuset", None)
+
     # Name of the image and container
     image = args.image if args.image is not None else f"{args.service_name}:latest"
     nested_set(compose_data, ["services", service_name, "image"], image)
@@ -518,18 +2225,18 @@ def generate_basic_configuration(
     )
 
 
+@traced
 def generate_nvidia_configuration(
-    env_file: str, compose_data: Dict, service_name: str, nvidia: bool
+    env_document: EnvDocument, compose_data: Dict, service_name: str, nvidia: bool
 ):
     # Add NVIDIA GPU configuration if requested
-    manage_content_in_file(
-        env_file,
+    env_document.manage(
         ["NVIDIA_VISIBLE_DEVICES=all", "NVIDIA_DRIVER_CAPABILITIES=all"],
         nvidia,
     )
 
     if nvidia:
-        logger.debug(f"Use nvidia container runtime for service '{service_name}'.")
+        logger.debug("Use nvidia container runtime for service '%s'.", service_name)
 
         nested_set(
             compose_data["services"][service_name],
@@ -538,7 +2245,8 @@ def generate_nvidia_configuration(
         )
 
         logger.debug(
-            f"Deploy all NVIDIA GPU Devices with GPU capabilities for service '{service_name}'."
+            "Deploy all NVIDIA GPU Devices with GPU capabilities for service '%s'.",
+            service_name,
         )
 
         nested_set(
@@ -548,41 +2256,44 @@ def generate_nvidia_configuration(
         )
 
 
+@traced
 def generate_wayland_configuration(
     compose_data,
-    env_file,
+    env_document,
     service_name,
     wayland,
     wayland_volume="$XDG_RUNTIME_DIR/$WAYLAND_DISPLAY:/tmp/$WAYLAND_DISPLAY:rw",
 ):
     volumes = compose_data["services"][service_name]["volumes"]
     # Handle Wayland socket mounting
-    manage_content_in_file(env_file, 'WAYLAND_DISPLAY="${WAYLAND_DISPLAY}"', wayland)
+    env_document.manage('WAYLAND_DISPLAY="${WAYLAND_DISPLAY}"', wayland)
     if wayland:
         if wayland_volume not in volumes:
             volumes.append(wayland_volume)
-            logger.debug(f"Added Wayland socket mount for service '{service_name}'")
+            logger.debug("Added Wayland socket mount for service '%s'", service_name)
     else:
         if wayland_volume in volumes:
             volumes.remove(wayland_volume)
-            logger.debug(f"Removed Wayland socket mount from service '{service_name}'")
+            logger.debug("Removed Wayland socket mount from service '%s'", service_name)
 
 
+@traced
 def generate_x11_configuration(
     compose_data,
-    env_file,
+    env_document,
     service_name,
     x11,
     x11_socket_volume,
     x11_authority_volume,
+    host_facts,
 ):
     volumes = compose_data["services"][service_name]["volumes"]
     # Handle X11 socket mounting
-    manage_content_in_file(env_file, 'DISPLAY="${DISPLAY}"', x11)
-    manage_content_in_file(env_file, 'XAUTHORITY="${XAUTHORITY}"', x11)
+    env_document.manage('DISPLAY="${DISPLAY}"', x11)
+    env_document.manage('XAUTHORITY="${XAUTHORITY}"', x11)
 
     if x11_authority_volume is None:
-        x11_authority_file = os.environ.get("XAUTHORITY")
+        x11_authority_file = host_facts.xauthority
         if x11_authority_file is None:
             logger.warning("env:XAUTHORITY doesn't exist.")
             logger.warning("X11 authority file is not given.")
@@ -592,27 +2303,28 @@ def generate_x11_configuration(
     if x11:
         if x11_socket_volume not in volumes:
             volumes.append(x11_socket_volume)
-            logging.debug(f"Added X11 socket mount for service '{service_name}'")
+            logger.debug("Added X11 socket mount for service '%s'", service_name)
             if x11_authority_volume is not None:
                 volumes.append(x11_authority_volume)
-                logging.debug(
-                    f"Added X11 authority file mount for service '{service_name}'"
+                logger.debug(
+                    "Added X11 authority file mount for service '%s'", service_name
                 )
         # Reference: https://github.com/mviereck/x11docker/wiki/Short-setups-to-provide-X-display-to-container
-        logging.debug("Using host IPC")
+        logger.debug("Using host IPC")
         compose_data["services"][service_name]["ipc"] = "host"
     else:
         if x11_socket_volume in volumes:
             volumes.remove(x11_socket_volume)
-            logging.debug(f"Removed X11 socket mount from service '{service_name}'")
+            logger.debug("Removed X11 socket mount from service '%s'", service_name)
             volumes.remove(x11_authority_volume)
-            logging.debug(
-                f"Removed X11 authority file mount from service '{service_name}'"
+            logger.debug(
+                "Removed X11 authority file mount from service '%s'", service_name
             )
 
 
 # TODO
-def generate_default_volume_configuration(compose_data, service_name):
+@traced
+def generate_default_volume_configuration(compose_data, service_name, host_facts):
     # Handle volumes
     nested_set(
         compose_data,
@@ -624,18 +2336,203 @@ def generate_default_volume_configuration(compose_data, service_name):
             "~/Pictures:${DOCKER_HOME}/Pictures:rw",
             "~/Videos:${DOCKER_HOME}/Videos:rw",
             "~/.ssh:${DOCKER_HOME}/.ssh:ro",
-            f"{os.environ.get('XDG_RUNTIME_DIR')}:{os.environ.get('XDG_RUNTIME_DIR')}:rw",
+            f"{host_facts.xdg_runtime_dir}:{host_facts.xdg_runtime_dir}:rw",
         ],
     )
 
 
+# Where the RAM-backed scratch space lives inside the container.
+SCRATCH_DIR = "/tmp/latex-scratch"
+SCRATCH_TEXMFVAR = "/tmp/texmf-var"
+LATEXMKRC_TARGET = "/etc/latexmkrc"
+# The user TEXMFVAR of the install profile, which holds the luaotfload font database.
+TEXMFVAR_TARGET = "${DOCKER_HOME}/.texlive${TEXLIVE_VERSION}/texmf-var"
+# Where preamble-cache keeps the formats, created by the Dockerfile.
+FORMAT_CACHE_TARGET = "${DOCKER_HOME}/.cache/latex-formats"
+# Where latex-build keeps the outputs by the hash of their inputs.
+OUTPUT_CACHE_TARGET = "${DOCKER_HOME}/.cache/latex-build/outputs"
+
+
+def generate_latexmkrc_template(latexmkrc: str):
+    return write_if_changed(
+        latexmkrc,
+        """# Read by latexmk as its system rc file through LATEXMKRCSYS.
+use Cwd qw(getcwd);
+use File::Copy qw(copy);
+
+my $scratch = $ENV{'LATEX_SCRATCH_DIR'};
+if ($scratch) {
+    # One directory per source directory, so documents do not collide.
+    (my $name = getcwd()) =~ s{/}{_}g;
+    $out_dir = $aux_dir = "$scratch/$name";
+    if ($ENV{'LATEX_SYNC_BACK'}) {
+        # Only the final PDF and SyncTeX file are written back to the project:
+        # after every successful build in -pvc mode, and when latexmk exits.
+        $success_cmd = 'cp -p "%D" . && if [ -f "%Z%R.synctex.gz" ]; then cp -p "%Z%R.synctex.gz" .; fi';
+    }
+}
+
+END {
+    if ($scratch && $ENV{'LATEX_SYNC_BACK'} && -d $out_dir) {
+        copy($_, '.') for glob("$out_dir/*.pdf"), glob("$out_dir/*.synctex.gz");
+    }
+}
+
+if ($ENV{'LATEX_FORMAT_CACHE_SIZE'}) {
+    # Load each document's preamble from a cached format.
+    $pdflatex = 'preamble-cache run pdflatex %O %S';
+    $xelatex = 'preamble-cache run xelatex %O %S';
+    $lualatex = 'preamble-cache run lualatex %O %S';
+}
+""",
+    )
+
+
+@traced
+def generate_scratch_configuration(
+    compose_data,
+    service_name,
+    scratch_size,
+    texmfvar_size,
+    shm_size,
+    sync_back,
+):
+    # Aux, log, synctex and intermediate files go to tmpfs instead of the
+    # bind-mounted project directories.
+    service = compose_data["services"][service_name]
+    tmpfs = []
+    if scratch_size is not None:
+        tmpfs.append(f"{SCRATCH_DIR}:size={scratch_size},mode=1777")
+        logger.debug(
+            "Added a %s tmpfs for latexmk output in service '%s'",
+            scratch_size,
+            service_name,
+        )
+    if texmfvar_size is not None:
+        tmpfs.append(f"{SCRATCH_TEXMFVAR}:size={texmfvar_size},mode=1777")
+        logger.debug(
+            "Added a %s tmpfs for TEXMFVAR in service '%s'", texmfvar_size, service_name
+        )
+    if tmpfs:
+        service["tmpfs"] = tmpfs
+    else:
+        service.pop("tmpfs", None)
+    if texmfvar_size is None:
+        # Docker seeds a new named volume from the image, so the caches baked at
+        # build time are warm on the first compile and survive the container.
+        volume = f"{service_name}-texmf-var"
+        service["volumes"].append(f"{volume}:{TEXMFVAR_TARGET}")
+        nested_set(compose_data, ["volumes", volume], {})
+        logger.debug("Added named volume '%s' for TEXMFVAR", volume)
+
+    set_service_environment(
+        service, "LATEX_SCRATCH_DIR", SCRATCH_DIR if scratch_size is not None else None
+    )
+    set_service_environment(
+        service,
+        "LATEX_SYNC_BACK",
+        "1" if scratch_size is not None and sync_back else None,
+    )
+    set_service_environment(
+        service, "TEXMFVAR", SCRATCH_TEXMFVAR if texmfvar_size is not None else None
+    )
+
+    # With the host's IPC namespace, /dev/shm is the host's and cannot be sized.
+    if shm_size is not None and service.get("ipc") != "host":
+        service["shm_size"] = shm_size
+        logger.debug("Setting shm_size to %s for service '%s'", shm_size, service_name)
+    else:
+        if shm_size is not None:
+            logger.warning(
+                "Ignoring --shm-size for service '%s', which uses the host IPC namespace.",
+                service_name,
+            )
+        service.pop("shm_size", None)
+
+
+def set_service_environment(service: Dict, name: str, value: Optional[str]):
+    # Settings of one service go to its environment, not to the env file that
+    # every service of a manifest shares. None removes the variable.
+    if value is not None:
+        nested_set(service, ["environment", name], value)
+        return
+    environment = service.get("environment", {})
+    environment.pop(name, None)
+    if not environment:
+        service.pop("environment", None)
+
+
+def uses_latexmkrc(args) -> bool:
+    return args.scratch_size is not None or args.format_cache is not None
+
+
+@traced
+def generate_latexmkrc_configuration(
+    compose_data, service_name, latexmkrc_path, enabled, dry_run=False
+):
+    service = compose_data["services"][service_name]
+    set_service_environment(
+        service, "LATEXMKRCSYS", LATEXMKRC_TARGET if enabled else None
+    )
+    if not enabled:
+        return
+    service["volumes"].append(f"{latexmkrc_path}:{LATEXMKRC_TARGET}:ro")
+    if not os.path.exists(latexmkrc_path):
+        if not dry_run:
+            generate_latexmkrc_template(latexmkrc_path)
+    elif "preamble-cache" not in read_text(latexmkrc_path):
+        logger.warning(
+            "'%s' predates the format cache; remove it to regenerate it.",
+            latexmkrc_path,
+        )
+
+
+@traced
+def generate_format_cache_configuration(compose_data, service_name, format_cache_size):
+    # Precompiled preambles, shared by the containers of the service and kept
+    # across them. The size cap is per service, hence not in the shared env file.
+    service = compose_data["services"][service_name]
+    if format_cache_size is None:
+        set_service_environment(service, "LATEX_FORMAT_CACHE_SIZE", None)
+        return
+    volume = f"{service_name}-formats"
+    service["volumes"].append(f"{volume}:{FORMAT_CACHE_TARGET}")
+    nested_set(compose_data, ["volumes", volume], {})
+    set_service_environment(service, "LATEX_FORMAT_CACHE_SIZE", str(format_cache_size))
+    logger.debug(
+        "Added named volume '%s' for a %s format cache", volume, format_cache_size
+    )
+
+
+@traced
+def generate_output_cache_configuration(
+    compose_data, service_name, output_cache_volume
+):
+    # The volume keeps its name across compose projects, so that CI and
+    # developer containers restore each other's outputs.
+    service = compose_data["services"][service_name]
+    if output_cache_volume is None:
+        set_service_environment(service, "LATEX_BUILD_CACHE", None)
+        return
+    service["volumes"].append(f"{output_cache_volume}:{OUTPUT_CACHE_TARGET}")
+    nested_set(
+        compose_data, ["volumes", output_cache_volume], {"name": output_cache_volume}
+    )
+    set_service_environment(service, "LATEX_BUILD_CACHE", OUTPUT_CACHE_TARGET)
+    logger.debug(
+        "Added shared volume '%s' for the output cache of service '%s'",
+        output_cache_volume,
+        service_name,
+    )
+
+
+@traced
 def generate_dbus_configuration(
-    compose_data, service_name, env_file, dbus, dbus_volume=""
+    compose_data, service_name, env_document, dbus, dbus_volume=""
 ):
     # Handle DBus socket mounting
     volumes = compose_data["services"][service_name]["volumes"]
-    manage_content_in_file(
-        env_file,
+    env_document.manage(
         'DBUS_SESSION_BUS_ADDRESS="$DBUS_SESSION_BUS_ADDRESS"',
         dbus,
     )
@@ -643,17 +2540,20 @@ def generate_dbus_configuration(
         nested_set(compose_data, ["services", service_name, "privileged"], True)
         if dbus_volume not in volumes:
             volumes.append(dbus_volume)
-            logger.debug(f"Added DBus socket mount for service '{service_name}'")
+            logger.debug("Added DBus socket mount for service '%s'", service_name)
     else:
         if dbus_volume in volumes:
             volumes.remove(dbus_volume)
-            logger.debug(f"Removed DBus socket mount from service '{service_name}'")
+            logger.debug("Removed DBus socket mount from service '%s'", service_name)
 
 
-def generate_kitty_configuration(compose_data, service_name, env_file, kitty):
-    manage_content_in_file(env_file, "TERM=xterm-kitty", kitty)
-    manage_content_in_file(env_file, "KITTY_LISTEN_ON=${KITTY_LISTEN_ON}", kitty)
-    manage_content_in_file(env_file, "TERMINFO=$DOCKER_HOME/.local/kitty.app/lib/kitty/terminfo", kitty)
+@traced
+def generate_kitty_configuration(compose_data, service_name, env_document, kitty):
+    env_document.manage("TERM=xterm-kitty", kitty)
+    env_document.manage("KITTY_LISTEN_ON=${KITTY_LISTEN_ON}", kitty)
+    env_document.manage(
+        "TERMINFO=$DOCKER_HOME/.local/kitty.app/lib/kitty/terminfo", kitty
+    )
     if kitty:
         volumes = compose_data["services"][service_name]["volumes"]
         kitty_listen_on = os.environ.get("KITTY_LISTEN_ON")
@@ -664,7 +2564,7 @@ def generate_kitty_configuration(compose_data, service_name, env_file, kitty):
             socket_path = kitty_listen_on.replace("unix:", "")
             kitty_volume = f"{socket_path}:{socket_path}:rw"
             volumes.append(kitty_volume)
-            logger.debug(f"Added kitty socket mount for service '{service_name}'")
+            logger.debug("Added kitty socket mount for service '%s'", service_name)
 
         terminfo = os.environ.get("TERMINFO")
         if terminfo is None:
@@ -674,90 +2574,69 @@ def generate_kitty_configuration(compose_data, service_name, env_file, kitty):
                 f"{terminfo}:$DOCKER_HOME/.local/kitty.app/lib/kitty/terminfo:rw"
             )
             volumes.append(terminfo_volume)
-            logger.debug(f"Added kitty terminfo mount for service '{service_name}'")
-
-
-def main():
-    args = parse_arguments()
+            logger.debug("Added kitty terminfo mount for service '%s'", service_name)
 
-    env_file = args.env_file
-    compose_file = args.compose_file
-    service_name = args.service_name
 
-    compose_file_from_scratch = args.from_scratch or not os.path.exists(compose_file)
-
-    compose_data = (
-        {} if compose_file_from_scratch else yaml.safe_load(open(compose_file, "r"))
-    )
-
-    if args.generate_build_args:
-        generate_build_args(
-            env_file=env_file, compose_file=compose_file, service_name=service_name
-        )
-        logger.debug(
-            "Generate build args in Docker Compose file according to environment variables file."
+def generate_service(
+    args: Any,
+    env_document: EnvDocument,
+    compose_data: Dict,
+    host_facts: HostFacts,
+    dry_run: bool = False,
+):
+    with TRACER.span("generate_service", service=args.service_name):
+        generate_service_configurations(
+            args, env_document, compose_data, host_facts, dry_run
         )
-        exit(0)
 
-    env_file_from_scratch = args.from_scratch or not os.path.exists(env_file)
 
-    start_line_env_file = """# >>> auto-generated contents
-"""
-    end_line_env_file = """# <<< auto-generated contents
-"""
-
-    if not env_file_from_scratch:
-        with open(env_file, "r") as file:
-            env_file_other_contents = []
-            is_managed_content = False
-            for line in file:
-                if line == start_line_env_file:
-                    is_managed_content = True
-                    continue
-                elif line == end_line_env_file:
-                    is_managed_content = False
-                    continue
-                elif not is_managed_content:
-                    env_file_other_contents.append(line)
-
-    with open(env_file, "w") as file:
-        file.write(start_line_env_file)
+def generate_service_configurations(
+    args: Any,
+    env_document: EnvDocument,
+    compose_data: Dict,
+    host_facts: HostFacts,
+    dry_run: bool = False,
+):
+    service_name = args.service_name
+    resolve_resource_defaults(args, host_facts)
 
     generate_basic_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         args=args,
     )
 
     generate_user_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
+        host_facts=host_facts,
     )
 
     generate_default_volume_configuration(
         service_name=service_name,
         compose_data=compose_data,
+        host_facts=host_facts,
     )
 
     generate_networking_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
     )
 
     generate_nvidia_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         nvidia=args.nvidia,
     )
 
     generate_wayland_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         wayland=args.wayland,
         wayland_volume=args.wayland_volume,
     )
@@ -765,16 +2644,17 @@ def main():
     generate_x11_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         x11=args.x11,
         x11_socket_volume=args.x11_socket_volume,
         x11_authority_volume=args.x11_authority_volume,
+        host_facts=host_facts,
     )
 
     generate_dbus_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         dbus=args.dbus,
         dbus_volume=args.dbus_volume,
     )
@@ -782,13 +2662,42 @@ def main():
     generate_kitty_configuration(
         service_name=service_name,
         compose_data=compose_data,
-        env_file=env_file,
+        env_document=env_document,
         kitty=args.kitty,
     )
 
+    generate_scratch_configuration(
+        service_name=service_name,
+        compose_data=compose_data,
+        scratch_size=args.scratch_size,
+        texmfvar_size=args.texmfvar_size,
+        shm_size=args.shm_size,
+        sync_back=args.sync_back,
+    )
+
+    generate_format_cache_configuration(
+        service_name=service_name,
+        compose_data=compose_data,
+        format_cache_size=args.format_cache,
+    )
+
+    generate_output_cache_configuration(
+        service_name=service_name,
+        compose_data=compose_data,
+        output_cache_volume=args.output_cache_volume,
+    )
+
+    generate_latexmkrc_configuration(
+        service_name=service_name,
+        compose_data=compose_data,
+        latexmkrc_path=args.latexmkrc_path,
+        enabled=uses_latexmkrc(args),
+        dry_run=dry_run,
+    )
+
     if args.volumes_append is not None:
         for item in args.volumes_append:
-            logger.debug(f"Added a new volume '{item}'")
+            logger.debug("Added a new volume '%s'", item)
             compose_data["services"][service_name]["volumes"].append(item)
 
     if args.entrypoint:
@@ -796,16 +2705,243 @@ def main():
             service_name=service_name,
             compose_data=compose_data,
             entrypoint_path=args.entrypoint_path,
+            host_facts=host_facts,
+            init_steps_file=args.init_steps,
+            interactive=args.interactive_entrypoint,
+            dry_run=dry_run,
         )
 
-    with open(env_file, "a") as file:
-        file.write(end_line_env_file)
-        if not env_file_from_scratch:
-            for line in env_file_other_contents:
-                file.write(line)
 
-    with open(compose_file, "w") as file:
-        yaml.dump(compose_data, file)
+def generate_service_fragment(
+    args: Any,
+    env_file: str,
+    compose_data: Dict,
+    host_facts: HostFacts,
+    dry_run: bool = False,
+):
+    # Run every generator for one service against private state, so several
+    # services can be generated concurrently. The returned env journal and
+    # compose fragment are merged back in manifest order by `merge_fragment`.
+    service_name = args.service_name
+    fragment = {
+        "services": {
+            service_name: copy.deepcopy(
+                compose_data.get("services", {}).get(service_name, {})
+            )
+        }
+    }
+    env_fragment = EnvDocument(env_file)
+    generate_service(args, env_fragment, fragment, host_facts, dry_run)
+    scope_service_variables(env_fragment, fragment, service_name)
+    return env_fragment, fragment
+
+
+@traced
+def merge_fragment(
+    env_document: EnvDocument,
+    compose_data: Dict,
+    env_fragment: EnvDocument,
+    fragment: Dict,
+):
+    # The env file is shared by every service, so keep whatever any service
+    # asked for. Each fragment starts empty, so its removals are no-ops anyway.
+    for content_to_manage, should_exist in env_fragment.journal:
+        if should_exist:
+            env_document.manage(content_to_manage, True)
+    for key, value in fragment.items():
+        if key == "services":
+            compose_data.setdefault("services", {}).update(value)
+        else:
+            nested_update(compose_data.setdefault(key, {}), value)
+
+
+def main():
+    parser = build_parser()
+    args = parse_arguments(parser)
+    logging.basicConfig(level=getattr(logging, args.log_level), format=LOG_FORMAT)
+    if args.trace is None:
+        run(parser, args)
+        return
+    TRACER.enable()
+    try:
+        with TRACER.span("main"):
+            run(parser, args)
+    finally:
+        # Also for the runs that end early, e.g. when nothing changed.
+        summary_file = TRACER.write(args.trace)
+        logger.info(
+            "Wrote the trace to '%s' and its summary to '%s'.", args.trace, summary_file
+        )
+
+
+def run(parser: argparse.ArgumentParser, args: Any):
+    env_file = args.env_file
+    compose_file = args.compose_file
+
+    if args.analyze_layer_cache:
+        report_layer_cache_impact(
+            args.dockerfile,
+            (
+                None
+                if args.proposed_env_file is None
+                else changed_build_args(env_file, args.proposed_env_file)
+            ),
+        )
+        exit(0)
+
+    if args.manifest is not None:
+        try:
+            services = [
+                parse_manifest_entry(parser, args, spec)
+                for spec in load_manifest(args.manifest)
+            ]
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid manifest '{args.manifest}'. {str(e)}")
+    elif args.service_name is not None:
+        services = [args]
+    else:
+        # --generate-build-args without a service: update every service.
+        services = []
+
+    compose_file_from_scratch = args.from_scratch or not os.path.exists(compose_file)
+
+    with TRACER.span("load_compose"):
+        compose_data = {} if compose_file_from_scratch else load_yaml(compose_file)
+
+    if args.generate_build_args:
+        generate_build_args(
+            env_file=env_file,
+            compose_file=compose_file,
+            service_names=(
+                None
+                if args.service_name is None and args.manifest is None
+                else [service_args.service_name for service_args in services]
+            ),
+            compose_data=None if compose_file_from_scratch else compose_data,
+        )
+        logger.debug(
+            "Generate build args in Docker Compose file according to environment variables file."
+        )
+        exit(0)
+
+    host_facts = HostFacts(ttl=args.host_facts_ttl)
+    try:
+        pin_services(services, compose_data, args.topology, host_facts)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        parser.error(f"Unable to pin cores. {str(e)}")
+    for service_args in services:
+        resolve_resource_defaults(service_args, host_facts)
+
+    init_steps_files = sorted(
+        {
+            service_args.init_steps
+            for service_args in services
+            if service_args.entrypoint and service_args.init_steps is not None
+        }
+    )
+    for init_steps_file in init_steps_files:
+        try:
+            init_step_waves(entrypoint_init_steps(init_steps_file, host_facts)[0])
+        except (OSError, ValueError, TypeError) as e:
+            parser.error(f"Invalid init steps in '{init_steps_file}'. {str(e)}")
+
+    # Skip the whole run when nothing that feeds the generators has changed.
+    dockerignore = dockerignore_file(compose_file)
+    fingerprint_inputs = [env_file, compose_file, dockerignore] + init_steps_files
+    if args.topology is not None and args.topology not in TOPOLOGY_PROBES:
+        fingerprint_inputs.append(args.topology)
+    # The entrypoints and latexmkrc files, which are kept once they exist.
+    for service_args in services:
+        if service_args.entrypoint:
+            fingerprint_inputs.append(service_args.entrypoint_path)
+        if uses_latexmkrc(service_args):
+            fingerprint_inputs.append(service_args.latexmkrc_path)
+    fingerprint_inputs = list(dict.fromkeys(fingerprint_inputs))
+    fingerprint_path = fingerprint_file(compose_file, env_file)
+    fingerprint = compute_fingerprint(services, fingerprint_inputs, host_facts)
+    if read_text(fingerprint_path) == fingerprint + "\n":
+        logger.info("Inputs are unchanged since the last run. Nothing to do.")
+        exit(0)
+
+    env_file_from_scratch = args.from_scratch or not os.path.exists(env_file)
+
+    env_file_other_contents = [] if env_file_from_scratch else unmanaged_lines(env_file)
+    if any(line.startswith("COMPILE_JOBS=") for line in env_file_other_contents):
+        logger.warning(
+            "COMPILE_JOBS set in '%s' overrides the planned value; remove it or use --compile-jobs.",
+            env_file,
+        )
+
+    env_document = EnvDocument(env_file, [ENV_FILE_BEGIN_MARKER])
+
+    if len(services) == 1:
+        generate_service(
+            services[0], env_document, compose_data, host_facts, dry_run=args.check
+        )
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        jobs = args.jobs or min(len(services), host_facts.cpu_count)
+        logger.debug("Generating %s services with %s workers", len(services), jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            fragments = list(
+                executor.map(
+                    lambda service_args: generate_service_fragment(
+                        service_args, env_file, compose_data, host_facts, args.check
+                    ),
+                    services,
+                )
+            )
+        for env_fragment, fragment in fragments:
+            merge_fragment(env_document, compose_data, env_fragment, fragment)
+
+    env_document.extend([ENV_FILE_END_MARKER] + env_file_other_contents)
+    dockerignore_content = generate_dockerignore(dockerignore, args.from_scratch)
+
+    if args.check:
+        outdated = [
+            filename
+            for filename, content in (
+                (env_file, env_document.render()),
+                (compose_file, dump_yaml(compose_data)),
+                (dockerignore, dockerignore_content),
+            )
+            if read_text(filename) != content
+        ]
+        outdated += [
+            service_args.entrypoint_path
+            for service_args in services
+            if service_args.entrypoint
+            and (
+                not os.path.exists(service_args.entrypoint_path)
+                if service_args.init_steps is None
+                else read_text(service_args.entrypoint_path)
+                != render_entrypoint(
+                    *entrypoint_init_steps(service_args.init_steps, host_facts)
+                )
+            )
+        ]
+        outdated += [
+            service_args.latexmkrc_path
+            for service_args in services
+            if uses_latexmkrc(service_args)
+            and not os.path.exists(service_args.latexmkrc_path)
+        ]
+        if outdated:
+            logger.error("Regeneration would change: %s", ", ".join(outdated))
+            exit(1)
+        logger.info("Generated files are up to date.")
+        exit(0)
+
+    with TRACER.span("write"):
+        env_document.save()
+        write_yaml(compose_file, compose_data)
+        write_if_changed(dockerignore, dockerignore_content)
+
+    store_fingerprint(
+        fingerprint_path,
+        compute_fingerprint(services, fingerprint_inputs, host_facts),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import time
+import fcntl
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from typing import Dict, List, Optional, Tuple
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "latex-formats"
+)
+DEFAULT_MAX_SIZE = "2G"
+FORMAT_EXTENSION = ".fmt"
+FAILED_EXTENSION = ".failed"
+# Build directories left behind by a killed build are removed after this long.
+STALE_BUILD_SECONDS = 3600
+
+# engine: (INI engine, format the preamble is loaded on top of)
+ENGINES = {
+    "pdflatex": ("pdftex", "pdflatex"),
+    "xelatex": ("xetex", "xelatex"),
+    "lualatex": ("luahbtex", "lualatex"),
+}
+# Both commands are split like a shell command line, then every word is
+# formatted with the fields below. A word that is exactly "{args}" expands to
+# the engine arguments of the compile.
+DEFAULT_BUILD_COMMAND = (
+    "{ini_engine} -ini -interaction=batchmode -jobname={name} "
+    '-output-directory={output_dir} "&{base_format}" mylatexformat.ltx {source}'
+)
+DEFAULT_RUN_COMMAND = "{engine} -fmt={name} {args}"
+
+SIZE_UNITS = {"": 1, "B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+# mylatexformat dumps everything before \endofdump, or else before \begin{document}.
+END_OF_DUMP = re.compile(r"^[^%\n]*?\\endofdump", re.MULTILINE)
+BEGIN_DOCUMENT = re.compile(r"^[^%\n]*?\\begin\s*\{document\}", re.MULTILINE)
+DOCUMENT_CLASS = re.compile(r"^[^%\n]*?\\documentclass", re.MULTILINE)
+# Files the preamble reads, which may be local to the project.
+PREAMBLE_INPUTS = re.compile(
+    r"^[^%\n]*?\\(?:input|include|usepackage|RequirePackage|documentclass)\s*(?:\[[^\]]*\])?\s*\{([^}]*)\}",
+    re.MULTILINE,
+)
+LOCAL_EXTENSIONS = ("", ".tex", ".sty", ".cls")
+# OpenType fonts loaded by XeTeX or LuaTeX cannot be dumped into a format.
+NATIVE_FONT_PACKAGES = re.compile(
+    r"^[^%\n]*?\\(?:usepackage|RequirePackage|documentclass)\s*(?:\[[^\]]*\])?\s*"
+    r"\{[^}]*\b(?:fontspec|unicode-math|xeCJK|luatexja-fontspec|ctex\w*)\b[^}]*\}",
+    re.MULTILINE,
+)
+
+
+def parse_size(size: str) -> int:
+    # Docker style sizes, e.g. "512M" or "2G".
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([BKMGT]?)i?B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Invalid size '{size}'.")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def extract_preamble(text: str) -> Optional[str]:
+    # The part of a root document that goes into its format, if it is one.
+    if DOCUMENT_CLASS.search(text) is None:
+        return None
+    match = END_OF_DUMP.search(text) or BEGIN_DOCUMENT.search(text)
+    if match is None:
+        return None
+    return text[: match.start()]
+
+
+def local_inputs(preamble: str, directory: str) -> List[str]:
+    inputs = []
+    for match in PREAMBLE_INPUTS.finditer(preamble):
+        for name in match.group(1).split(","):
+            name = name.strip()
+            for extension in LOCAL_EXTENSIONS:
+                path = os.path.join(directory, name + extension)
+                if name and os.path.isfile(path):
+                    inputs.append(path)
+                    break
+    return sorted(set(inputs))
+
+
+_versions: Dict[str, str] = {}
+
+
+def texlive_version(engine: str) -> str:
+    # Formats only load on the binaries that dumped them.
+    if engine not in _versions:
+        version = os.environ.get("TEXLIVE_VERSION")
+        if not version:
+            try:
+                output = subprocess.run(
+                    [engine, "--version"], capture_output=True, text=True
+                ).stdout
+                version = output.splitlines()[0] if output else ""
+            except OSError:
+                version = ""
+        _versions[engine] = version
+    return _versions[engine]
+
+
+def format_name(engine: str, source: str) -> Tuple[Optional[str], str]:
+    # (name, reason): the name of the source's format, or None and why it has none.
+    with open(source, "r", encoding="utf-8", errors="replace") as file:
+        preamble = extract_preamble(file.read())
+    if preamble is None:
+        return None, "no preamble"
+    if engine != "pdflatex" and NATIVE_FONT_PACKAGES.search(preamble):
+        return None, "loads OpenType fonts before \\endofdump"
+    digest = hashlib.sha256()
+    for part in (engine, texlive_version(engine), preamble):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    for path in local_inputs(preamble, os.path.dirname(source) or "."):
+        with open(path, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return f"{engine}-{digest.hexdigest()[:20]}", ""
+
+
+def expand_command(template: str, args: List[str] = (), **fields) -> List[str]:
+    command = []
+    for word in shlex.split(template):
+        if word == "{args}":
+            command.extend(args)
+        else:
+            command.append(word.format(**fields))
+    return command
+
+
+class FormatCache:
+    # Formats of preambles under a directory shared by concurrent compiles.
+    # A fill holds the lock of its format, so a format is built only once.
+    # Compiles hold the cache lock shared and eviction holds it exclusively,
+    # so no format is removed while an engine might be loading it.
+
+    def __init__(
+        self,
+        directory: str,
+        max_size: int,
+        build_command: str = DEFAULT_BUILD_COMMAND,
+        run_command: str = DEFAULT_RUN_COMMAND,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.build_command = build_command
+        self.run_command = run_command
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, extension: str = FORMAT_EXTENSION) -> str:
+        return os.path.join(self.directory, name + extension)
+
+    @contextlib.contextmanager
+    def lock(self, name: str, operation: int):
+        with open(self.path(name, ".lock"), "a") as file:
+            fcntl.flock(file, operation)
+            yield
+
+    def ensure(self, engine: str, source: str, name: str) -> bool:
+        # Build the format unless it is cached, and mark it as recently used.
+        if not os.path.exists(self.path(name)):
+            with self.lock(name, fcntl.LOCK_EX):
+                if os.path.exists(self.path(name, FAILED_EXTENSION)):
+                    return False
+                if not os.path.exists(self.path(name)) and not self.build(
+                    engine, source, name
+                ):
+                    open(self.path(name, FAILED_EXTENSION), "w").close()
+                    return False
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:  # evicted in between
+            return self.ensure(engine, source, name)
+        return True
+
+    def build(self, engine: str, source: str, name: str) -> bool:
+        ini_engine, base_format = ENGINES[engine]
+        logger.info(f"Building the format '{name}' of {source}.")
+        start = time.monotonic()
+        with tempfile.TemporaryDirectory(
+            prefix=".build-", dir=self.directory
+        ) as output_dir:
+            command = expand_command(
+                self.build_command,
+                engine=engine,
+                ini_engine=ini_engine,
+                base_format=base_format,
+                name=name,
+                output_dir=output_dir,
+                source=os.path.basename(source),
+            )
+            result = subprocess.run(
+                command,
+                cwd=os.path.dirname(source) or ".",
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            built = os.path.join(output_dir, name + FORMAT_EXTENSION)
+            if result.returncode != 0 or not os.path.exists(built):
+                log = os.path.join(output_dir, name + ".log")
+                if os.path.exists(log):
+                    os.replace(log, self.path(name, ".log"))
+                logger.warning(
+                    f"Unable to build the format of {source}, which is compiled without one. See {self.path(name, '.log')}."
+                )
+                return False
+            # Readers only ever see a complete format.
+            os.replace(built, self.path(name))
+        logger.info(f"Built the format '{name}' in {time.monotonic() - start:.1f}s.")
+        return True
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        # (last use, size, name) of every cached format
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(FORMAT_EXTENSION):
+                    stat = entry.stat()
+                    name = entry.name[: -len(FORMAT_EXTENSION)]
+                    entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def evict(self, keep: str = "") -> int:
+        # Remove the least recently used formats until the cache fits. Skipped
+        # while other compiles run; the next one evicts instead.
+        with open(self.path("", ".lock"), "a") as file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, name in entries:
+                if total <= self.max_size:
+                    break
+                if name == keep:
+                    continue
+                for extension in (FORMAT_EXTENSION, ".log", ".lock"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.path(name, extension))
+                total -= size
+                removed += 1
+            self.remove_stale_builds()
+        if removed:
+            logger.info(f"Evicted {removed} formats from {self.directory}.")
+        return removed
+
+    def remove_stale_builds(self):
+        deadline = time.time() - STALE_BUILD_SECONDS
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if (
+                    entry.name.startswith(".build-")
+                    and entry.stat().st_mtime < deadline
+                ):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                elif (
+                    entry.name.endswith(FAILED_EXTENSION)
+                    and entry.stat().st_mtime < deadline
+                ):
+                    # Retry failed builds now and then, e.g. after a package update.
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
+
+    def run(self, engine: str, args: List[str]) -> int:
+        # Compile with the cached format of the source, or plainly if it has none.
+        source = find_source(args)
+        name = None
+        if source is not None:
+            name, reason = format_name(engine, source)
+            if name is None:
+                logger.debug(f"Not caching the format of {source}: {reason}.")
+            elif not self.ensure(engine, source, name):
+                name = None
+        if name is None:
+            return subprocess.run([engine] + args).returncode
+        self.evict(keep=name)
+        env = dict(os.environ)
+        env["TEXFORMATS"] = self.directory + os.pathsep + env.get("TEXFORMATS", "")
+        with open(self.path("", ".lock"), "a") as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            if not os.path.exists(self.path(name)):  # evicted before the lock
+                return self.run(engine, args)
+            command = expand_command(self.run_command, args, engine=engine, name=name)
+            return subprocess.run(command, env=env).returncode
+
+
+def find_source(args: List[str]) -> Optional[str]:
+    # The root document among the engine arguments, as latexmk passes them.
+    if any(arg.startswith(("-ini", "-fmt", "&")) for arg in args):
+        return None
+    for arg in reversed(args):
+        if arg.startswith("-"):
+            continue
+        for path in (arg, arg + ".tex"):
+            if os.path.isfile(path):
+                return path
+        return None
+    return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Compile LaTeX documents with cached formats of their preambles.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("LATEX_FORMAT_CACHE", CACHE_DIR),
+        help="Directory of the cached formats (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-size",
+        default=os.environ.get("LATEX_FORMAT_CACHE_SIZE", DEFAULT_MAX_SIZE),
+        help="Evict the least recently used formats above this size (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--build-command",
+        default=DEFAULT_BUILD_COMMAND,
+        help="Command that dumps a format (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--run-command",
+        default=DEFAULT_RUN_COMMAND,
+        help="Command that compiles with a format (default: %(default)s)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser(
+        "run", help="Compile with ENGINE, e.g. as latexmk's $pdflatex"
+    )
+    run.add_argument("engine", choices=sorted(ENGINES))
+    run.add_argument("args", nargs=argparse.REMAINDER)
+    build = subparsers.add_parser("build", help="Fill the cache ahead of compiles")
+    build.add_argument("engine", choices=sorted(ENGINES))
+    build.add_argument("sources", nargs="+")
+    subparsers.add_parser("evict", help="Shrink the cache to --max-size now")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    cache = FormatCache(
+        args.cache_dir,
+        parse_size(args.max_size),
+        build_command=args.build_command,
+        run_command=args.run_command,
+    )
+    if args.command == "run":
+        sys.exit(cache.run(args.engine, args.args))
+    elif args.command == "build":
+        failed = 0
+        for source in args.sources:
+            name, reason = format_name(args.engine, source)
+            if name is None:
+                logger.warning(f"Skipping {source}: {reason}.")
+            elif not cache.ensure(args.engine, source, name):
+                failed += 1
+        cache.evict()
+        sys.exit(1 if failed else 0)
+    else:
+        cache.evict()
+
+
+if __name__ == "__main__":
+    main()
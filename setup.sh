@@ -41,7 +41,8 @@ usage() {
 		"${INDENT}--env-file                            " \
 		"${INDENT}--downloads-dir DOWNLOADS_DIR         Path to the directory containing things to download" \
 		"${INDENT}--download-texlive                                                                       " \
-		"${INDENT}--generate-texlive-install-profile                                                       " \
+		"${INDENT}--generate-texlive-install-profile    With TEXLIVE_SCHEME=documents, from ~/Projects and ~/Documents" \
+		"${INDENT}--texlive-layers N                    Install TeX Live as a base scheme plus N-1 collection layers" \
 		"${INDENT}--mount                               Mount TexLive ISO (superuser privilege required)   " \
 		"${INDENT}--download-typefaces                                                                     " \
 		"${INDENT}--extract-typefaces                                                                      " \
@@ -54,6 +55,7 @@ ENV_FILE="${SCRIPT_DIR}/.env"
 DOWNLOADS_DIR="${SCRIPT_DIR}/downloads"
 DOWNLOAD_TEXLIVE=false
 GENERATE_TEXLIVE_INSTALL_PROFILE=false
+TEXLIVE_LAYERS=1
 DOWNLOAD_TYPEFACES=false
 EXTRACT_TYPEFACES=false
 REMOVE_TYPEFACES_ZIPFILES=false
@@ -87,6 +89,10 @@ while [[ $# -gt 0 ]]; do
 		GENERATE_TEXLIVE_INSTALL_PROFILE="true"
 		shift 1
 		;;
+	--texlive-layers)
+		TEXLIVE_LAYERS="${2}"
+		shift 2
+		;;
 	--extract-typefaces)
 		EXTRACT_TYPEFACES="true"
 		shift 1
@@ -105,20 +111,22 @@ done
 
 set -o allexport && source ${ENV_FILE} && set +o allexport
 
+TYPEFACES_DIR="${DOWNLOADS_DIR}/typefaces"
+
+# The Dockerfile always bind-mounts the package list, which stays empty unless a
+# generated profile needs packages on top of its collections.
+mkdir -p "${DOWNLOADS_DIR}"
+touch "${DOWNLOADS_DIR}/texlive.packages"
+
 if [[ "$DOWNLOAD_TEXLIVE" == "true" ]]; then
 	# We use the huge ISO distribution.
-	if [[ ! -f ${DOWNLOADS_DIR}/texlive${TEXLIVE_VERSION}.iso ]]; then
-		wget https://ctan.mirrors.hoobly.com/systems/texlive/Images/texlive${TEXLIVE_VERSION}.iso -O ${DOWNLOADS_DIR}/texlive${TEXLIVE_VERSION}.iso
-	fi
-	# Check MD5.
-	info "Checking the MD5 checksum of texlive${TEXLIVE_VERSION}.iso."
-	md5="$(md5sum ${DOWNLOADS_DIR}/texlive${TEXLIVE_VERSION}.iso | awk '{ print $1 }')"
-	real_md5="$(wget -qO- https://ctan.math.utah.edu/ctan/tex-archive/systems/texlive/Images/texlive${TEXLIVE_VERSION}.iso.md5 | awk '{ print $1 }')"
-	if [ ${md5} != ${real_md5} ]; then
-		error "MD5 Unverified. Check your networking status, remove the corrupt file (${DOWNLOADS_DIR}/texlive${TEXLIVE_VERSION}.iso) and execute the script again."
+	# Its SHA512 checksum is computed while it downloads, and an ISO verified on a previous run is not hashed again.
+	info "Downloading and verifying texlive${TEXLIVE_VERSION}.iso."
+	if ! python3 "${SCRIPT_DIR}/download_artifacts.py" --downloads-dir "${DOWNLOADS_DIR}" "${SCRIPT_DIR}/texlive.yaml"; then
+		error "Unverified. Check your networking status and execute the script again."
 		exit 1
 	else
-		info "MD5 Verified."
+		info "SHA512 Verified."
 	fi
 fi
 
@@ -135,7 +143,26 @@ if [[ $MOUNT == "true" ]]; then
 	fi
 fi
 
-if [[ $GENERATE_TEXLIVE_INSTALL_PROFILE == "true" ]]; then
+if [[ $GENERATE_TEXLIVE_INSTALL_PROFILE == "true" && (${TEXLIVE_SCHEME} == "documents" || ${TEXLIVE_LAYERS} -gt 1) ]]; then
+	# With TEXLIVE_SCHEME=documents, only the collections and packages our documents use.
+	# Both are resolved through the tlpdb of the mounted ISO, which also sizes the layers
+	# written to the auto-generated TeX Live section of the Dockerfile.
+	if [[ ${TEXLIVE_SCHEME} == "documents" ]]; then
+		scheme_options=(~/Projects ~/Documents)
+	else
+		scheme_options=(--scheme "${TEXLIVE_SCHEME}" --install-docs)
+	fi
+	if ! python3 "${SCRIPT_DIR}/texlive_profile.py" \
+		--tlpdb "${DOWNLOADS_DIR}/texlive/tlpkg/texlive.tlpdb" \
+		--profile "${DOWNLOADS_DIR}/texlive.profile" \
+		--packages-file "${DOWNLOADS_DIR}/texlive.packages" \
+		--layers "${TEXLIVE_LAYERS}" \
+		--dockerfile "${SCRIPT_DIR}/Dockerfile" \
+		"${scheme_options[@]}"; then
+		error "Unable to generate the profile. Mount the ISO with --mount first."
+		exit 1
+	fi
+elif [[ $GENERATE_TEXLIVE_INSTALL_PROFILE == "true" ]]; then
 	# Reference: https://www.tug.org/texlive/doc/install-tl.html#PROFILES
 	install_profile=$(
 		cat <<-END
@@ -168,84 +195,32 @@ if [[ $GENERATE_TEXLIVE_INSTALL_PROFILE == "true" ]]; then
 			tlpdbopt_w32_multi_user 1
 		END
 	)
-	echo "${install_profile}" >>"${DOWNLOADS_DIR}/texlive.profile"
+	echo "${install_profile}" >"${DOWNLOADS_DIR}/texlive.profile"
+	# The scheme covers everything, so there is nothing to install on top of it.
+	: >"${DOWNLOADS_DIR}/texlive.packages"
+	# Drop the tlmgr layers of an earlier layered install from the Dockerfile.
+	if ! python3 "${SCRIPT_DIR}/texlive_profile.py" --reset-dockerfile --dockerfile "${SCRIPT_DIR}/Dockerfile"; then
+		error "Unable to reset the TeX Live section of the Dockerfile."
+		exit 1
+	fi
 	info "TeXLive installation profile is saved to ${DOWNLOADS_DIR}/texlive.profile."
 fi
 
-wget_urls=()
-wget_paths=()
-_append_to_list() {
-	# $1: flag
-	if [ -z "$(eval echo "\$$1")" ]; then
-		warning "$1 is unset. Failed to append to the downloading list."
-		return 0
-	fi
-	# $2: url
-	url="$2"
-	# $3: filename
-	if [ -z "$3" ]; then
-		filename=$(basename "$url")
-	else
-		filename="$3"
-	fi
-	mkdir -p $(dirname ${filename})
-	if [ ! -f "${filename}" ]; then
-		wget_paths+=("${filename}")
-		wget_urls+=("$url")
-	fi
-}
-_wget_all() {
-	for i in "${!wget_urls[@]}"; do
-		wget "${wget_urls[i]}" -q -c --show-progress -O "${wget_paths[i]}"
-	done
-}
-_download_everything() {
-	# a wrapper of the function "wget_all"
-	if [ ${#wget_urls[@]} = 0 ]; then
-		debug "No download tasks."
-	else
-		debug "${#wget_urls[@]} files to download:"
-		(
-			IFS=$'\n'
-			echo "${wget_urls[*]}"
-		)
-		_wget_all
-	fi
-}
-
 if [[ ${DOWNLOAD_TYPEFACES} == "true" ]]; then
-	TYPEFACES_DIR="${DOWNLOADS_DIR}/typefaces"
 	mkdir -p ${TYPEFACES_DIR}
 
-	_append_to_list 1 "https://github.com/adobe-fonts/source-han-serif/releases/download/2.002R/09_SourceHanSerifSC.zip" "${TYPEFACES_DIR}/SourceHanSerifSC/SourceHanSerifSC.zip"
-	_append_to_list 1 "https://github.com/adobe-fonts/source-han-sans/releases/download/2.004R/SourceHanSansSC.zip" "${TYPEFACES_DIR}/SourceHanSansSC/SourceHanSansSC.zip"
-	_append_to_list 1 "https://github.com/adobe-fonts/source-han-mono/releases/download/1.002/SourceHanMono.ttc" "${TYPEFACES_DIR}/SourceHanMono/SourceHanMono.ttc"
-	_append_to_list 1 "https://github.com/adobe-fonts/source-serif/releases/download/4.005R/source-serif-4.005_Desktop.zip" "${TYPEFACES_DIR}/SourceSerif/SourceSerif.zip"
-	_append_to_list 1 "https://github.com/adobe-fonts/source-sans/releases/download/3.052R/OTF-source-sans-3.052R.zip" "${TYPEFACES_DIR}/SourceSans/SourceSans.zip"
-	_append_to_list 1 "https://github.com/adobe-fonts/source-code-pro/releases/download/2.042R-u%2F1.062R-i%2F1.026R-vf/OTF-source-code-pro-2.042R-u_1.062R-i.zip" "${TYPEFACES_DIR}/SourceCodePro/SourceCodePro.zip"
-	_append_to_list 1 "https://github.com/ryanoasis/nerd-fonts/releases/download/v3.0.2/SourceCodePro.zip" "${TYPEFACES_DIR}/NerdFontsSourceCodePro/NerdFontsSourceCodePro.zip"
-	_append_to_list 1 "https://github.com/mozilla/Fira/archive/refs/tags/4.106.tar.gz" "${TYPEFACES_DIR}/FiraSans/FiraSans.tar.gz"
-	_append_to_list 1 "https://github.com/tonsky/FiraCode/releases/download/6.2/Fira_Code_v6.2.zip" "${TYPEFACES_DIR}/FiraCode/FiraCode.zip"
-	_append_to_list 1 "https://github.com/ryanoasis/nerd-fonts/releases/download/v3.2.1/FiraCode.zip" "${TYPEFACES_DIR}/NerdFontsFiraCode/NerdFontsSourceCodePro.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/adventor/qag2_501otf.zip" "${TYPEFACES_DIR}/TexGyreAdventor/TexGyreAdventor.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/bonum/qbk2.004otf.zip" "${TYPEFACES_DIR}/TexGyreBonum/TexGyreBonum.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/chorus/qzc2.003otf.zip" "${TYPEFACES_DIR}/TexGyreChorus/TexGyreChorus.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/cursor/qcr2.004otf.zip" "${TYPEFACES_DIR}/TexGyreCursor/TexGyreCursor.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/heros/qhv2.004otf.zip" "${TYPEFACES_DIR}/TexGyreHero/TexGyreHero.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/pagella/qpl2_501otf.zip" "${TYPEFACES_DIR}/TexGyrePagella/TexGyrePagella.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/schola/qcs2.005otf.zip" "${TYPEFACES_DIR}/TexGyreSchola/TexGyreSchola.zip"
-	_append_to_list 1 "https://www.gust.org.pl/projects/e-foundry/tex-gyre/termes/qtm2.004otf.zip" "${TYPEFACES_DIR}/TexGyreTermes/TexGyreTermes.zip"
-	_append_to_list 1 "https://github.com/firamath/firamath/releases/download/v0.3.4/FiraMath-Regular.otf" "${TYPEFACES_DIR}/FiraMath/FiraMath-Regular.otf"
-
-	_download_everything
+	# Fetch every archive listed in the manifest concurrently, resuming partial downloads.
+	python3 "${SCRIPT_DIR}/download_artifacts.py" --downloads-dir "${DOWNLOADS_DIR}" "${SCRIPT_DIR}/typefaces.yaml"
 fi
 
 if [[ "$EXTRACT_TYPEFACES" = "true" ]]; then
-	info "Extracting all the typefaces."
-	# Reference: https://stackoverflow.com/a/2318189
-	cd "$TYPEFACES_DIR"
-	find . -name "*.tar.gz" | while read filename; do tar -zxf "$filename" --directory "$(dirname "$filename")"; done
-	find . -name "*.zip" | while read filename; do unzip -qq -o -d "$(dirname "$filename")" "$filename"; done
+	info "Extracting the font files of all the typefaces."
+	# Only .otf, .ttf and .ttc members are extracted, in parallel.
+	# Archives unchanged since the last run are recorded in .extracted.json and skipped.
+	if ! python3 "${SCRIPT_DIR}/extract_typefaces.py" "$TYPEFACES_DIR"; then
+		error "Some typeface archives could not be extracted."
+		exit 1
+	fi
 fi
 
 if [[ "$REMOVE_TYPEFACES_ZIPFILES" = "true" ]]; then
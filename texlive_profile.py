@@ -0,0 +1,693 @@
+import re
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from typing import Dict, Any, List, Optional, Set, Tuple
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "latex-docker"
+)
+# Bumped whenever the layout of the cached index changes.
+INDEX_VERSION = 2
+# Sizes in texlive.tlpdb are counted in blocks of this many bytes.
+TLPDB_BLOCK_SIZE = 4096
+INDEXED_EXTENSIONS = (".sty", ".cls", ".otf", ".ttf", ".ttc")
+SOURCE_EXTENSIONS = (".tex", ".sty", ".cls", ".ltx", ".dtx")
+# The same trees `generate_default_volume_configuration` mounts.
+DEFAULT_PROJECT_DIRS = ["~/Projects", "~/Documents"]
+BASE_COLLECTIONS = ["collection-basic", "collection-latex"]
+DOCKERFILE_BEGIN_MARKER = "# >>> auto-generated texlive layers"
+DOCKERFILE_END_MARKER = "# <<< auto-generated texlive layers"
+ENGINE_PACKAGES = {
+    "pdflatex": ["latex-bin", "pdftex"],
+    "lualatex": ["latex-bin", "luahbtex", "luaotfload"],
+    "xelatex": ["xetex"],
+}
+
+COMMENT_PATTERN = re.compile(r"(?<!\\)%.*")
+OPTIONS = r"\s*(?:\[[^\]]*\]\s*)*"
+PACKAGE_PATTERN = re.compile(
+    r"\\(?:usepackage|RequirePackage|RequirePackageWithOptions)"
+    + OPTIONS
+    + r"\{([^}]*)\}"
+)
+CLASS_PATTERN = re.compile(r"\\(?:documentclass|LoadClass)" + OPTIONS + r"\{([^}]*)\}")
+FONT_PATTERN = re.compile(
+    r"\\(?:set\w*font|newfontfamily\s*\\\w+|newfontface\s*\\\w+|fontspec)"
+    + OPTIONS
+    + r"\{([^}]*)\}"
+)
+# `% !TEX program = xelatex` and `% !TeX TS-program = lualatex`
+MAGIC_ENGINE_PATTERN = re.compile(
+    r"^%\s*!TeX\s+(?:TS-)?program\s*=\s*(\w+)", re.IGNORECASE | re.MULTILINE
+)
+
+
+def normalize_font_name(name: str) -> str:
+    return re.sub(r"[\s_-]", "", os.path.splitext(name)[0]).casefold()
+
+
+def parse_tlpdb(filename: str, arch: str) -> Dict[str, Any]:
+    # Only what resolution needs: categories, dependencies, installed sizes and
+    # which package ships each .sty, .cls and font file.
+    packages: Dict[str, Dict[str, Any]] = {}
+    files: Dict[str, str] = {}
+    package = None
+    section = None
+    with open(filename, "r", encoding="utf-8", errors="replace") as file:
+        for line in file:
+            if line.startswith(" "):
+                if section == "runfiles" and package is not None:
+                    basename = line.split()[0].rsplit("/", 1)[-1]
+                    if basename.endswith(INDEXED_EXTENSIONS):
+                        files.setdefault(basename, package["name"])
+                continue
+            line = line.rstrip("\n")
+            if not line:
+                package = section = None
+                continue
+            key, _, value = line.partition(" ")
+            if key == "name":
+                package = {
+                    "name": value,
+                    "category": None,
+                    "depends": [],
+                    "size": 0,
+                    "revision": 0,
+                }
+                packages[value] = package
+                section = None
+            elif package is None:
+                continue
+            elif key == "category":
+                package["category"] = value
+            elif key == "revision":
+                package["revision"] = int(value)
+            elif key == "depend":
+                package["depends"].append(value.replace(".ARCH", f".{arch}"))
+            elif key in ("runfiles", "binfiles"):
+                fields = dict(
+                    field.split("=", 1) for field in value.split() if "=" in field
+                )
+                section = key
+                if key == "runfiles" or fields.get("arch") == arch:
+                    package["size"] += int(fields.get("size", 0))
+            else:
+                section = key
+    return {
+        "packages": {
+            name: [
+                package["category"],
+                package["depends"],
+                package["size"],
+                package["revision"],
+            ]
+            for name, package in packages.items()
+        },
+        "files": files,
+    }
+
+
+class TlpdbIndex:
+    """Compact index of texlive.tlpdb, cached on disk next to other latex-docker caches.
+
+    The cache is keyed by the path, size and mtime of the tlpdb and by the
+    architecture, so a new ISO is parsed once and every later run loads a
+    small JSON file instead.
+    """
+
+    def __init__(
+        self, tlpdb: str, arch: str = "x86_64-linux", cache_dir: str = CACHE_DIR
+    ):
+        stat = os.stat(tlpdb)
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    os.path.realpath(tlpdb),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    arch,
+                    INDEX_VERSION,
+                ]
+            ).encode()
+        ).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, f"tlpdb-{key}.json")
+        try:
+            with open(cache_file, "r") as file:
+                index = json.load(file)
+            logger.debug(f"Loaded the tlpdb index from '{cache_file}'.")
+        except (OSError, ValueError):
+            logger.info(f"Indexing '{tlpdb}'.")
+            index = parse_tlpdb(tlpdb, arch)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+                with os.fdopen(fd, "w") as file:
+                    json.dump(index, file, separators=(",", ":"))
+                os.replace(tmp_path, cache_file)
+            except OSError as e:
+                logger.warning(f"Unable to cache the tlpdb index. {str(e)}")
+        self.packages: Dict[str, List[Any]] = index["packages"]
+        self.files: Dict[str, str] = index["files"]
+        self._fonts: Optional[List[Tuple[str, str]]] = None
+
+    def category(self, package: str) -> Optional[str]:
+        return self.packages[package][0] if package in self.packages else None
+
+    def depends(self, package: str) -> List[str]:
+        return self.packages[package][1] if package in self.packages else []
+
+    def size(self, package: str) -> int:
+        return self.packages[package][2] if package in self.packages else 0
+
+    def revision(self, package: str) -> int:
+        return self.packages[package][3] if package in self.packages else 0
+
+    def closure(self, roots) -> Set[str]:
+        closed = set()
+        pending = [root for root in roots if root in self.packages]
+        while pending:
+            package = pending.pop()
+            if package in closed:
+                continue
+            closed.add(package)
+            pending.extend(
+                depend
+                for depend in self.depends(package)
+                if depend in self.packages and depend not in closed
+            )
+        return closed
+
+    def collections(self) -> Dict[str, List[str]]:
+        # Packages each collection pulls in directly, without nested collections.
+        return {
+            name: [
+                depend
+                for depend in self.depends(name)
+                if self.category(depend) not in ("Collection", "Scheme")
+            ]
+            for name in self.packages
+            if self.category(name) == "Collection"
+        }
+
+    def resolve_file(self, filename: str) -> Optional[str]:
+        return self.files.get(filename)
+
+    def resolve_font(self, name: str) -> Optional[str]:
+        # fontspec takes either a file name or a family name; for the latter,
+        # the family is matched against the font file names of each package.
+        package = self.files.get(name) or self.files.get(os.path.basename(name))
+        if package is not None:
+            return package
+        if self._fonts is None:
+            self._fonts = sorted(
+                (normalize_font_name(basename), package)
+                for basename, package in self.files.items()
+                if basename.endswith((".otf", ".ttf", ".ttc"))
+            )
+        normalized = normalize_font_name(name)
+        for stem, package in self._fonts:
+            if normalized and stem.startswith(normalized):
+                return package
+        return None
+
+
+class ProjectRequirements:
+    def __init__(self):
+        self.packages: Set[str] = set()
+        self.classes: Set[str] = set()
+        self.fonts: Set[str] = set()
+        self.engines: Set[str] = set()
+        # Packages and classes the projects ship themselves.
+        self.local: Set[str] = set()
+        self.sources = 0
+
+
+def scan_projects(paths: List[str]) -> ProjectRequirements:
+    requirements = ProjectRequirements()
+    for path in paths:
+        for root, dirs, files in os.walk(os.path.expanduser(path)):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in files:
+                if not name.endswith(SOURCE_EXTENSIONS):
+                    continue
+                if name.endswith((".sty", ".cls")):
+                    requirements.local.add(name)
+                try:
+                    with open(
+                        os.path.join(root, name),
+                        "r",
+                        encoding="utf-8",
+                        errors="replace",
+                    ) as file:
+                        source = file.read()
+                except OSError as e:
+                    logger.warning(
+                        f"Unable to read '{os.path.join(root, name)}'. {str(e)}"
+                    )
+                    continue
+                requirements.sources += 1
+                requirements.engines.update(
+                    engine.lower() for engine in MAGIC_ENGINE_PATTERN.findall(source)
+                )
+                source = COMMENT_PATTERN.sub("", source)
+                for pattern, found in (
+                    (PACKAGE_PATTERN, requirements.packages),
+                    (CLASS_PATTERN, requirements.classes),
+                    (FONT_PATTERN, requirements.fonts),
+                ):
+                    for match in pattern.findall(source):
+                        found.update(
+                            item.strip() for item in match.split(",") if item.strip()
+                        )
+    return requirements
+
+
+def select_packages(
+    index: TlpdbIndex,
+    requirements: ProjectRequirements,
+    base_collections: List[str],
+    extra_packages: List[str],
+    collection_share: float,
+) -> Tuple[List[str], List[str], List[str]]:
+    """Choose the collections and extra packages covering `requirements`.
+
+    A collection is selected as a whole once the packages needed from it make
+    up `collection_share` of its installed size; anything else is left to
+    `tlmgr install`. Returns the collections, the extra packages and the
+    names that no package provides.
+    """
+    roots = set(extra_packages)
+    unresolved = []
+    for names, extension in (
+        (requirements.packages, ".sty"),
+        (requirements.classes, ".cls"),
+    ):
+        for name in names:
+            filename = name + extension
+            if filename in requirements.local:
+                continue
+            package = index.resolve_file(filename)
+            if package is None:
+                unresolved.append(filename)
+            else:
+                roots.add(package)
+    for font in requirements.fonts:
+        package = index.resolve_font(font)
+        if package is None:
+            unresolved.append(font)
+        else:
+            roots.add(package)
+    engines = requirements.engines & ENGINE_PACKAGES.keys()
+    if not engines:
+        engines = {"lualatex"} if "fontspec" in requirements.packages else {"pdflatex"}
+    for engine in engines:
+        roots.update(ENGINE_PACKAGES[engine])
+
+    needed = index.closure(roots)
+    collections = set(base_collections)
+    for collection, members in sorted(index.collections().items()):
+        total = sum(index.size(member) for member in members)
+        used = sum(index.size(member) for member in members if member in needed)
+        if total and used / total >= collection_share:
+            collections.add(collection)
+    covered = index.closure(collections)
+    collections = {
+        package for package in covered if index.category(package) == "Collection"
+    }
+    extras = sorted(
+        package
+        for package in needed - covered
+        if index.category(package) not in ("Collection", "Scheme")
+    )
+    return sorted(collections), extras, sorted(unresolved)
+
+
+def scheme_collections(index: TlpdbIndex, scheme: str) -> List[str]:
+    return sorted(
+        package
+        for package in index.closure([f"scheme-{scheme}"])
+        if index.category(package) == "Collection"
+    )
+
+
+def collection_layers(
+    index: TlpdbIndex, collections: List[str], base: List[str], layers: int
+) -> List[Tuple[List[str], int]]:
+    """Split the collections outside of `base` into at most `layers` groups.
+
+    Collections are ordered from the least to the most recently revised, which
+    is how often they tend to change, with nested collections ahead of the
+    ones depending on them. The order is then cut into runs of about the same
+    installed size. Returns each group with its size in tlpdb blocks.
+    """
+    installed = index.closure(base)
+    remaining = [
+        collection for collection in collections if collection not in installed
+    ]
+
+    def volatility(collection):
+        return max(
+            (index.revision(member) for member in index.depends(collection)), default=0
+        )
+
+    ordered: List[str] = []
+
+    def visit(collection):
+        if collection in ordered:
+            return
+        for depend in index.depends(collection):
+            if depend in remaining:
+                visit(depend)
+        ordered.append(collection)
+
+    for collection in sorted(remaining, key=lambda c: (volatility(c), c)):
+        visit(collection)
+
+    # What each collection adds on top of the base and the earlier ones.
+    sizes = {}
+    for collection in ordered:
+        added = index.closure([collection]) - installed
+        sizes[collection] = sum(index.size(package) for package in added)
+        installed |= added
+
+    target = sum(sizes.values()) / max(layers, 1)
+    groups: List[Tuple[List[str], int]] = []
+    cumulative = 0
+    for collection in ordered:
+        if not groups or (cumulative >= target * len(groups) and len(groups) < layers):
+            groups.append(([], 0))
+        members, size = groups[-1]
+        groups[-1] = (members + [collection], size + sizes[collection])
+        cumulative += sizes[collection]
+    return groups
+
+
+def render_install_section(
+    groups: List[Tuple[List[str], int]], extras: Optional[List[str]], arch: str
+) -> List[str]:
+    # With `extras` None, packages on top of the profile come from the
+    # texlive.packages file; otherwise they get a last layer of their own.
+    tlmgr = f"sudo ${{XDG_PREFIX_DIR}}/texlive/${{TEXLIVE_VERSION}}/bin/{arch}/tlmgr --repository /texlive install"
+    lines = [
+        "RUN --mount=type=bind,from=texlive,target=/texlive \\",
+        "    --mount=type=bind,source=downloads/texlive.profile,target=/tmp/texlive.profile \\",
+    ]
+    if extras is None:
+        lines += [
+            "    --mount=type=bind,source=downloads/texlive.packages,target=/tmp/texlive.packages \\",
+            "    cd /texlive && sudo ./install-tl -profile=/tmp/texlive.profile && \\",
+            "    if [ -s /tmp/texlive.packages ]; then \\",
+            f"        {tlmgr} $(cat /tmp/texlive.packages); \\",
+            "    fi",
+        ]
+        return lines
+    lines.append("    cd /texlive && sudo ./install-tl -profile=/tmp/texlive.profile")
+    steps = [
+        (f"~{size * TLPDB_BLOCK_SIZE / 2**20:.0f} MiB", members)
+        for members, size in groups
+    ]
+    if extras:
+        steps.append(("extra packages", extras))
+    for comment, packages in steps:
+        lines += [
+            f"# {comment}",
+            "RUN --mount=type=bind,from=texlive,target=/texlive \\",
+            f"    {tlmgr} \\",
+            "    " + " ".join(packages),
+        ]
+    return lines
+
+
+def update_dockerfile(filename: str, section: List[str]) -> bool:
+    with open(filename, "r") as file:
+        lines = [line.rstrip("\n") for line in file]
+    try:
+        begin = lines.index(DOCKERFILE_BEGIN_MARKER)
+        end = lines.index(DOCKERFILE_END_MARKER, begin)
+    except ValueError:
+        logger.error(
+            f"'{filename}' has no '{DOCKERFILE_BEGIN_MARKER}' section to update."
+        )
+        return False
+    updated = lines[: begin + 1] + section + lines[end:]
+    if updated != lines:
+        write_file(filename, "".join(line + "\n" for line in updated))
+    return True
+
+
+def render_profile(
+    collections: List[str], texlive_version: str, prefix: str, docs: bool = False
+) -> str:
+    # Mirrors the profile written by `setup.sh --generate-texlive-install-profile`,
+    # with a custom scheme and, unless `docs`, without documentation and sources.
+    texdir = f"{prefix}/texlive/{texlive_version}"
+    lines = ["selected_scheme scheme-custom"]
+    lines += [f"{collection} 1" for collection in collections]
+    lines += [
+        f"TEXDIR {texdir}",
+        f"TEXMFCONFIG ~/.texlive{texlive_version}/texmf-config",
+        "TEXMFHOME ~/texmf",
+        f"TEXMFLOCAL {prefix}/texlive/texmf-local",
+        f"TEXMFSYSCONFIG {texdir}/texmf-config",
+        f"TEXMFSYSVAR {texdir}/texmf-var",
+        f"TEXMFVAR ~/.texlive{texlive_version}/texmf-var",
+        "binary_x86_64-linux 1",
+        "instopt_adjustpath 0",
+        "instopt_adjustrepo 1",
+        "instopt_letter 0",
+        "instopt_portable 0",
+        "instopt_write18_restricted 1",
+        "tlpdbopt_autobackup 1",
+        "tlpdbopt_backupdir tlpkg/backups",
+        "tlpdbopt_create_formats 1",
+        "tlpdbopt_desktop_integration 1",
+        "tlpdbopt_file_assocs 1",
+        "tlpdbopt_generate_updmap 0",
+        f"tlpdbopt_install_docfiles {int(docs)}",
+        f"tlpdbopt_install_srcfiles {int(docs)}",
+        "tlpdbopt_post_code 1",
+        f"tlpdbopt_sys_bin {prefix}/bin",
+        f"tlpdbopt_sys_info {prefix}/share/info",
+        f"tlpdbopt_sys_man {prefix}/share/man",
+        "tlpdbopt_w32_multi_user 1",
+    ]
+    return "".join(line + "\n" for line in lines)
+
+
+def write_file(filename: str, content: str) -> None:
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        file.write(content)
+    os.replace(tmp_path, filename)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Generate a minimal TeX Live installation profile and package list from the packages, classes and fonts LaTeX projects use.",
+    )
+
+    parser.add_argument(
+        "projects",
+        type=str,
+        nargs="*",
+        default=DEFAULT_PROJECT_DIRS,
+        help="Directories scanned for LaTeX sources (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--tlpdb",
+        type=str,
+        default="downloads/texlive/tlpkg/texlive.tlpdb",
+        help="texlive.tlpdb of the mounted ISO (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="downloads/texlive.profile",
+        help="Installation profile to write (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--packages-file",
+        type=str,
+        default="downloads/texlive.packages",
+        help="Packages to install with tlmgr on top of the profile (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--collections",
+        type=str,
+        nargs="+",
+        default=BASE_COLLECTIONS,
+        help="Collections always installed (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--packages",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Packages always installed, e.g. latexmk",
+    )
+
+    parser.add_argument(
+        "--collection-share",
+        type=float,
+        default=0.5,
+        help="Install a whole collection once the needed packages make up this share of its size (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--texlive-version",
+        type=str,
+        default=os.environ.get("TEXLIVE_VERSION"),
+        help="TeX Live version (default: $TEXLIVE_VERSION)",
+    )
+
+    parser.add_argument(
+        "--prefix",
+        type=str,
+        default=os.environ.get("XDG_PREFIX_DIR", "/usr/local"),
+        help="Installation prefix (default: $XDG_PREFIX_DIR or /usr/local)",
+    )
+
+    parser.add_argument(
+        "--scheme",
+        type=str,
+        help="Install this scheme, e.g. full, instead of what the projects use",
+    )
+
+    parser.add_argument(
+        "--install-docs",
+        action="store_true",
+        help="Install documentation and sources",
+    )
+
+    parser.add_argument(
+        "--layers",
+        type=int,
+        default=1,
+        help="Install a base scheme, then the other collections in up to this many tlmgr layers (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--base-scheme",
+        type=str,
+        default="basic",
+        help="Scheme of the first layer when --layers is more than 1 (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--dockerfile",
+        type=str,
+        help="Dockerfile whose auto-generated TeX Live section is updated to match",
+    )
+
+    parser.add_argument(
+        "--reset-dockerfile",
+        action="store_true",
+        help="Only restore the single install step in the section of --dockerfile, e.g. after a layered install",
+    )
+
+    parser.add_argument(
+        "--arch",
+        type=str,
+        default="x86_64-linux",
+        help="Binary architecture (default: %(default)s)",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.reset_dockerfile:
+        # Needs neither the tlpdb nor the projects.
+        if args.dockerfile is None:
+            logger.error("--reset-dockerfile needs --dockerfile.")
+            sys.exit(1)
+        section = render_install_section([], None, args.arch)
+        sys.exit(0 if update_dockerfile(args.dockerfile, section) else 1)
+    if args.texlive_version is None:
+        logger.error("Set --texlive-version or TEXLIVE_VERSION.")
+        sys.exit(1)
+    try:
+        index = TlpdbIndex(args.tlpdb, args.arch)
+    except OSError as e:
+        logger.error(f"Unable to read '{args.tlpdb}'. Is the ISO mounted? {str(e)}")
+        sys.exit(1)
+
+    if args.scheme is not None:
+        collections = scheme_collections(index, args.scheme)
+        extras = sorted(set(args.packages))
+        if not collections:
+            logger.error(f"The tlpdb has no scheme-{args.scheme}.")
+            sys.exit(1)
+    else:
+        requirements = scan_projects(args.projects)
+        collections, extras, unresolved = select_packages(
+            index, requirements, args.collections, args.packages, args.collection_share
+        )
+        for name in unresolved:
+            logger.warning(f"No TeX Live package provides '{name}'.")
+        logger.info(
+            f"Scanned {requirements.sources} files: {len(requirements.packages)} packages, "
+            f"{len(requirements.classes)} classes and {len(requirements.fonts)} fonts."
+        )
+
+    if args.layers > 1:
+        base = scheme_collections(index, args.base_scheme)
+        groups = collection_layers(index, collections, base, args.layers - 1)
+        profile_collections = base
+        # The layers name the packages themselves, so the list stays empty.
+        packages_file_content = ""
+        section = render_install_section(groups, extras, args.arch)
+        for i, (members, size) in enumerate(groups, start=2):
+            logger.info(
+                f"Layer {i}: {len(members)} collections, "
+                f"{size * TLPDB_BLOCK_SIZE / 2**20:.0f} MiB."
+            )
+    else:
+        profile_collections = collections
+        packages_file_content = "".join(package + "\n" for package in extras)
+        section = render_install_section([], None, args.arch)
+
+    write_file(
+        args.profile,
+        render_profile(
+            profile_collections, args.texlive_version, args.prefix, args.install_docs
+        ),
+    )
+    write_file(args.packages_file, packages_file_content)
+    if args.dockerfile is not None and not update_dockerfile(args.dockerfile, section):
+        sys.exit(1)
+
+    installed = index.closure(collections) | index.closure(extras)
+    size = sum(index.size(package) for package in installed) * TLPDB_BLOCK_SIZE
+    full = (
+        sum(index.size(package) for package in index.closure(["scheme-full"]))
+        * TLPDB_BLOCK_SIZE
+    )
+    logger.info(
+        f"Selected {len(collections)} collections and {len(extras)} extra packages, "
+        f"{size / 2**30:.2f} GiB of runtime files"
+        + (f" instead of {full / 2**30:.2f} GiB for scheme-full." if full else ".")
+    )
+    logger.info(
+        f"Profile saved to '{args.profile}', packages to '{args.packages_file}'."
+    )
+
+
+if __name__ == "__main__":
+    main()